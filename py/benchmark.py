@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+##############################################################################
+# benchmark.py
+#
+# Small benchmarks against a running SurfStore deployment. Every benchmark
+# is a subcommand; run one with -h to see its options.
+##############################################################################
+from __future__ import print_function
+import argparse
+import base64
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+import tracemalloc
+
+from config_reader import SurfStoreConfigReader
+
+
+def percentile(ordered, fraction):
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def report(name, latencies):
+    ordered = sorted(latencies)
+    print("%s: %d calls, mean %.2f ms, p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        name, len(ordered), 1000. * sum(ordered) / len(ordered),
+        1000. * percentile(ordered, 0.5), 1000. * percentile(ordered, 0.99),
+        1000. * ordered[-1]))
+
+
+def run_threads(count, target):
+    ''' Run target(i) on count threads, return the seconds it took '''
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - started
+
+
+def write_latency(args, config):
+    '''
+    Time ModifyFile on the leader. Every call commits a new version of the
+    same one-block file, so it measures the 2PC round and nothing else. Run
+    it against configs with 3, 5 and 7 metadata servers to see how the
+    write latency grows with the number of replicas.
+    '''
+    import grpc
+    import SurfStoreBasic_pb2
+    import SurfStoreBasic_pb2_grpc
+    from block_router import BlockRouter
+
+    leader = grpc.insecure_channel('localhost:%d' % config.metadata_ports[config.num_leaders])
+    mstub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(leader)
+    # stored on the servers that own the block, as the client does
+    bstub = BlockRouter(config, lambda port: grpc.insecure_channel('localhost:%d' % port))
+
+    data = os.urandom(config.get_block_size())
+    b_hash = base64.b64encode(hashlib.sha256(data).digest()).decode()
+    bstub.StoreBlock(SurfStoreBasic_pb2.Block(hash=b_hash, data=data))
+
+    filename = "benchmark-%d" % os.getpid()
+    version = mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=filename)).version
+    latencies = []
+    for i in range(args.warmup + args.writes):
+        version += 1
+        file_info = SurfStoreBasic_pb2.FileInfo(filename=filename, version=version, blocklist=[b_hash])
+        started = time.time()
+        result = mstub.ModifyFile(file_info)
+        elapsed = time.time() - started
+        if result.result != 0:
+            raise Exception("ModifyFile failed with result %d" % result.result)
+        if i >= args.warmup:
+            latencies.append(elapsed)
+
+    print("%d metadata servers" % config.num_metadata_servers)
+    report("ModifyFile", latencies)
+
+
+def read_throughput(args, config):
+    '''
+    ReadFile calls per second from --threads threads sharing one
+    MetadataRouter, reading files written just before. With
+    --follower-reads the reads are spread over every metadata server that
+    has the writes, so the rate should grow with the number of servers.
+    '''
+    import grpc
+    import SurfStoreBasic_pb2
+    from metadata_router import MetadataRouter
+
+    router = MetadataRouter(config, lambda port: grpc.insecure_channel('localhost:%d' % port),
+                            args.follower_reads)
+    names = ["benchmark-%d-%d" % (os.getpid(), i) for i in range(args.files)]
+    for filename in names:
+        # an empty blocklist needs no blocks in the blockstore
+        router.ModifyFile(SurfStoreBasic_pb2.FileInfo(filename=filename, version=1))
+
+    latencies = []
+    lock = threading.Lock()
+    def reader(seed):
+        mine = []
+        for i in range(args.reads):
+            filename = names[(seed + i) % len(names)]
+            started = time.time()
+            router.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=filename))
+            mine.append(time.time() - started)
+        with lock:
+            latencies.extend(mine)
+
+    elapsed = run_threads(args.threads, reader)
+
+    print("%d metadata servers, follower reads %s: %.0f reads/s" % (
+        config.num_metadata_servers, "on" if args.follower_reads else "off", len(latencies) / elapsed))
+    report("ReadFile", latencies)
+
+
+def stress(args, config):
+    '''
+    Concurrent writes against the leader. For every thread count, each
+    thread first writes versions of its own file, which should scale with
+    the threads since writes to different files don't wait for each other.
+    Then all threads race to write the next version of one shared file;
+    every version must be won by exactly one writer.
+    '''
+    import grpc
+    import SurfStoreBasic_pb2
+    import SurfStoreBasic_pb2_grpc
+
+    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[config.num_leaders])
+    mstub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
+    prefix = "stress-%d" % os.getpid()
+
+    for count in [int(x) for x in args.threads.split(",")]:
+        def own_file(i):
+            filename = "%s-%d-%d" % (prefix, count, i)
+            for version in range(1, args.writes + 1):
+                result = mstub.ModifyFile(SurfStoreBasic_pb2.FileInfo(filename=filename, version=version))
+                if result.result != 0:
+                    raise Exception("%s version %d failed with result %d" % (filename, version, result.result))
+        elapsed = run_threads(count, own_file)
+        rate = count * args.writes / elapsed
+
+        shared = "%s-%d-shared" % (prefix, count)
+        won = []
+        lock = threading.Lock()
+        def same_file(i):
+            for _ in range(args.writes):
+                version = mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=shared)).version + 1
+                result = mstub.ModifyFile(SurfStoreBasic_pb2.FileInfo(filename=shared, version=version))
+                if result.result == 0:
+                    with lock:
+                        won.append(version)
+        run_threads(count, same_file)
+        final = mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=shared)).version
+        if sorted(won) != list(range(1, final + 1)):
+            raise Exception("%d threads: versions won %s, final version %d" % (count, sorted(won), final))
+
+        print("%3d threads: %7.0f writes/s to separate files, %d/%d racing writes won on one file" % (
+            count, rate, len(won), count * args.writes))
+
+
+def block_client(args, config, barrier, results):
+    ''' One client process of block-throughput '''
+    import grpc
+    import SurfStoreBasic_pb2
+    import SurfStoreBasic_pb2_grpc
+
+    target = 'localhost:%d' % config.get_block_port(args.number)
+    stubs, blocks = [], []
+    for _ in range(args.threads):
+        # a connection of its own, so SO_REUSEPORT can hand it to any worker
+        channel = grpc.insecure_channel(target, options=[("grpc.use_local_subchannel_pool", 1)])
+        stubs.append(SurfStoreBasic_pb2_grpc.BlockStoreStub(channel))
+        mine = []
+        for _ in range(args.calls):
+            data = os.urandom(config.get_block_size())
+            b_hash = base64.b64encode(hashlib.sha256(data).digest()).decode()
+            mine.append(SurfStoreBasic_pb2.Block(hash=b_hash, data=data))
+        blocks.append(mine)
+
+    def store(i):
+        for block in blocks[i]:
+            stubs[i].StoreBlock(block)
+    def get(i):
+        # the blocks another thread stored, most likely through another worker
+        for block in blocks[(i + 1) % args.threads]:
+            if stubs[i].GetBlock(SurfStoreBasic_pb2.Block(hash=block.hash)).data != block.data:
+                raise Exception("GetBlock returned the wrong data for %s" % block.hash)
+
+    barrier.wait()
+    stored = run_threads(args.threads, store)
+    barrier.wait()
+    got = run_threads(args.threads, get)
+    results.put((stored, got))
+
+
+def block_throughput(args, config):
+    '''
+    StoreBlock and then GetBlock calls per second against one block server,
+    from --processes client processes with --threads connections each. Run
+    it against block_store.py -w 1, 2, 4 ... to see the rate grow with the
+    worker processes; the clients need enough processes of their own not
+    to be the limit.
+    '''
+    fork = multiprocessing.get_context("fork")
+    barrier = fork.Barrier(args.processes)
+    results = fork.Queue()
+    clients = [fork.Process(target=block_client, args=(args, config, barrier, results))
+               for _ in range(args.processes)]
+    for client in clients:
+        client.start()
+    timings = [results.get() for _ in clients]
+    for client in clients:
+        client.join()
+
+    calls = args.processes * args.threads * args.calls
+    print("block%d, %d client processes x %d threads: StoreBlock %.0f calls/s, GetBlock %.0f calls/s" % (
+        args.number, args.processes, args.threads,
+        calls / max(t[0] for t in timings), calls / max(t[1] for t in timings)))
+
+
+def block_memory(args, config):
+    '''
+    Memory per block and get() calls per second of the two in-memory
+    block backends, the dict and the arenas. Runs in this process, no
+    servers needed.
+    '''
+    from block_backend import MemoryBackend, ArenaBackend
+
+    blocks = {}
+    for _ in range(args.blocks):
+        data = os.urandom(args.size)
+        blocks[base64.b64encode(hashlib.sha256(data).digest()).decode()] = data
+    hashes = list(blocks)
+
+    for name, backend in (("dict", MemoryBackend()), ("arena", ArenaBackend())):
+        # count the hash strings too, each is a new str in a real server,
+        # and a new copy of the data, the way it comes out of its message
+        tracemalloc.start()
+        for b_hash in hashes:
+            backend.put(b_hash.encode().decode(), bytes(bytearray(blocks[b_hash])))
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        started = time.time()
+        for b_hash in hashes:
+            backend.get(b_hash)
+        elapsed = time.time() - started
+        print("%-5s %d blocks of %d bytes: %.0f bytes per block (%.0f over the data), %.0f gets/s" % (
+            name, len(hashes), args.size, 1. * used / len(hashes), 1. * used / len(hashes) - args.size,
+            len(hashes) / elapsed))
+
+
+def metadata_memory(args, config):
+    '''
+    Memory of the metadata store's file map at --files files of --blocks
+    blocks each, with the log of the last --log-entries writes, in the
+    old layout (tuples holding lists of hash strings) and in FileTable.
+    Every block hash is drawn from a pool of --unique hashes, fewer hashes
+    than blocks means the files share blocks. Runs in this process, no
+    servers needed.
+    '''
+    import random
+    from metadata_table import FileTable
+
+    pool = [base64.b64encode(hashlib.sha256(str(i).encode()).digest()).decode()
+            for i in range(args.unique or args.files * args.blocks)]
+    def blocklist(i):
+        # new strings, as they come out of each request
+        if args.unique:
+            return [random.choice(pool).encode().decode() for _ in range(args.blocks)]
+        return [pool[i * args.blocks + j].encode().decode() for j in range(args.blocks)]
+    names = ["dir%d/file-%d" % (i % 1000, i) for i in range(args.files)]
+
+    def old_layout():
+        files, logs = {}, []
+        for i, filename in enumerate(names):
+            log = ["mod", filename, 1, blocklist(i), "fixed:4096"]
+            files[filename] = (log[2], log[3], False, log[4])
+            logs.append(log)
+            del logs[:-args.log_entries]
+        return files, logs
+
+    def file_table():
+        files, logs = FileTable(), []
+        for i, filename in enumerate(names):
+            logs.append(files.apply(("mod", filename, 1, blocklist(i), "fixed:4096")))
+            del logs[:-args.log_entries]
+        return files, logs
+
+    for name, build in (("tuples", old_layout), ("FileTable", file_table)):
+        # timed without tracemalloc, which slows every allocation down
+        random.seed(1)
+        started = time.time()
+        state = build()
+        elapsed = time.time() - started
+        del state
+
+        random.seed(1)
+        tracemalloc.start()
+        state = build()
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("%-9s %d files x %d blocks: %.0f MB, %.0f bytes per file, built in %.1f s" % (
+            name, args.files, args.blocks, used / 1e6, 1. * used / args.files, elapsed))
+        del state
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SurfStore benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    writes = subparsers.add_parser("write-latency", help="Latency of ModifyFile on the leader")
+    writes.add_argument("config_file", type=str,
+                        help="Path to configuration file")
+    writes.add_argument("-w", "--writes", default=1000, type=int,
+                        help="Number of timed writes")
+    writes.add_argument("--warmup", default=50, type=int,
+                        help="Writes done before timing starts")
+    writes.set_defaults(run=write_latency)
+
+    reads = subparsers.add_parser("read-throughput", help="ReadFile calls per second")
+    reads.add_argument("config_file", type=str,
+                       help="Path to configuration file")
+    reads.add_argument("--follower-reads", action="store_true",
+                       help="Spread the reads over the followers")
+    reads.add_argument("-t", "--threads", default=16, type=int,
+                       help="Threads reading at the same time")
+    reads.add_argument("-r", "--reads", default=2000, type=int,
+                       help="Reads per thread")
+    reads.add_argument("-f", "--files", default=100, type=int,
+                       help="Files written and then read")
+    reads.set_defaults(run=read_throughput)
+
+    writers = subparsers.add_parser("stress", help="Concurrent writes to separate and shared files")
+    writers.add_argument("config_file", type=str,
+                         help="Path to configuration file")
+    writers.add_argument("-t", "--threads", default="1,2,4,8,16,32", type=str,
+                         help="Comma separated thread counts to run with")
+    writers.add_argument("-w", "--writes", default=500, type=int,
+                         help="Writes per thread")
+    writers.set_defaults(run=stress)
+
+    blocks = subparsers.add_parser("block-throughput", help="StoreBlock and GetBlock calls per second")
+    blocks.add_argument("config_file", type=str,
+                        help="Path to configuration file")
+    blocks.add_argument("-n", "--number", default=1, type=int,
+                        help="Block server to run against")
+    blocks.add_argument("-p", "--processes", default=4, type=int,
+                        help="Client processes")
+    blocks.add_argument("-t", "--threads", default=4, type=int,
+                        help="Threads per client process, each with its own connection")
+    blocks.add_argument("-c", "--calls", default=1000, type=int,
+                        help="Blocks each thread stores and then reads")
+    blocks.set_defaults(run=block_throughput)
+
+    memory = subparsers.add_parser("block-memory", help="Memory per block of the in-memory backend")
+    memory.add_argument("-b", "--blocks", default=100000, type=int,
+                        help="Blocks stored")
+    memory.add_argument("-s", "--size", default=4096, type=int,
+                        help="Bytes per block")
+    memory.set_defaults(run=block_memory)
+
+    table = subparsers.add_parser("metadata-memory", help="Memory of the metadata file map")
+    table.add_argument("-f", "--files", default=1000000, type=int,
+                       help="Files in the namespace")
+    table.add_argument("-b", "--blocks", default=4, type=int,
+                       help="Blocks per file")
+    table.add_argument("-u", "--unique", default=0, type=int,
+                       help="Distinct block hashes the blocks are drawn from, 0 for all different")
+    table.add_argument("-l", "--log-entries", default=10000, type=int,
+                       help="Log entries kept, as before a compaction")
+    table.set_defaults(run=metadata_memory)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config_file = getattr(args, "config_file", None)
+    args.run(args, SurfStoreConfigReader(config_file) if config_file else None)
@@ -0,0 +1,761 @@
+##############################################################################
+# block_backend.py
+#
+# Storage backends for the BlockStore. A backend maps a block hash to the
+# block data and exposes put(hash, data), get(hash), contains(hash),
+# delete(hash) and keys(); get returns None when the block isn't stored and
+# delete returns the number of bytes the block took.
+##############################################################################
+import array
+import collections
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import threading
+import zlib
+
+_SEGMENT_BYTES = 64 * 1024 * 1024
+_SEGMENT_NAME  = "segment-%08d.log"
+_SEGMENT_RE    = re.compile(r"^segment-(\d{8})\.log$")
+
+# record: hash length, data length, hash, data
+_RECORD_HEADER = struct.Struct("<HI")
+# data length of a record (and footer entry) that deletes its hash
+_TOMBSTONE = 0xffffffff
+# footer entry: hash length, data offset, data length, hash
+_FOOTER_ENTRY = struct.Struct("<HII")
+# footer trailer: footer offset, number of entries, magic
+_FOOTER_TRAILER = struct.Struct("<QI4s")
+_FOOTER_MAGIC = b"SSF1"
+# fraction of a sealed segment that has to be deleted blocks before its live
+# records are copied to the active segment and it is removed
+_LOG_RECLAIM = 0.5
+
+# first byte of a block stored by CompressedBackend
+_RAW  = b"\x00"
+_ZLIB = b"\x01"
+# bytes compressed to decide whether a block is worth compressing, and the
+# ratio the trial has to beat
+_TRIAL_BYTES = 4096
+_TRIAL_RATIO = 0.9
+
+# ArenaBackend: bytes an arena starts at and grows to, by a quarter at a
+# time (smaller steps would land in the slack bytearray already adds), and
+# the fraction of a full arena that has to be deleted blocks before its
+# live blocks are moved out and it is freed
+_ARENA_START   = 64 * 1024
+_ARENA_BYTES   = 16 * 1024 * 1024
+_ARENA_RECLAIM = 0.5
+# hash table slots: empty, a deleted entry, and the size it starts at
+_SLOT_EMPTY    = 0
+_SLOT_DELETED  = -1
+_INITIAL_SLOTS = 1024
+# location of an entry id that is free for reuse
+_FREE_ENTRY = 0xffffffffffffffff
+
+# SharedLogBackend state has to be inherited by the worker processes
+_FORK = multiprocessing.get_context("fork")
+
+
+class MemoryBackend(object):
+    ''' The original in-memory dict, lost on restart '''
+    def __init__(self):
+        # key --> hash val, value --> block of data
+        self.block_map = {}
+
+    def put(self, b_hash, data):
+        self.block_map[b_hash] = bytes(data)
+
+    def get(self, b_hash):
+        return self.block_map.get(b_hash)
+
+    def contains(self, b_hash):
+        return b_hash in self.block_map
+
+    def delete(self, b_hash):
+        data = self.block_map.pop(b_hash, None)
+        return len(data) if data is not None else 0
+
+    def keys(self):
+        return list(self.block_map)
+
+    def close(self):
+        pass
+
+
+class ArenaBackend(object):
+    '''
+    Blocks kept in memory, lost on restart, with less overhead per block
+    than MemoryBackend. Each block is copied once into a bytearray arena,
+    its hash right before its data, so a stored block costs no Python
+    objects. An arena starts at _ARENA_START bytes and grows in place by
+    a quarter up to arena_bytes, then the next one is started. Entries
+    live in parallel arrays (location, hash and data lengths, fingerprint)
+    and are found through an open addressing table of entry ids with
+    linear probing, about 30 bytes a block. With the hash and the unused
+    end of the active arena that is 90-120 bytes a block over the data
+    once the blocks fill a few arenas, where MemoryBackend takes about
+    165. A store of a few MB can lose more to the unused end, up to a
+    fifth of what it holds; benchmark.py block-memory measures it.
+
+    Lookups probe the table in Python, so a get() is about ten times slower
+    than a dict lookup. Deleted blocks leave holes; once _ARENA_RECLAIM of
+    a full arena is holes its live blocks are copied to the active arena
+    and it is freed.
+    '''
+    def __init__(self, arena_bytes=_ARENA_BYTES):
+        self.arena_bytes = arena_bytes
+        self.arenas = []
+        # bytes taken by deleted blocks, per arena
+        self.dead = []
+        # indexes of freed arenas, reused before the lists grow
+        self.free_arenas = []
+        self.active = -1
+        self.used = 0
+
+        # per entry id: arena << 32 | offset of the hash, then the data
+        self.where = array.array("Q")
+        self.hash_lengths = array.array("H")
+        self.lengths = array.array("I")
+        self.fingerprints = array.array("q")
+        self.free_entries = []
+
+        # entry id + 1, or _SLOT_EMPTY / _SLOT_DELETED
+        self.slots = array.array("i", [_SLOT_EMPTY]) * _INITIAL_SLOTS
+        self.count = 0
+        self.deleted_slots = 0
+        self.lock = threading.Lock()
+
+    def find(self, raw_hash, fingerprint):
+        ''' The slot holding raw_hash, or -1 '''
+        mask = len(self.slots) - 1
+        slot = fingerprint & mask
+        while True:
+            value = self.slots[slot]
+            if value == _SLOT_EMPTY:
+                return -1
+            entry = value - 1
+            if value != _SLOT_DELETED and self.fingerprints[entry] == fingerprint:
+                where = self.where[entry]
+                offset = where & 0xffffffff
+                if self.arenas[where >> 32][offset:offset + self.hash_lengths[entry]] == raw_hash:
+                    return slot
+            slot = (slot + 1) & mask
+
+    def insert(self, entry):
+        ''' Put an entry id in the first free slot, called for a hash that
+        isn't in the table '''
+        mask = len(self.slots) - 1
+        slot = self.fingerprints[entry] & mask
+        while self.slots[slot] > _SLOT_EMPTY:
+            slot = (slot + 1) & mask
+        if self.slots[slot] == _SLOT_DELETED:
+            self.deleted_slots -= 1
+        self.slots[slot] = entry + 1
+
+    def resize(self):
+        ''' Rebuild the table at most 1/3 full, dropping deleted slots '''
+        size = _INITIAL_SLOTS
+        while size < 3 * (self.count + 1):
+            size *= 2
+        self.slots = array.array("i", [_SLOT_EMPTY]) * size
+        self.deleted_slots = 0
+        for entry in range(len(self.where)):
+            if self.where[entry] != _FREE_ENTRY:
+                self.insert(entry)
+
+    def allocate(self, size):
+        ''' Room for size bytes in the active arena, returns (arena, offset).
+        No memoryview of an arena is kept, so it can grow in place. '''
+        if self.active >= 0 and self.used + size > len(self.arenas[self.active]):
+            arena = self.arenas[self.active]
+            grown = len(arena)
+            while grown < self.used + size and grown < self.arena_bytes:
+                grown = min(grown + grown // 4, self.arena_bytes)
+            if self.used + size <= grown:
+                arena.extend(bytes(grown - len(arena)))
+        if self.active < 0 or self.used + size > len(self.arenas[self.active]):
+            previous = self.active
+            arena = bytearray(max(min(_ARENA_START, self.arena_bytes), size))
+            if self.free_arenas:
+                self.active = self.free_arenas.pop()
+                self.arenas[self.active] = arena
+            else:
+                self.active = len(self.arenas)
+                self.arenas.append(arena)
+                self.dead.append(0)
+            self.used = 0
+            if previous >= 0:
+                self.maybe_reclaim(previous)
+        offset = self.used
+        self.used += size
+        return self.active, offset
+
+    def store(self, entry, raw_hash, data):
+        ''' Copy hash and data into an arena for entry '''
+        arena, offset = self.allocate(len(raw_hash) + len(data))
+        start = offset + len(raw_hash)
+        self.arenas[arena][offset:start] = raw_hash
+        self.arenas[arena][start:start + len(data)] = data
+        self.where[entry] = arena << 32 | offset
+
+    def maybe_reclaim(self, arena):
+        holes = self.dead[arena]
+        if arena == self.active or self.arenas[arena] is None or \
+                holes <= _ARENA_RECLAIM * len(self.arenas[arena]):
+            return
+        for entry in range(len(self.where)):
+            where = self.where[entry]
+            if where != _FREE_ENTRY and where >> 32 == arena:
+                offset = where & 0xffffffff
+                record = self.arenas[arena][offset:offset + self.hash_lengths[entry] + self.lengths[entry]]
+                new_arena, new_offset = self.allocate(len(record))
+                self.arenas[new_arena][new_offset:new_offset + len(record)] = record
+                self.where[entry] = new_arena << 32 | new_offset
+        self.arenas[arena] = None
+        self.dead[arena] = 0
+        self.free_arenas.append(arena)
+
+    def put(self, b_hash, data):
+        raw_hash = b_hash.encode()
+        fingerprint = hash(b_hash)
+        with self.lock:
+            if self.find(raw_hash, fingerprint) >= 0:
+                return
+            if 3 * (self.count + self.deleted_slots + 1) > 2 * len(self.slots):
+                self.resize()
+            if self.free_entries:
+                entry = self.free_entries.pop()
+                self.hash_lengths[entry] = len(raw_hash)
+                self.lengths[entry] = len(data)
+                self.fingerprints[entry] = fingerprint
+            else:
+                entry = len(self.where)
+                self.where.append(_FREE_ENTRY)
+                self.hash_lengths.append(len(raw_hash))
+                self.lengths.append(len(data))
+                self.fingerprints.append(fingerprint)
+            self.store(entry, raw_hash, data)
+            self.insert(entry)
+            self.count += 1
+
+    def get(self, b_hash):
+        with self.lock:
+            slot = self.find(b_hash.encode(), hash(b_hash))
+            if slot < 0:
+                return None
+            entry = self.slots[slot] - 1
+            where = self.where[entry]
+            start = (where & 0xffffffff) + self.hash_lengths[entry]
+            # the one copy, protobuf wants bytes; the view is released
+            # before the lock, so the arena can still grow
+            with memoryview(self.arenas[where >> 32]) as view:
+                return view[start:start + self.lengths[entry]].tobytes()
+
+    def contains(self, b_hash):
+        with self.lock:
+            return self.find(b_hash.encode(), hash(b_hash)) >= 0
+
+    def delete(self, b_hash):
+        with self.lock:
+            slot = self.find(b_hash.encode(), hash(b_hash))
+            if slot < 0:
+                return 0
+            entry = self.slots[slot] - 1
+            self.slots[slot] = _SLOT_DELETED
+            self.deleted_slots += 1
+            self.count -= 1
+
+            arena = self.where[entry] >> 32
+            length = self.lengths[entry]
+            self.dead[arena] += self.hash_lengths[entry] + length
+            self.where[entry] = _FREE_ENTRY
+            self.free_entries.append(entry)
+            self.maybe_reclaim(arena)
+            return length
+
+    def keys(self):
+        with self.lock:
+            hashes = []
+            for entry in range(len(self.where)):
+                where = self.where[entry]
+                if where != _FREE_ENTRY:
+                    offset = where & 0xffffffff
+                    hashes.append(self.arenas[where >> 32][offset:offset + self.hash_lengths[entry]].decode())
+            return hashes
+
+    def close(self):
+        pass
+
+
+def pack_location(segment, offset, length):
+    return (segment << 64) | (offset << 32) | length
+
+def unpack_location(location):
+    return location >> 64, (location >> 32) & 0xffffffff, location & 0xffffffff
+
+def record_size(b_hash, length):
+    return _RECORD_HEADER.size + len(b_hash.encode()) + (0 if length == _TOMBSTONE else length)
+
+
+class LogBackend(object):
+    '''
+    Append-only segment files under data_dir. Every block is appended as a
+    record to the active segment; once the segment passes segment_bytes it is
+    sealed with a footer listing (hash, offset, length) for all its records,
+    so startup only has to read footers. A segment without a footer (the
+    process died before sealing it) is scanned record by record once,
+    truncated after the last complete record and sealed.
+
+    The index maps each hash to a single int packing (segment, offset,
+    length). Reads slice a read-only mmap of the segment. Deleting a block
+    appends a tombstone record. Once _LOG_RECLAIM of a sealed segment's
+    bytes are deleted blocks, its live records and the tombstones that may
+    still be needed are appended to the active segment and the file is
+    removed; the segments are checked the same way at startup.
+    '''
+    def __init__(self, data_dir, segment_bytes=_SEGMENT_BYTES):
+        self.data_dir = data_dir
+        self.segment_bytes = segment_bytes
+        self.index = {}
+        self.maps = {}
+        # bytes of records per sealed segment, and of those deleted since
+        self.segment_sizes = {}
+        self.dead = collections.Counter()
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+        segments = sorted(int(m.group(1)) for m in
+                          map(_SEGMENT_RE.match, os.listdir(data_dir)) if m)
+        for segment in segments:
+            entries = self.read_footer(segment)
+            if entries is None:
+                entries = self.recover_segment(segment)
+            if not entries:
+                continue
+            self.segment_sizes[segment] = sum(record_size(b_hash, length) for b_hash, _, length in entries)
+            for b_hash, offset, length in entries:
+                # a tombstone, or a copy left by a compaction that didn't finish
+                location = self.index.pop(b_hash, None)
+                if location is not None:
+                    self.add_dead(b_hash, location)
+                if length != _TOMBSTONE:
+                    self.index[b_hash] = pack_location(segment, offset, length)
+
+        self.open_segment(segments[-1] + 1 if segments else 1)
+        with self.lock:
+            for segment in sorted(self.segment_sizes):
+                self.maybe_compact(segment)
+
+    def segment_path(self, segment):
+        return os.path.join(self.data_dir, _SEGMENT_NAME % segment)
+
+    def open_segment(self, segment):
+        self.active = segment
+        self.active_file = open(self.segment_path(segment), "ab", 0)
+        self.active_size = 0
+        self.active_entries = []
+
+    def read_footer(self, segment):
+        with open(self.segment_path(segment), "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < _FOOTER_TRAILER.size:
+                return None
+            f.seek(size - _FOOTER_TRAILER.size)
+            footer_offset, count, magic = _FOOTER_TRAILER.unpack(f.read(_FOOTER_TRAILER.size))
+            if magic != _FOOTER_MAGIC or footer_offset > size - _FOOTER_TRAILER.size:
+                return None
+            f.seek(footer_offset)
+            footer = f.read(size - _FOOTER_TRAILER.size - footer_offset)
+
+        entries = []
+        pos = 0
+        for _ in range(count):
+            hash_len, offset, length = _FOOTER_ENTRY.unpack_from(footer, pos)
+            pos += _FOOTER_ENTRY.size
+            entries.append((footer[pos:pos + hash_len].decode(), offset, length))
+            pos += hash_len
+        return entries
+
+    def recover_segment(self, segment):
+        ''' Scan an unsealed segment, drop a torn tail record, then seal it '''
+        path = self.segment_path(segment)
+        entries = []
+        with open(path, "rb") as f:
+            data = f.read()
+        pos = 0
+        while pos + _RECORD_HEADER.size <= len(data):
+            hash_len, length = _RECORD_HEADER.unpack_from(data, pos)
+            start = pos + _RECORD_HEADER.size + hash_len
+            data_len = 0 if length == _TOMBSTONE else length
+            if start + data_len > len(data):
+                break
+            b_hash = data[pos + _RECORD_HEADER.size:start].decode()
+            entries.append((b_hash, start, length))
+            pos = start + data_len
+
+        if not entries:
+            os.remove(path)
+            return entries
+        with open(path, "r+b") as f:
+            f.truncate(pos)
+            self.write_footer(f, pos, entries)
+        return entries
+
+    def write_footer(self, f, footer_offset, entries):
+        parts = []
+        for b_hash, offset, length in entries:
+            raw_hash = b_hash.encode()
+            parts.append(_FOOTER_ENTRY.pack(len(raw_hash), offset, length))
+            parts.append(raw_hash)
+        parts.append(_FOOTER_TRAILER.pack(footer_offset, len(entries), _FOOTER_MAGIC))
+        f.seek(footer_offset)
+        f.write(b"".join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def seal_active(self):
+        if self.active_entries:
+            self.write_footer(self.active_file, self.active_size, self.active_entries)
+            self.active_file.close()
+            self.segment_sizes[self.active] = self.active_size
+        else:
+            self.active_file.close()
+            os.remove(self.segment_path(self.active))
+
+    def append(self, b_hash, data, length):
+        ''' Append a record to the active segment, return its data offset '''
+        raw_hash = b_hash.encode()
+        header = _RECORD_HEADER.pack(len(raw_hash), length)
+        self.active_file.write(header + raw_hash + bytes(data))
+
+        offset = self.active_size + len(header) + len(raw_hash)
+        self.active_entries.append((b_hash, offset, length))
+        self.active_size = offset + len(data)
+        return offset
+
+    def roll_segment(self):
+        if self.active_size >= self.segment_bytes:
+            self.seal_active()
+            self.open_segment(self.active + 1)
+
+    def put(self, b_hash, data):
+        with self.lock:
+            if b_hash in self.index:
+                return
+            offset = self.append(b_hash, data, len(data))
+            self.index[b_hash] = pack_location(self.active, offset, len(data))
+            self.roll_segment()
+
+    def delete(self, b_hash):
+        with self.lock:
+            location = self.index.pop(b_hash, None)
+            if location is None:
+                return 0
+            self.append(b_hash, b"", _TOMBSTONE)
+            self.roll_segment()
+            self.add_dead(b_hash, location)
+            self.maybe_compact(unpack_location(location)[0])
+            return unpack_location(location)[2]
+
+    def add_dead(self, b_hash, location):
+        segment, _, length = unpack_location(location)
+        self.dead[segment] += record_size(b_hash, length)
+
+    def maybe_compact(self, segment):
+        ''' Copy the live records of a sealed segment that is mostly deleted
+        blocks to the active segment and remove it, called holding lock '''
+        size = self.segment_sizes.get(segment)
+        if size is None or self.dead[segment] < _LOG_RECLAIM * size:
+            return
+        # a tombstone in the oldest segment has nothing older left to delete
+        oldest = segment == min(self.segment_sizes)
+        segment_map = self.map_segment(segment, 0)
+        for b_hash, offset, length in self.read_footer(segment):
+            if length == _TOMBSTONE:
+                if oldest or b_hash in self.index:
+                    continue
+                self.append(b_hash, b"", _TOMBSTONE)
+            elif self.index.get(b_hash) == pack_location(segment, offset, length):
+                moved = self.append(b_hash, segment_map[offset:offset + length], length)
+                self.index[b_hash] = pack_location(self.active, moved, length)
+            else:
+                continue
+            self.roll_segment()
+        # the copies are on disk before the segment with the originals goes
+        os.fsync(self.active_file.fileno())
+        del self.segment_sizes[segment]
+        del self.dead[segment]
+        # readers still holding the map keep the removed file readable
+        self.maps.pop(segment, None)
+        os.remove(self.segment_path(segment))
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def get(self, b_hash):
+        location = self.index.get(b_hash)
+        if location is None:
+            return None
+        segment, offset, length = unpack_location(location)
+        try:
+            segment_map = self.map_segment(segment, offset + length)
+        except OSError:
+            # compacted away since the index was read, the block was moved
+            if self.index.get(b_hash) == location:
+                raise
+            return self.get(b_hash)
+        return segment_map[offset:offset + length]
+
+    def map_segment(self, segment, end):
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            # the active segment has grown past the current mapping
+            with open(self.segment_path(segment), "rb") as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = segment_map
+        return segment_map
+
+    def contains(self, b_hash):
+        return b_hash in self.index
+
+    def close(self):
+        with self.lock:
+            self.seal_active()
+
+
+class SharedLogBackend(LogBackend):
+    '''
+    A LogBackend shared by worker processes forked after it is created. The
+    segment files are one log for all of them: appends take a lock shared
+    by the workers, and the number of the active segment and the bytes
+    written to it live in shared memory. Each worker keeps its own index
+    and brings it up to date by reading the records appended since it last
+    looked, so a block stored through one worker can be read or deleted
+    through any other. When nothing changed that check is two reads of
+    shared memory.
+
+    Segments are only compacted when it is opened, before the workers are
+    forked: a worker would not see the records another one moved. Only the
+    process that created it may close it, after the workers have exited.
+    '''
+    def __init__(self, data_dir, segment_bytes=_SEGMENT_BYTES):
+        self.shared_lock = _FORK.Lock()
+        # the active segment and the bytes written to it
+        self.position = _FORK.RawArray("Q", 2)
+        LogBackend.__init__(self, data_dir, segment_bytes)
+        # the compaction at startup may have appended to the active segment
+        self.position[1] = self.active_size
+
+    def open_segment(self, segment):
+        LogBackend.open_segment(self, segment)
+        # a worker that reads the new segment number must not see the old
+        # segment's size with it
+        self.position[1] = 0
+        self.position[0] = segment
+
+    def refresh(self):
+        if self.position[0] == self.active and self.position[1] == self.active_size:
+            return
+        with self.lock:
+            with self.shared_lock:
+                segment, size = self.position[0], self.position[1]
+            self.read_log(segment, size)
+
+    def read_log(self, segment, size):
+        ''' Index the log up to size bytes into segment, called holding lock '''
+        while self.active < segment:
+            # sealed by another worker, its footer has what we haven't read
+            for b_hash, offset, length in self.read_footer(self.active):
+                if offset > self.active_size:
+                    self.index_record(b_hash, offset, length)
+            self.active_file.close()
+            LogBackend.open_segment(self, self.active + 1)
+
+        if size <= self.active_size:
+            return
+        segment_map = self.map_segment(self.active, size)
+        pos = self.active_size
+        while pos < size:
+            hash_len, length = _RECORD_HEADER.unpack_from(segment_map, pos)
+            start = pos + _RECORD_HEADER.size + hash_len
+            b_hash = segment_map[pos + _RECORD_HEADER.size:start].decode()
+            self.active_entries.append((b_hash, start, length))
+            self.index_record(b_hash, start, length)
+            pos = start if length == _TOMBSTONE else start + length
+        self.active_size = pos
+
+    def index_record(self, b_hash, offset, length):
+        if length == _TOMBSTONE:
+            self.index.pop(b_hash, None)
+        else:
+            self.index[b_hash] = pack_location(self.active, offset, length)
+
+    def put(self, b_hash, data):
+        with self.lock:
+            with self.shared_lock:
+                self.read_log(self.position[0], self.position[1])
+                if b_hash in self.index:
+                    return
+                offset = self.append(b_hash, data, len(data))
+                self.index[b_hash] = pack_location(self.active, offset, len(data))
+                self.position[1] = self.active_size
+                self.roll_segment()
+
+    def delete(self, b_hash):
+        with self.lock:
+            with self.shared_lock:
+                self.read_log(self.position[0], self.position[1])
+                location = self.index.pop(b_hash, None)
+                if location is None:
+                    return 0
+                self.append(b_hash, b"", _TOMBSTONE)
+                self.position[1] = self.active_size
+                self.roll_segment()
+                return unpack_location(location)[2]
+
+    def keys(self):
+        self.refresh()
+        return LogBackend.keys(self)
+
+    def get(self, b_hash):
+        self.refresh()
+        return LogBackend.get(self, b_hash)
+
+    def contains(self, b_hash):
+        self.refresh()
+        return b_hash in self.index
+
+    def close(self):
+        with self.lock:
+            with self.shared_lock:
+                self.read_log(self.position[0], self.position[1])
+                self.seal_active()
+
+
+class BlockCache(object):
+    '''
+    Byte-budgeted LRU cache in front of another backend. Blocks are admitted
+    when a read misses, not when they are stored, so one big upload doesn't
+    flush out the blocks people actually read. A block bigger than 1/8 of
+    the budget is never admitted.
+    '''
+    def __init__(self, backend, capacity):
+        self.backend = backend
+        self.capacity = capacity
+        self.size = 0
+        # key --> hash, value --> data, least recently used first
+        self.entries = collections.OrderedDict()
+        # bumped by every delete; a read that missed only admits what it
+        # got from the backend if no delete finished in the meantime
+        self.generation = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, b_hash, data):
+        self.backend.put(b_hash, data)
+
+    def get(self, b_hash):
+        with self.lock:
+            data = self.entries.get(b_hash)
+            if data is not None:
+                self.entries.move_to_end(b_hash)
+                self.hits += 1
+                return data
+            self.misses += 1
+            generation = self.generation
+
+        data = self.backend.get(b_hash)
+        if data is not None and len(data) <= self.capacity // 8:
+            self.admit(b_hash, bytes(data), generation)
+        return data
+
+    def admit(self, b_hash, data, generation):
+        with self.lock:
+            if b_hash in self.entries or generation != self.generation:
+                return
+            self.entries[b_hash] = data
+            self.size += len(data)
+            while self.size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def contains(self, b_hash):
+        return b_hash in self.entries or self.backend.contains(b_hash)
+
+    def delete(self, b_hash):
+        freed = self.backend.delete(b_hash)
+        # after the backend's delete, a read that got the block before it
+        # either admitted it already or finds the generation changed
+        with self.lock:
+            data = self.entries.pop(b_hash, None)
+            if data is not None:
+                self.size -= len(data)
+            self.generation += 1
+        return freed
+
+    def keys(self):
+        return self.backend.keys()
+
+    def stats(self):
+        return "cache: %d/%d bytes, %d hits, %d misses, %d evictions" % (
+            self.size, self.capacity, self.hits, self.misses, self.evictions)
+
+    def close(self):
+        self.backend.close()
+
+
+class CompressedBackend(object):
+    '''
+    Compresses blocks with zlib before handing them to another backend. Every
+    stored block starts with a flag byte saying whether the rest is raw or
+    compressed. A block is only compressed if a level 1 trial on its first
+    _TRIAL_BYTES beats _TRIAL_RATIO, so already compressed data costs one
+    cheap trial. Hashes always refer to the uncompressed data.
+    '''
+    def __init__(self, backend, level=6):
+        self.backend = backend
+        self.level = level
+
+    def encode(self, data):
+        trial = data[:_TRIAL_BYTES]
+        if len(trial) == 0 or len(zlib.compress(trial, 1)) > _TRIAL_RATIO * len(trial):
+            return _RAW + data
+        compressed = zlib.compress(data, self.level)
+        if len(compressed) >= len(data):
+            return _RAW + data
+        return _ZLIB + compressed
+
+    def put(self, b_hash, data):
+        if not self.backend.contains(b_hash):
+            self.backend.put(b_hash, self.encode(bytes(data)))
+
+    def get(self, b_hash):
+        stored = self.backend.get(b_hash)
+        if stored is None:
+            return None
+        if stored[:1] == _ZLIB:
+            return zlib.decompress(stored[1:])
+        return stored[1:]
+
+    def contains(self, b_hash):
+        return self.backend.contains(b_hash)
+
+    def delete(self, b_hash):
+        return self.backend.delete(b_hash)
+
+    def keys(self):
+        return self.backend.keys()
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,231 @@
+##############################################################################
+# block_gc.py
+#
+# Garbage collection of the blocks no file uses any more, run on the leader
+# MetadataStore. Every committed log entry moves a reference from each
+# block of the file's old version to each block of the new one; blocks
+# left without references are deleted from the blockstore by a background
+# thread, a small batch at a time.
+##############################################################################
+import array
+import threading
+import time
+
+from metadata_table import OTHER_IDS
+
+# seconds a block has to go without references before it is deleted, and
+# between collection cycles
+_GC_GRACE    = 60.0
+_GC_INTERVAL = 5.0
+# hashes per DeleteBlocks round, and the pause after each so GetBlock and
+# StoreBlock calls never wait behind a long run of deletes
+_GC_BATCH    = 256
+_GC_PAUSE    = 0.01
+
+
+class BlockCollector(object):
+    '''
+    Reference counts by block id, for the ids a FileTable's block_ids hands
+    out. replace() is called for every applied entry, under the store's
+    log_lock. A block whose count drops to zero becomes a candidate, and
+    collect() deletes the candidates that stayed at zero for grace seconds.
+
+    A ModifyFile pins its hashes before it checks that they are in the
+    blockstore and unpins them once the write is committed or turned down,
+    so a pinned block is never picked. A block picked before the pin is
+    reported back by pin() and has to be treated as missing: the client
+    uploads it again after the delete.
+
+    A DeleteBlocks that fails on some replicas is retried next cycle on
+    just those replicas, as long as the block is still unreferenced.
+    '''
+    def __init__(self, decode, blockstore, grace=_GC_GRACE):
+        # decode(block_id) --> hash, blockstore() --> a BlockRouter
+        self.decode = decode
+        self.blockstore = blockstore
+        self.grace = grace
+        self.lock = threading.Lock()
+
+        # references of digest ids, and of the other ids from OTHER_IDS up
+        self.refs = array.array("I")
+        self.other_refs = {}
+        # key --> block id without references, value --> since when
+        self.candidates = {}
+        # key --> hash, value --> ModifyFile calls that pinned it
+        self.pinned = {}
+        # hashes whose DeleteBlocks is in flight
+        self.deleting = set()
+        # key --> (server id, hash) whose DeleteBlocks failed, value --> block id
+        self.failed = {}
+
+        self.cycles = 0
+        self.blocks = 0
+        self.bytes = 0
+
+    def start(self, files):
+        ''' Count the references of every file in files, make candidates of
+        the ids nothing uses, then start collecting in the background '''
+        with self.lock:
+            for _, record in files.items():
+                self.add_refs(record.blocks, 1)
+            now = time.time()
+            for block_id in range(files.block_ids.count):
+                if block_id >= len(self.refs) or self.refs[block_id] == 0:
+                    self.candidates[block_id] = now
+            for block_id in files.block_ids.other_ids.values():
+                if not self.other_refs.get(block_id):
+                    self.candidates[block_id] = now
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def add_refs(self, blocks, delta):
+        ''' Add delta to the references of blocks, called holding lock '''
+        now = time.time()
+        for block_id in blocks:
+            if block_id >= OTHER_IDS:
+                count = self.other_refs.get(block_id, 0) + delta
+                self.other_refs[block_id] = count
+            else:
+                if block_id >= len(self.refs):
+                    self.refs.extend([0] * (block_id + 1 - len(self.refs)))
+                count = self.refs[block_id] + delta
+                self.refs[block_id] = count
+            if count == 0:
+                self.candidates[block_id] = now
+            elif delta > 0:
+                self.candidates.pop(block_id, None)
+
+    def replace(self, old, new):
+        ''' The file of record old (None for a new file) now is record new '''
+        with self.lock:
+            self.add_refs(new.blocks, 1)
+            if old is not None:
+                self.add_refs(old.blocks, -1)
+
+    def pin(self, hashes):
+        ''' Keep hashes from being collected, return the ones being deleted
+        right now '''
+        with self.lock:
+            for b_hash in hashes:
+                self.pinned[b_hash] = self.pinned.get(b_hash, 0) + 1
+            return set(b_hash for b_hash in hashes if b_hash in self.deleting)
+
+    def unpin(self, hashes):
+        with self.lock:
+            for b_hash in hashes:
+                count = self.pinned[b_hash] - 1
+                if count:
+                    self.pinned[b_hash] = count
+                else:
+                    del self.pinned[b_hash]
+
+    def run(self):
+        while True:
+            time.sleep(_GC_INTERVAL)
+            try:
+                self.collect()
+            except Exception as e:
+                print("gc: cycle failed: %s" % e)
+
+    def collect(self):
+        ''' One cycle: delete the blocks that went without references for
+        grace seconds, _GC_BATCH at a time '''
+        deadline = time.time() - self.grace
+        blocks, freed, hashes = 0, 0, 0
+        try:
+            blockstore = self.blockstore()
+            retries = self.pick_failed()
+            if retries:
+                pairs = [pair for pair, _ in retries]
+                try:
+                    deleted, size, failed = blockstore.delete_from(pairs)
+                except Exception:
+                    deleted, size, failed = 0, 0, pairs
+                self.done([(block_id, b_hash) for (_, b_hash), block_id in retries], failed)
+                blocks += deleted
+                freed += size
+
+            while True:
+                batch = self.pick(deadline)
+                if not batch:
+                    break
+                try:
+                    deleted, size, failed = blockstore.delete_blocks([b_hash for _, b_hash in batch])
+                except Exception:
+                    self.done(batch, retry=True)
+                    raise
+                self.done(batch, failed)
+                blocks += deleted
+                freed += size
+                hashes += len(batch)
+                time.sleep(_GC_PAUSE)
+        finally:
+            with self.lock:
+                self.cycles += 1
+                self.blocks += blocks
+                self.bytes += freed
+            if hashes:
+                print("gc: deleted %d blocks of %d bytes (%d unreferenced hashes)" % (blocks, freed, hashes))
+        return freed
+
+    def pick(self, deadline):
+        ''' Up to _GC_BATCH (block id, hash) of the candidates that are due
+        and not pinned, marked as being deleted. Candidates are in the order
+        they lost their last reference, so only the due ones are looked at. '''
+        batch = []
+        with self.lock:
+            for block_id, since in self.candidates.items():
+                if since > deadline or len(batch) == _GC_BATCH:
+                    break
+                b_hash = self.decode(block_id)
+                if b_hash not in self.pinned:
+                    batch.append((block_id, b_hash))
+            for block_id, b_hash in batch:
+                del self.candidates[block_id]
+                self.deleting.add(b_hash)
+        return batch
+
+    def pick_failed(self):
+        ''' The ((server id, hash), block id) of the earlier failed deletes
+        to try again, marked as being deleted. Pairs of blocks referenced
+        again are dropped, and so are those of blocks that are candidates
+        again, they get deleted from every replica once due. '''
+        retries = []
+        with self.lock:
+            for pair, block_id in list(self.failed.items()):
+                if self.count(block_id) or block_id in self.candidates:
+                    del self.failed[pair]
+                elif pair[1] not in self.pinned:
+                    retries.append((pair, block_id))
+            for pair, block_id in retries:
+                del self.failed[pair]
+                self.deleting.add(pair[1])
+        return retries
+
+    def done(self, batch, failed=(), retry=False):
+        ''' The DeleteBlocks of batch finished, failed are the (server id,
+        hash) pairs it didn't reach. After the whole call failed the blocks
+        still without references become candidates again. '''
+        now = time.time()
+        with self.lock:
+            ids = {}
+            for block_id, b_hash in batch:
+                self.deleting.discard(b_hash)
+                ids[b_hash] = block_id
+                if retry and self.count(block_id) == 0:
+                    self.candidates.setdefault(block_id, now)
+            for server_id, b_hash in failed:
+                self.failed[(server_id, b_hash)] = ids[b_hash]
+
+    def count(self, block_id):
+        ''' References of block_id, called holding lock '''
+        if block_id >= OTHER_IDS:
+            return self.other_refs.get(block_id, 0)
+        return self.refs[block_id] if block_id < len(self.refs) else 0
+
+    def stats(self):
+        with self.lock:
+            return "gc: %d cycles deleted %d blocks of %d bytes, %d candidates waiting, %d failed deletes to retry" % (
+                self.cycles, self.blocks, self.bytes, len(self.candidates), len(self.failed))
@@ -0,0 +1,367 @@
+##############################################################################
+# block_router.py
+#
+# Talks to every BlockStore server in the config. Blocks are placed on the
+# servers with a HashRing; the unary BlockStore calls are routed by the
+# block hash, and the batched calls are split per server and sent to all
+# of them at once.
+##############################################################################
+import collections
+import threading
+import time
+from concurrent import futures
+
+import grpc
+
+import SurfStoreBasic_pb2
+import SurfStoreBasic_pb2_grpc
+
+from hash_ring import HashRing
+
+# HasBlocks: hashes per call and calls in flight per server
+_HAS_BLOCKS_CHUNK     = 4096
+_HAS_BLOCKS_IN_FLIGHT = 4
+
+# StoreBlocks: blocks per stream and streams in flight per server
+_UPLOAD_BATCH  = 256
+_UPLOAD_WINDOW = 4
+
+# hashes per batch of GetBlocks streams
+_DOWNLOAD_BATCH = 4096
+
+# Replicated reads: a GetBlock that hasn't answered within the
+# _HEDGE_PERCENTILE of recent GetBlock latencies is sent again to the next
+# replica. _HEDGE_DELAY is used until _HEDGE_MIN_SAMPLES latencies are known.
+_HEDGE_DELAY       = 0.05
+_HEDGE_PERCENTILE  = 0.95
+_HEDGE_MIN_SAMPLES = 32
+_LATENCY_SAMPLES   = 512
+# hedged GetBlock calls in flight while downloading from replicas
+_READ_WINDOW = 64
+# a GetBlock that no replica answered within this many seconds fails
+_READ_TIMEOUT = 30.0
+
+
+def interleave(lists):
+    ''' Round robin over the lists, so every server gets work early on '''
+    merged = []
+    for i in range(max([len(l) for l in lists] or [0])):
+        merged.extend(l[i] for l in lists if i < len(l))
+    return merged
+
+
+class Quorum(object):
+    ''' Counts successful writes per block and lets a caller wait until
+    every block has been written needed times '''
+    def __init__(self, size, needed):
+        self.acks = [0] * size
+        self.needed = needed
+        self.short = size
+        self.pending = 0
+        self.cond = threading.Condition()
+
+    def track(self, future, positions):
+        with self.cond:
+            self.pending += 1
+
+        def done(f):
+            ok = f.exception() is None
+            with self.cond:
+                self.pending -= 1
+                if ok:
+                    for i in positions:
+                        self.acks[i] += 1
+                        if self.acks[i] == self.needed:
+                            self.short -= 1
+                self.cond.notify_all()
+        future.add_done_callback(done)
+
+    def wait(self):
+        with self.cond:
+            while self.short > 0 and self.pending > 0:
+                self.cond.wait()
+            if self.short > 0:
+                raise Exception("write quorum of %d not reached for %d blocks" % (self.needed, self.short))
+
+
+class BlockRouter(object):
+    '''
+    Every block is stored on config.replication servers, the first ones
+    clockwise from it on the ring. A write is done once
+    config.write_quorum of them stored it, the others finish in the
+    background. Reads go to the replica with the fewest calls in flight and
+    are hedged to the next one when they are slow.
+    '''
+    def __init__(self, config, open_channel):
+        self.stubs = {}
+        for server_id, port in config.block_ports.items():
+            self.stubs[server_id] = SurfStoreBasic_pb2_grpc.BlockStoreStub(open_channel(port))
+        self.ring = HashRing(self.stubs.keys())
+        self.replication = config.replication
+        self.write_quorum = config.write_quorum
+
+        # read load and latency per server, used to pick and hedge replicas
+        self.lock = threading.Lock()
+        self.in_flight = dict((server_id, 0) for server_id in self.stubs)
+        self.ewma = dict((server_id, 0.0) for server_id in self.stubs)
+        self.latencies = collections.deque(maxlen=_LATENCY_SAMPLES)
+        self.hedge_delay = _HEDGE_DELAY
+        self.read_pool = None
+
+    def replicas_for(self, b_hash):
+        return self.ring.lookup_n(b_hash, self.replication)
+
+    def group_by_server(self, hashes, size):
+        ''' Split the hashes into per server batches of at most size
+        (position, hash) pairs, interleaved across servers. A hash is in
+        the batches of all its replicas. '''
+        by_server = collections.OrderedDict((server_id, []) for server_id in self.ring.nodes)
+        for i, b_hash in enumerate(hashes):
+            for server_id in self.replicas_for(b_hash):
+                by_server[server_id].append((i, b_hash))
+
+        batches = []
+        for server_id, pairs in by_server.items():
+            batches.append([(server_id, pairs[start:start + size])
+                            for start in range(0, len(pairs), size)])
+        return interleave(batches)
+
+    def pick_replicas(self, b_hash):
+        ''' The replicas of the block, least loaded first '''
+        with self.lock:
+            return sorted(self.replicas_for(b_hash),
+                          key=lambda server_id: (self.in_flight[server_id], self.ewma[server_id]))
+
+    def begin_read(self, server_id):
+        with self.lock:
+            self.in_flight[server_id] += 1
+        return time.time()
+
+    def end_read(self, server_id, started):
+        latency = time.time() - started
+        with self.lock:
+            self.in_flight[server_id] -= 1
+            self.ewma[server_id] = 0.8 * self.ewma[server_id] + 0.2 * latency
+            self.latencies.append(latency)
+            if len(self.latencies) >= _HEDGE_MIN_SAMPLES and len(self.latencies) % 16 == 0:
+                ordered = sorted(self.latencies)
+                self.hedge_delay = ordered[int(_HEDGE_PERCENTILE * (len(ordered) - 1))]
+
+    # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
+    # The same calls as a BlockStoreStub
+
+    def Ping(self, request):
+        ''' Succeeds while every block has write_quorum of its replicas up,
+        so a minority of replicas being down doesn't stop anything '''
+        pings = [(server_id, stub.Ping.future(request)) for server_id, stub in self.stubs.items()]
+        up = set()
+        for server_id, future in pings:
+            if future.exception() is None:
+                up.add(server_id)
+            else:
+                print("WARNING: block server %d is down: %s" % (server_id, future.exception()))
+        for replicas in self.ring.replica_sets(self.replication):
+            if len(up.intersection(replicas)) < self.write_quorum:
+                raise Exception("fewer than %d of block servers %s are up" % (self.write_quorum, list(replicas)))
+        return SurfStoreBasic_pb2.Empty()
+
+    def StoreBlock(self, block):
+        quorum = Quorum(1, self.write_quorum)
+        for server_id in self.replicas_for(block.hash):
+            quorum.track(self.stubs[server_id].StoreBlock.future(block), [0])
+        quorum.wait()
+        return SurfStoreBasic_pb2.Empty()
+
+    def GetBlock(self, block):
+        ''' Read from the least loaded replica, hedging to the next one if
+        it is slower than usual. A replica that doesn't have the block is
+        skipped. Returns an empty Block if no replica has it, and fails if
+        none answered within _READ_TIMEOUT. '''
+        order = self.pick_replicas(block.hash)
+        cond = threading.Condition()
+        state = {"block": None, "started": 0, "finished": 0}
+        give_up = time.time() + _READ_TIMEOUT
+
+        def launch():
+            server_id = order[state["started"]]
+            state["started"] += 1
+            started = self.begin_read(server_id)
+
+            def done(f):
+                self.end_read(server_id, started)
+                with cond:
+                    state["finished"] += 1
+                    if f.exception() is None and f.result().hash == block.hash \
+                    and state["block"] is None:
+                        state["block"] = f.result()
+                    cond.notify_all()
+            timeout = max(give_up - time.time(), 0)
+            self.stubs[server_id].GetBlock.future(block, timeout=timeout).add_done_callback(done)
+
+        with cond:
+            launch()
+            while state["block"] is None:
+                if time.time() >= give_up:
+                    raise Exception("no replica of block %s answered within %.0f seconds" % (block.hash, _READ_TIMEOUT))
+                if state["finished"] == state["started"]:
+                    # everything sent so far failed or came back empty
+                    if state["started"] == len(order):
+                        return SurfStoreBasic_pb2.Block()
+                    launch()
+                    continue
+                deadline = min(time.time() + self.hedge_delay, give_up)
+                while state["block"] is None and state["finished"] < state["started"] \
+                and time.time() < deadline:
+                    cond.wait(deadline - time.time())
+                if state["block"] is None and state["finished"] < state["started"] \
+                and state["started"] < len(order):
+                    launch()
+        return state["block"]
+
+    def HasBlock(self, block):
+        ''' Whether any replica has the block. A replica that is down is
+        skipped, the call only fails if none of them answered. '''
+        answered, error = False, None
+        for server_id in self.replicas_for(block.hash):
+            try:
+                answer = self.stubs[server_id].HasBlock(block, timeout=_READ_TIMEOUT).answer
+            except grpc.RpcError as e:
+                print("WARNING: HasBlock to block server %d failed: %s" % (server_id, e))
+                error = e
+                continue
+            if answer:
+                return SurfStoreBasic_pb2.SimpleAnswer(answer=True)
+            answered = True
+        if not answered and error is not None:
+            raise error
+        return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
+
+    # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
+    # Batched calls, fanned out to every server
+
+    def missing_blocks(self, hashes):
+        ''' Return the hashes stored on fewer than write_quorum of their
+        replicas, in blocklist order, so uploading them again also repairs
+        blocks whose earlier write only reached a minority '''
+        present = [0] * len(hashes)
+        pending = collections.deque()
+        in_flight = _HAS_BLOCKS_IN_FLIGHT * len(self.stubs)
+
+        for server_id, pairs in self.group_by_server(hashes, _HAS_BLOCKS_CHUNK):
+            if len(pending) >= in_flight:
+                self.count_present(present, *pending.popleft())
+            request = SurfStoreBasic_pb2.BlockList(hashes=[p[1] for p in pairs])
+            pending.append((pairs, self.stubs[server_id].HasBlocks.future(request), server_id))
+
+        while pending:
+            self.count_present(present, *pending.popleft())
+
+        return [b_hash for i, b_hash in enumerate(hashes) if present[i] < self.write_quorum]
+
+    def count_present(self, present, pairs, future, server_id):
+        if future.exception() is not None:
+            # the blocks count as not present on a server that is down, the
+            # others still make up their quorum
+            print("WARNING: HasBlocks to block server %d failed: %s" % (server_id, future.exception()))
+            return
+        bitmap = bytearray(future.result().bitmap)
+        for j, (i, b_hash) in enumerate(pairs):
+            if bitmap[j >> 3] & (1 << (j & 7)):
+                present[i] += 1
+
+    def store_blocks(self, hashes, read_blocks):
+        ''' Upload the blocks to all their replicas with StoreBlocks,
+        _UPLOAD_BATCH blocks per stream and at most _UPLOAD_WINDOW streams in
+        flight per server, and wait for the write quorum of every block.
+        read_blocks(hashes) must return an iterator of the Block messages. '''
+        quorum = Quorum(len(hashes), self.write_quorum)
+        pending = collections.deque()
+        in_flight = _UPLOAD_WINDOW * len(self.stubs)
+
+        for server_id, pairs in self.group_by_server(hashes, _UPLOAD_BATCH):
+            if len(pending) >= in_flight:
+                # only wait for it to finish, failures are counted by quorum
+                pending.popleft().exception()
+            blocks = read_blocks([p[1] for p in pairs])
+            future = self.stubs[server_id].StoreBlocks.future(blocks)
+            quorum.track(future, [p[0] for p in pairs])
+            pending.append(future)
+
+        quorum.wait()
+
+    def delete_blocks(self, hashes):
+        ''' Delete the blocks from all their replicas, see delete_from '''
+        return self.delete_from([(server_id, b_hash) for b_hash in hashes
+                                 for server_id in self.replicas_for(b_hash)])
+
+    def delete_from(self, pairs):
+        ''' Delete the blocks of the (server id, hash) pairs from those
+        servers. Return (blocks, bytes) deleted summed over the servers that
+        answered, and the pairs of the servers that didn't. '''
+        by_server = collections.OrderedDict()
+        for server_id, b_hash in pairs:
+            by_server.setdefault(server_id, []).append(b_hash)
+        calls = []
+        for server_id, hashes in by_server.items():
+            for start in range(0, len(hashes), _HAS_BLOCKS_CHUNK):
+                chunk = hashes[start:start + _HAS_BLOCKS_CHUNK]
+                request = SurfStoreBasic_pb2.BlockList(hashes=chunk)
+                calls.append((server_id, chunk, self.stubs[server_id].DeleteBlocks.future(request)))
+
+        deleted, freed, failed = 0, 0, []
+        for server_id, chunk, future in calls:
+            if future.exception() is not None:
+                print("WARNING: DeleteBlocks to block server %d failed: %s" % (server_id, future.exception()))
+                failed.extend((server_id, b_hash) for b_hash in chunk)
+                continue
+            result = future.result()
+            deleted += result.deleted
+            freed += result.bytes
+        return deleted, freed, failed
+
+    def get_blocks(self, hashes):
+        ''' Yield the requested blocks in order '''
+        if self.replication > 1:
+            return self.get_blocks_hedged(hashes)
+        return self.get_blocks_streamed(hashes)
+
+    def get_blocks_hedged(self, hashes):
+        ''' Replicated downloads use hedged GetBlock calls, _READ_WINDOW at
+        a time, so one slow replica doesn't hold up the stream '''
+        if self.read_pool is None:
+            self.read_pool = futures.ThreadPoolExecutor(max_workers=_READ_WINDOW)
+        pending = collections.deque()
+
+        for b_hash in hashes:
+            if len(pending) >= _READ_WINDOW:
+                yield self.check_block(*pending.popleft())
+            request = SurfStoreBasic_pb2.Block(hash=b_hash)
+            pending.append((b_hash, self.read_pool.submit(self.GetBlock, request)))
+
+        while pending:
+            yield self.check_block(*pending.popleft())
+
+    def check_block(self, b_hash, future):
+        block = future.result()
+        if block.hash != b_hash:
+            raise Exception("block %s is missing from the blockstore" % b_hash)
+        return block
+
+    def get_blocks_streamed(self, hashes):
+        ''' Each batch of _DOWNLOAD_BATCH hashes opens one GetBlocks stream
+        per server and reads from them in blocklist order '''
+        for start in range(0, len(hashes), _DOWNLOAD_BATCH):
+            batch = hashes[start:start + _DOWNLOAD_BATCH]
+            owners = [self.ring.lookup(b_hash) for b_hash in batch]
+
+            responses = {}
+            for server_id in set(owners):
+                request = SurfStoreBasic_pb2.BlockList(
+                    hashes=[b_hash for b_hash, owner in zip(batch, owners) if owner == server_id])
+                responses[server_id] = self.stubs[server_id].GetBlocks(request)
+
+            for b_hash, owner in zip(batch, owners):
+                block = next(responses[owner], None)
+                if block is None or block.hash != b_hash:
+                    raise Exception("block %s is missing from the blockstore" % b_hash)
+                yield block
@@ -6,6 +6,8 @@
 # block_store.py
 ##############################################################################
 import argparse
+import asyncio
+import multiprocessing
 import time
 from concurrent import futures
 
@@ -15,15 +17,19 @@ import SurfStoreBasic_pb2
 import SurfStoreBasic_pb2_grpc
 
 from config_reader import SurfStoreConfigReader
+from block_backend import MemoryBackend, ArenaBackend, LogBackend, SharedLogBackend, BlockCache, CompressedBackend
 
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
+# hashes per BlockList streamed back by ListBlocks
+_LIST_BATCH = 4096
 
 class BlockStore(SurfStoreBasic_pb2_grpc.BlockStoreServicer):
-    def __init__(self, config):
+    def __init__(self, config, backend=None):
         super(BlockStore, self).__init__()
 
         # key --> hash val, value --> block of data
-        self.block_map = {}
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.block_size = config.get_block_size()
         # self.config = config
         # self.mstub = None
 
@@ -37,9 +43,20 @@ class BlockStore(SurfStoreBasic_pb2_grpc.BlockStoreServicer):
     # rpc StoreBlock (Block) returns (Empty) {}
     def StoreBlock(self, block, context):
         # print 'storing block with hash:', block.hash 
-        self.block_map[block.hash] = block.data.decode()
+        self.check_block_size(block, context)
+        self.backend.put(block.hash, block.data)
         return SurfStoreBasic_pb2.Empty()
 
+    # // Store a stream of blocks in storage.
+    # rpc StoreBlocks (stream Block) returns (StoreBlocksResult) {}
+    def StoreBlocks(self, block_iterator, context):
+        stored = 0
+        for block in block_iterator:
+            self.check_block_size(block, context)
+            self.backend.put(block.hash, block.data)
+            stored += 1
+        return SurfStoreBasic_pb2.StoreBlocksResult(stored=stored)
+
     # // Get a block in storage.
     # // The client only needs to supply the "hash" field.
     # // The server returns both the "hash" and "data" fields.
@@ -49,11 +66,11 @@ class BlockStore(SurfStoreBasic_pb2_grpc.BlockStoreServicer):
     # rpc GetBlock (Block) returns (Block) {}
     def GetBlock(self, request, context):
         builder = SurfStoreBasic_pb2.Block()
-        try:
-            data = self.block_map[request.hash]
-            builder.data = data.encode()
+        data = self.backend.get(request.hash)
+        if data is not None:
+            builder.data = data
             builder.hash = request.hash
-        except:
+        else:
             print ("No mapping found for hash",request.hash)
         return builder
 
@@ -62,29 +79,201 @@ class BlockStore(SurfStoreBasic_pb2_grpc.BlockStoreServicer):
     # rpc HasBlock (Block) returns (SimpleAnswer) {}
     def HasBlock(self, block, context):
         # print 'testing for existence of block with hash:', block.hash 
-        if block.hash in self.block_map:
+        if self.backend.contains(block.hash):
             return SurfStoreBasic_pb2.SimpleAnswer(answer=True)
 
         return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
 
+    # // Check whether a batch of blocks is in storage.
+    # rpc HasBlocks (BlockList) returns (BlockPresence) {}
+    def HasBlocks(self, block_list, context):
+        bitmap = bytearray((len(block_list.hashes) + 7) // 8)
+        for i, b_hash in enumerate(block_list.hashes):
+            if self.backend.contains(b_hash):
+                bitmap[i >> 3] |= 1 << (i & 7)
+
+        return SurfStoreBasic_pb2.BlockPresence(bitmap=bytes(bitmap))
+
+    # // Get a batch of blocks in storage.
+    # rpc GetBlocks (BlockList) returns (stream Block) {}
+    def GetBlocks(self, block_list, context):
+        for b_hash in block_list.hashes:
+            data = self.backend.get(b_hash)
+            if data is not None:
+                yield SurfStoreBasic_pb2.Block(hash=b_hash, data=data)
+            else:
+                yield SurfStoreBasic_pb2.Block()
+
+    # // List the hashes of every block in storage, a batch at a time.
+    # rpc ListBlocks (Empty) returns (stream BlockList) {}
+    def ListBlocks(self, request, context):
+        hashes = self.backend.keys()
+        for start in range(0, len(hashes), _LIST_BATCH):
+            yield SurfStoreBasic_pb2.BlockList(hashes=hashes[start:start + _LIST_BATCH])
+
+    # // Remove blocks from storage.
+    # rpc DeleteBlocks (BlockList) returns (DeleteBlocksResult) {}
+    def DeleteBlocks(self, block_list, context):
+        result = SurfStoreBasic_pb2.DeleteBlocksResult()
+        for b_hash in block_list.hashes:
+            freed = self.backend.delete(b_hash)
+            if freed:
+                result.deleted += 1
+                result.bytes += freed
+        return result
+
     # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
 
+    def check_block_size(self, block, context):
+        if len(block.data) > self.block_size:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                          "block of %d bytes is over the blocksize of %d" % (len(block.data), self.block_size))
+
+
+class AsyncBlockStore(SurfStoreBasic_pb2_grpc.BlockStoreServicer):
+    '''
+    The BlockStore calls as grpc.aio coroutines, for --aio. Every RPC runs
+    on one event loop, so an open stream costs no thread. Backend calls
+    that can touch disk run on a pool of io_threads; the memory backends are
+    called right on the loop.
+    '''
+    def __init__(self, store, io_threads):
+        super(AsyncBlockStore, self).__init__()
+        self.store = store
+        self.backend = store.backend
+        self.pool = futures.ThreadPoolExecutor(max_workers=io_threads)
+        self.inline = isinstance(store.backend, (MemoryBackend, ArenaBackend))
+
+    async def io(self, fn, *args):
+        if self.inline:
+            return fn(*args)
+        return await asyncio.get_event_loop().run_in_executor(self.pool, fn, *args)
+
+    async def Ping(self, request, context):
+        return SurfStoreBasic_pb2.Empty()
+
+    async def StoreBlock(self, block, context):
+        await self.check_block_size(block, context)
+        await self.io(self.backend.put, block.hash, block.data)
+        return SurfStoreBasic_pb2.Empty()
+
+    async def StoreBlocks(self, block_iterator, context):
+        stored = 0
+        async for block in block_iterator:
+            await self.check_block_size(block, context)
+            await self.io(self.backend.put, block.hash, block.data)
+            stored += 1
+        return SurfStoreBasic_pb2.StoreBlocksResult(stored=stored)
+
+    async def GetBlock(self, request, context):
+        return await self.io(self.store.GetBlock, request, context)
+
+    async def HasBlock(self, block, context):
+        return await self.io(self.store.HasBlock, block, context)
+
+    async def HasBlocks(self, block_list, context):
+        return await self.io(self.store.HasBlocks, block_list, context)
+
+    async def GetBlocks(self, block_list, context):
+        for b_hash in block_list.hashes:
+            data = await self.io(self.backend.get, b_hash)
+            if data is not None:
+                yield SurfStoreBasic_pb2.Block(hash=b_hash, data=data)
+            else:
+                yield SurfStoreBasic_pb2.Block()
+
+    async def ListBlocks(self, request, context):
+        hashes = await self.io(self.backend.keys)
+        for start in range(0, len(hashes), _LIST_BATCH):
+            yield SurfStoreBasic_pb2.BlockList(hashes=hashes[start:start + _LIST_BATCH])
+
+    async def DeleteBlocks(self, block_list, context):
+        return await self.io(self.store.DeleteBlocks, block_list, context)
+
+    async def check_block_size(self, block, context):
+        if len(block.data) > self.store.block_size:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                "block of %d bytes is over the blocksize of %d" % (len(block.data), self.store.block_size))
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description="BlockStore server for SurfStore")
     parser.add_argument("config_file", type=str,
                         help="Path to configuration file")
+    parser.add_argument("-n", "--number", type=int, default=1,
+                        help="Set which number this server is")
     parser.add_argument("-t", "--threads", type=int, default=10,
-                        help="Maximum number of concurrent threads")
-    return parser.parse_args()
+                        help="Maximum number of concurrent threads (with --aio, threads doing disk I/O)")
+    parser.add_argument("--aio", action="store_true",
+                        help="Serve with grpc.aio on an event loop instead of a thread per call")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Worker processes serving the same port, more than one needs -b log")
+    parser.add_argument("-b", "--backend", choices=["memory", "arena", "log"], default="memory",
+                        help="Where blocks are kept: in a dict in memory, packed into arenas in memory, or in segment files on disk")
+    parser.add_argument("-d", "--data-dir", type=str, default="blockdata",
+                        help="Directory for the segment files of the log backend")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        help="Store blocks compressed with zlib when it saves space")
+    parser.add_argument("--wire-compress", action="store_true",
+                        help="Compress the messages this server sends")
+    parser.add_argument("-c", "--cache-bytes", type=int, default=0,
+                        help="Size in bytes of the LRU cache of recently read blocks, 0 for none")
+    args = parser.parse_args()
+    if args.workers > 1 and args.backend != "log":
+        parser.error("--workers needs the log backend, the workers share its segment files")
+    if args.workers > 1 and args.cache_bytes > 0:
+        parser.error("--workers can't be used with a cache, a worker's cache would miss deletes made by the others")
+    return args
 
 
-def serve(args, config):
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.threads))
-    SurfStoreBasic_pb2_grpc.add_BlockStoreServicer_to_server(BlockStore(config), server)
-    server.add_insecure_port("127.0.0.1:%d" % config.block_port)
+def create_backend(args):
+    if args.backend == "log" and args.workers > 1:
+        backend = SharedLogBackend(args.data_dir)
+        print("WARNING: with more than one worker the segment files are only compacted at startup, "
+              "deleted blocks keep their disk space until the next restart")
+    elif args.backend == "log":
+        backend = LogBackend(args.data_dir)
+    elif args.backend == "arena":
+        backend = ArenaBackend()
+    else:
+        backend = MemoryBackend()
+    if args.compress:
+        backend = CompressedBackend(backend)
+    if args.cache_bytes > 0:
+        backend = BlockCache(backend, args.cache_bytes)
+    return backend
+
+
+def run_aio(args, config, backend):
+    ''' Serve with grpc.aio until interrupted '''
+    async def run():
+        server = grpc.aio.server(compression=grpc.Compression.Gzip if args.wire_compress else None,
+                                 options=[("grpc.so_reuseport", 1)])
+        SurfStoreBasic_pb2_grpc.add_BlockStoreServicer_to_server(
+            AsyncBlockStore(BlockStore(config, backend), args.threads), server)
+        port = config.get_block_port(args.number)
+        server.add_insecure_port("127.0.0.1:%d" % port)
+        await server.start()
+        print("Server started on 127.0.0.1:%d (aio)" % port)
+        await server.wait_for_termination()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_threads(args, config, backend):
+    ''' Serve from a thread pool until interrupted '''
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.threads),
+                         compression=grpc.Compression.Gzip if args.wire_compress else None,
+                         options=[("grpc.so_reuseport", 1)])
+    SurfStoreBasic_pb2_grpc.add_BlockStoreServicer_to_server(BlockStore(config, backend), server)
+    port = config.get_block_port(args.number)
+    server.add_insecure_port("127.0.0.1:%d" % port)
     server.start()
-    print("Server started on 127.0.0.1:%d" % config.block_port)
+    print("Server started on 127.0.0.1:%d" % port)
     try:
         while True:
             time.sleep(_ONE_DAY_IN_SECONDS)
@@ -92,7 +281,45 @@ def serve(args, config):
         server.stop(0)
 
 
+def run_workers(args, config, backend):
+    '''
+    Fork args.workers processes that each serve the port on their own
+    socket; with SO_REUSEPORT the kernel spreads new connections over them,
+    so block traffic isn't held to the one core a GIL allows. gRPC must
+    not be started in this process before the fork.
+    '''
+    run = run_aio if args.aio else run_threads
+    fork = multiprocessing.get_context("fork")
+    workers = [fork.Process(target=run, args=(args, config, backend)) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the same interrupt
+        for worker in workers:
+            worker.join()
+
+
+def serve(args, config):
+    backend = create_backend(args)
+    if args.workers > 1:
+        run_workers(args, config, backend)
+    elif args.aio:
+        run_aio(args, config, backend)
+    else:
+        run_threads(args, config, backend)
+    if args.cache_bytes > 0:
+        print(backend.stats())
+    backend.close()
+
+
 if __name__ == "__main__":
     args = parse_args()
     config = SurfStoreConfigReader(args.config_file)
+
+    if args.number not in config.block_ports:
+        raise RuntimeError("block%d not defined in config file" % args.number)
+
     serve(args, config)
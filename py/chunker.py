@@ -0,0 +1,135 @@
+##############################################################################
+# chunker.py
+#
+# Splits files into blocks. A chunking spec is a short string stored with
+# every file in the MetadataStore, so a file keeps being cut the same way
+# it was first uploaded:
+#
+#   fixed:<size>             cut every <size> bytes
+#   cdc:<min>:<avg>:<max>    content-defined cuts with a Gear rolling hash
+#                            (FastCDC-style normalized chunking)
+##############################################################################
+import hashlib
+import struct
+
+FIXED = "fixed"
+CDC   = "cdc"
+
+DEFAULT_CHUNKING = "fixed:4096"
+
+_READ_BYTES = 1024 * 1024
+_MASK64     = (1 << 64) - 1
+
+# 256 pseudo random 64-bit values, derived from sha256 so every client
+# (and every version of this file) agrees on the cut points
+_GEAR = [struct.unpack("<Q", hashlib.sha256(struct.pack("<I", i)).digest()[:8])[0]
+         for i in range(256)]
+
+
+def parse_chunking(spec):
+    ''' Return (mode, sizes) for a chunking spec, raising ValueError if bad '''
+    if not spec:
+        spec = DEFAULT_CHUNKING
+    parts = spec.split(":")
+    sizes = tuple(int(p) for p in parts[1:])
+
+    if parts[0] == FIXED and len(sizes) == 1 and sizes[0] > 0:
+        return FIXED, sizes
+    if parts[0] == CDC and len(sizes) == 3 and 0 < sizes[0] <= sizes[1] <= sizes[2]:
+        return CDC, sizes
+    raise ValueError("Invalid chunking spec: %s" % spec)
+
+
+def cdc_spec(min_size, avg_size, max_size):
+    spec = "%s:%d:%d:%d" % (CDC, min_size, avg_size, max_size)
+    parse_chunking(spec)
+    return spec
+
+
+def default_cdc_sizes(block_size):
+    ''' (min, avg, max) for cdc chunking that fits blocks of block_size:
+    the largest chunk is a whole block, the average a quarter of one '''
+    avg_size = max(block_size // 4, 1)
+    return max(avg_size // 4, 1), avg_size, block_size
+
+
+def max_chunk_size(spec):
+    mode, sizes = parse_chunking(spec)
+    return sizes[-1]
+
+
+def chunk_file(f, spec):
+    ''' Yield the blocks of the open file f, cut according to spec. A
+    yielded block may be a view into a reused buffer, so it is only valid
+    until the next one is requested. '''
+    mode, sizes = parse_chunking(spec)
+    if mode == FIXED:
+        return fixed_chunks(f, sizes[0])
+    return cdc_chunks(f, *sizes)
+
+
+def fixed_chunks(f, block_size):
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    while True:
+        read_amt = f.readinto(buf)
+        if not read_amt:
+            return
+        yield view[:read_amt]
+
+
+def _high_mask(bits):
+    # the high bits of a Gear hash depend on the last 64 bytes, the low
+    # bits only on the last few, so test the high ones
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def cdc_chunks(f, min_size, avg_size, max_size):
+    bits = max(avg_size.bit_length() - 1, 1)
+    # harder to cut before avg_size, easier after it
+    mask_s = _high_mask(bits + 1)
+    mask_l = _high_mask(max(bits - 1, 1))
+
+    buf = bytearray()
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buf) - pos < max_size:
+            data = f.read(_READ_BYTES)
+            if data:
+                buf = buf[pos:] + data
+                pos = 0
+                continue
+            eof = True
+        if pos >= len(buf):
+            return
+        cut = cut_point(buf, pos, len(buf), min_size, avg_size, max_size, mask_s, mask_l)
+        yield memoryview(buf)[pos:cut]
+        pos = cut
+
+
+def cut_point(buf, start, end, min_size, avg_size, max_size, mask_s, mask_l):
+    ''' Return the end offset of the chunk that starts at buf[start] '''
+    length = end - start
+    if length <= min_size:
+        return end
+    if length > max_size:
+        length = max_size
+    normal = min(avg_size, length)
+
+    gear = _GEAR
+    fp = 0
+    i = start + min_size
+    stop = start + normal
+    while i < stop:
+        fp = ((fp << 1) + gear[buf[i]]) & _MASK64
+        i += 1
+        if not fp & mask_s:
+            return i
+    stop = start + length
+    while i < stop:
+        fp = ((fp << 1) + gear[buf[i]]) & _MASK64
+        i += 1
+        if not fp & mask_l:
+            return i
+    return stop
@@ -8,7 +8,12 @@ import base64
 import hashlib
 
 import argparse
+import collections
+import json
 import os.path
+import tempfile
+import time
+from concurrent import futures
 
 import grpc
 
@@ -16,33 +21,137 @@ import SurfStoreBasic_pb2
 import SurfStoreBasic_pb2_grpc
 
 from config_reader import SurfStoreConfigReader
+from block_router import BlockRouter
+from metadata_router import MetadataRouter
+from local_index import LocalBlockIndex
+from chunker import DEFAULT_CHUNKING, FIXED, chunk_file, cdc_spec, default_cdc_sizes, max_chunk_size, parse_chunking
 
+# ModifyFile calls per upload: a block the metadata server's garbage
+# collector deleted meanwhile comes back as missing and is uploaded again
+_UPLOAD_ATTEMPTS = 3
+
+# push every block while the first ModifyFile is still running (--eager-upload)
+eager_upload = False
+
+# chunking spec for new files, existing files keep the one they were stored with
+chunking = DEFAULT_CHUNKING
+
+# gzip every message on our channels (--wire-compress)
+wire_compression = False
+
+# spread ReadFile over all metadata servers instead of only the leader
+follower_reads = False
+
+# where the blocks of files we uploaded or downloaded live on local disk
+block_index = None
+
+# threads hashing a fixed-size chunked file once it is at least
+# _PARALLEL_HASH_MIN_BYTES long, each one taking _HASH_RANGE_BYTES at a time
+hash_workers = 1
+_PARALLEL_HASH_MIN_BYTES = 64 * 1024 * 1024
+_HASH_RANGE_BYTES        = 16 * 1024 * 1024
+
+# files synced at once by sync, and filenames per ReadFiles call
+sync_workers = 8
+_SYNC_READ_BATCH = 1000
+# what sync knew of every file at the end of the last run, kept in the
+# synced directory; files starting with _SYNC_IGNORE are never synced
+_SYNC_STATE  = ".surfstore_sync.json"
+_SYNC_IGNORE = ".surfstore"
 
 ##############################################################################
 
+def open_channel(port):
+    if wire_compression:
+        return grpc.insecure_channel('localhost:%d' % port, compression=grpc.Compression.Gzip)
+    return grpc.insecure_channel('localhost:%d' % port)
+
 def sha256(s):
     m = hashlib.sha256()
     m.update(str.encode(s))
     return base64.b64encode(m.digest())
 
-def create_blocklist(filename):
+def hash_block(block):
+    return base64.b64encode(hashlib.sha256(block).digest()).decode()
+
+def create_blocklist(filename, spec=DEFAULT_CHUNKING):
+    ''' Return a generator of (hash, offset, length) for every block of the
+    file, or None if it can't be opened. Blocks are hashed as they are read,
+    so the file is never held in memory. '''
     try:
         file = open(filename, 'rb')
-        hash_block_tups = []
-
-        while True:
-            block = file.read(4096)
-            read_amt = len(block)
+    except IOError: return None
 
-            if read_amt != 0:
-                _hash = sha256(block)
-                hash_block_tups.append( (_hash, block) )
-            else:
-                break
+    mode, sizes = parse_chunking(spec)
+    if mode == FIXED and hash_workers > 1 and \
+    os.fstat(file.fileno()).st_size >= _PARALLEL_HASH_MIN_BYTES:
+        file.close()
+        return _hash_blocks_parallel(filename, sizes[0])
 
-        return hash_block_tups
+    return _hash_blocks(file, spec)
 
-    except IOError: return None
+def _hash_blocks(file, spec):
+    offset = 0
+    with file:
+        for block in chunk_file(file, spec):
+            read_amt = len(block)
+            yield (hash_block(block), offset, read_amt)
+            offset += read_amt
+
+def _hash_blocks_parallel(filename, block_size):
+    ''' Hash block aligned byte ranges of the file on hash_workers threads.
+    hashlib releases the GIL while hashing, so the threads run on separate
+    cores. Ranges are yielded back in file order. '''
+    size = os.path.getsize(filename)
+    range_bytes = max(_HASH_RANGE_BYTES // block_size, 1) * block_size
+    starts = range(0, size, range_bytes)
+
+    pool = futures.ThreadPoolExecutor(max_workers=hash_workers)
+    try:
+        results = pool.map(lambda start: _hash_range(filename, start, min(start + range_bytes, size), block_size), starts)
+        for hash_offset_tups in results:
+            for tup in hash_offset_tups:
+                yield tup
+    finally:
+        pool.shutdown(wait=False)
+
+def _hash_range(filename, start, end, block_size):
+    hash_offset_tups = []
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        offset = start
+        while offset < end:
+            read_amt = file.readinto(view[:min(block_size, end - offset)])
+            if not read_amt:
+                break
+            hash_offset_tups.append((hash_block(view[:read_amt]), offset, read_amt))
+            offset += read_amt
+    return hash_offset_tups
+
+def file_blocks(filename, spec):
+    ''' Return the blocklist of the file and hash --> (offset, length) of
+    the first copy of each block, or None if it can't be opened. Only
+    hashes and where to find each block are kept, the data is read again
+    for the blocks the blockstore turns out to be missing. '''
+    hash_offset_tups = create_blocklist(filename, spec)
+    if hash_offset_tups == None:
+        return None
+    hashes = []
+    locations = {}
+    for _hash, offset, length in hash_offset_tups:
+        hashes.append(_hash)
+        locations.setdefault(_hash, (offset, length))
+    return hashes, locations
+
+def read_blocks(filename, hashes, locations):
+    ''' Read the requested blocks back from the file, one at a time '''
+    with open(filename, 'rb') as file:
+        for req in hashes:
+            offset, length = locations[req]
+            file.seek(offset)
+            yield SurfStoreBasic_pb2.Block(hash=req, data=file.read(length))
 
 def _create(mstub, bstub, filename, ver):
     # Get the current file info if it exists
@@ -85,34 +194,35 @@ def _modify(mstub, bstub, filename, ver):
     
 def modifyFile(file_info, mstub, bstub):
     filename = file_info.filename
+    # A file that exists remotely keeps its chunking so unchanged regions
+    # produce the same hashes, new (or deleted) files use ours
+    if len(file_info.blocklist) == 0 or file_info.blocklist[0] == '0':
+        file_info.chunking = chunking
+    elif not file_info.chunking:
+        file_info.chunking = DEFAULT_CHUNKING
     # Get the list of hashes
-    hash_block_tups = create_blocklist(filename)
+    blocks = file_blocks(filename, file_info.chunking)
 
     # If this returns None, then the file is not in this directory
-    if hash_block_tups == None:
+    if blocks == None:
         print("Filename: " + filename + ", does not exist!")
         return
+    hashes, locations = blocks
+    file_info.blocklist[:] = hashes
 
-    file_info.blocklist[:] = [ x[0] for x in hash_block_tups ] # List of hashes
-    
-    result = mstub.ModifyFile(file_info)
+    push = None
+    if eager_upload:
+        # start streaming everything now, the metadata check runs meanwhile
+        pool = futures.ThreadPoolExecutor(max_workers=1)
+        push = pool.submit(upload_blocks, bstub, list(locations), filename, locations)
+        pool.shutdown(wait=False)
 
-    if result.result == 2: # MISSING_BLOCKS
-        block_map = dict(hash_block_tups)
-
-        for req in result.missing_blocks:
-            try:
-                to_add = SurfStoreBasic_pb2.Block(hash=req,data=block_map[req])
-                bstub.StoreBlock(to_add)
-            except Exception:
-                print("Error during file storage, please check the blockstore connection.")
-                break
-                
-        # the indent here was probably not needed 
-        updated_result = mstub.ModifyFile(file_info)
+    result, uploaded = store_file(mstub, bstub, file_info, filename, locations, push)
 
-        if updated_result.result == 0: # OK
+    if uploaded is not None: # there were MISSING_BLOCKS
+        if result.result == 0: # OK
             print("Upload successful!")
+            index_upload(filename, locations)
         else:
             print("Upload not successful :(")
 
@@ -124,14 +234,56 @@ def modifyFile(file_info, mstub, bstub):
 
     elif result.result == 0: # OK
         print("Did not update anything, but result == OK so the data probably already existed")
+        index_upload(filename, locations)
+
+def store_file(mstub, bstub, file_info, filename, locations, push=None):
+    ''' ModifyFile, uploading the blocks the blockstore is missing each
+    time it says some are, at most _UPLOAD_ATTEMPTS times. push is an
+    upload of every block already under way. Return the last WriteResult
+    and the bytes uploaded, or None if nothing had to be. '''
+    result = mstub.ModifyFile(file_info)
+    if result.result != 2: # MISSING_BLOCKS
+        return result, None
+
+    uploaded = 0
+    for _ in range(_UPLOAD_ATTEMPTS):
+        try:
+            if push is not None:
+                # every block is already on its way
+                push.result()
+                push = None
+                uploaded += sum(length for offset, length in locations.values())
+            else:
+                missing = list(result.missing_blocks)
+                upload_blocks(bstub, missing, filename, locations)
+                uploaded += sum(locations[b_hash][1] for b_hash in set(missing))
+        except Exception:
+            print("Error during file storage, please check the blockstore connection.")
+
+        result = mstub.ModifyFile(file_info)
+        if result.result != 2:
+            break
+    return result, uploaded
+
+def index_upload(filename, locations):
+    if block_index is not None:
+        block_index.set_file(filename, [(b_hash, offset, length) for b_hash, (offset, length) in locations.items()])
+        block_index.save()
     
+def upload_blocks(bstub, hashes, filename, locations):
+    ''' Stream the requested blocks to the blockstore servers that own
+    them, reading each one back from the file as it is sent '''
+    bstub.store_blocks(hashes, lambda batch: read_blocks(filename, batch, locations))
+
 # support reading of any meta_data store
 def _read(config, bstub, filename, serverID):     
     # create the fileinfo message to send to metadata
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     mstub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
+    download(mstub, bstub, filename)
+
+def download(mstub, bstub, filename):
     file_info = mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=filename))
-    block_list = []
 
     if file_info.version == 0:
         print("FILE NOT FOUND!")
@@ -141,16 +293,64 @@ def _read(config, bstub, filename, serverID):
         print("FILE WAS DELETED!")
         return
     print("downloading file")
-    for block in file_info.blocklist:
-        if bstub.HasBlock(SurfStoreBasic_pb2.Block(hash=block)).answer == True:
-            data = bstub.GetBlock(SurfStoreBasic_pb2.Block(hash=block))
-            block_list.append(data.data)
+    try:
+        fetched, hash_offset_tups = fetch_file(bstub, list(file_info.blocklist), filename)
+    except Exception as e:
+        print("Download failed: %s" % e)
+        return
+    finally:
+        if block_index is not None:
+            block_index.close_files()
     print("writting local file")
-    if len(block_list) > 0:
-        out = open(filename, 'wb')
-
-        for data in block_list:
-            out.write(data)
+    print("fetched %d of %d bytes from the blockstore" % (fetched, sum(t[2] for t in hash_offset_tups)))
+
+    if block_index is not None:
+        block_index.set_file(filename, hash_offset_tups)
+        block_index.save()
+
+def fetch_file(bstub, blocklist, filename):
+    ''' Write the file with the blocklist to filename and return (bytes
+    fetched from the blockstore, [(hash, offset, length)] of the new
+    file). Blocks we already have on disk are copied from there, the rest
+    are streamed from the blockstore in blocklist order. '''
+    # decided once, other threads may change the index meanwhile
+    local = set()
+    if block_index is not None:
+        local = set(b for b in blocklist if block_index.has_block(b))
+    remote_hashes = [b for b in blocklist if b not in local]
+    remote_blocks = bstub.get_blocks(remote_hashes)
+    hash_offset_tups = []
+    offset = 0
+    fetched = 0
+
+    # blocks go straight to a temp file next to the target, which is then
+    # renamed over it, so only a few blocks are ever held in memory
+    out = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(filename)),
+                                      prefix='.surfstore-', delete=False)
+    try:
+        with out:
+            for b_hash in blocklist:
+                data = None
+                if b_hash in local:
+                    data = block_index.read_block(b_hash)
+                    if data is None:
+                        # the local copy changed since it was indexed
+                        block = bstub.GetBlock(SurfStoreBasic_pb2.Block(hash=b_hash))
+                        if block.hash != b_hash:
+                            raise Exception("block %s is missing from the blockstore" % b_hash)
+                        data = block.data
+                        fetched += len(data)
+                else:
+                    data = next(remote_blocks).data
+                    fetched += len(data)
+                out.write(data)
+                hash_offset_tups.append((b_hash, offset, len(data)))
+                offset += len(data)
+    except Exception:
+        os.remove(out.name)
+        raise
+    os.rename(out.name, filename)
+    return fetched, hash_offset_tups
 
 def _delete(mstub, bstub, filename, ver): 
     # create the fileinfo message to send to metadata
@@ -168,12 +368,219 @@ def _delete(mstub, bstub, filename, ver):
         print("Delete unsuccessful, the server is not leader")
 
 
+############### sync ###############
+class SyncStats(object):
+    ''' What one sync_dir run did, for its throughput report '''
+    def __init__(self):
+        self.started = time.time()
+        # key --> action sync_file took, value --> files
+        self.files = collections.Counter()
+        # bytes of the files uploaded or downloaded, and of the blocks that
+        # actually went over the wire for them
+        self.bytes = 0
+        self.wire_bytes = 0
+
+    def add(self, action, size, wire_bytes):
+        self.files[action] += 1
+        if action in ("upload", "download"):
+            self.bytes += size
+            self.wire_bytes += wire_bytes
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        files = sum(self.files.values())
+        mb = 1024. * 1024.
+        print("sync: %d files in %.1f s (%.0f files/s): %d uploaded, %d downloaded, %d deleted, "
+              "%d removed locally, %d unchanged, %d conflicts, %d failed" % (
+                  files, elapsed, files / elapsed, self.files["upload"], self.files["download"],
+                  self.files["delete"], self.files["remove"], self.files["same"],
+                  self.files["conflict"], self.files["failed"]))
+        print("sync: %.1f MB of changed files (%.1f MB/s), %.1f MB transferred, %.1f MB deduplicated" % (
+            self.bytes / mb, self.bytes / mb / elapsed, self.wire_bytes / mb,
+            (self.bytes - self.wire_bytes) / mb))
+
+def sync_dir(mstub, bstub, directory, workers=None):
+    '''
+    Make directory and the server agree on every file in either of them.
+    Remote filenames are the paths relative to directory, with "/"
+    separators. The local tree and the server's ListFiles are diffed
+    against the remote versions read with one ReadFiles per
+    _SYNC_READ_BATCH files, and the files that differ are uploaded or
+    downloaded by at most workers threads sharing the stubs' channels,
+    while the next batch is read.
+
+    A file changed on one side since the last run is copied to the other
+    side; a file changed on both is a conflict and left alone. A file
+    only on the server is downloaded. Returns a SyncStats.
+    '''
+    workers = workers or sync_workers
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    state_file = os.path.join(directory, _SYNC_STATE)
+    state = load_sync_state(state_file)
+    local = walk_tree(directory)
+    names = sorted(set(local) | set(state) | remote_names(mstub))
+    stats = SyncStats()
+
+    pool = futures.ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for start in range(0, len(names), _SYNC_READ_BATCH):
+            batch = names[start:start + _SYNC_READ_BATCH]
+            request = SurfStoreBasic_pb2.FileList(
+                files=[SurfStoreBasic_pb2.FileInfo(filename=name) for name in batch])
+            for name, remote in zip(batch, mstub.ReadFiles(request).files):
+                if len(pending) >= 2 * workers:
+                    finish_sync(pending.popleft(), state, stats)
+                future = pool.submit(sync_file, mstub, bstub, directory, name,
+                                     local.get(name), state.get(name), remote)
+                pending.append((name, future))
+        while pending:
+            finish_sync(pending.popleft(), state, stats)
+    finally:
+        pool.shutdown(wait=True)
+        save_sync_state(state_file, state)
+        if block_index is not None:
+            block_index.close_files()
+            block_index.save()
+    stats.report()
+    return stats
+
+def finish_sync(pending, state, stats):
+    name, future = pending
+    action, entry, size, wire_bytes = future.result()
+    if action == "conflict":
+        print("sync: %s changed here and on the server, skipped" % name)
+    if action not in ("conflict", "failed"):
+        if entry is None:
+            state.pop(name, None)
+        else:
+            state[name] = entry
+    stats.add(action, size, wire_bytes)
+
+def sync_file(mstub, bstub, directory, name, local, entry, remote):
+    '''
+    Sync one file. local is its (size, mtime) or None if it isn't in
+    directory, entry its [version, size, mtime] as of the last run or None,
+    remote its FileInfo. Return (action, the new entry or None, file size,
+    bytes sent or fetched).
+    '''
+    path = os.path.join(directory, *name.split("/"))
+    exists = remote.version != 0 and list(remote.blocklist[:1]) != ['0']
+    base = entry[0] if entry is not None else 0
+    # only a delete newer than the last run removes anything here; version 0
+    # or a version older than base means the server lost the file, not that
+    # someone deleted it
+    tombstone = remote.version > base and list(remote.blocklist[:1]) == ['0']
+    try:
+        if local is None:
+            if not exists:
+                return "same", None, 0, 0
+            if remote.version < base:
+                return "conflict", entry, 0, 0
+            if entry is not None and remote.version == base:
+                # removed here since the last run
+                file_info = SurfStoreBasic_pb2.FileInfo(filename=name, version=remote.version + 1)
+                result = mstub.DeleteFile(file_info).result
+                if result == 1: # OLD_VERSION
+                    return "conflict", entry, 0, 0
+                return ("delete" if result == 0 else "failed"), None, 0, 0
+            return sync_download(bstub, path, remote)
+
+        if entry is not None and list(local) == entry[1:]:
+            # unchanged here since the last run
+            if remote.version == base:
+                return "same", entry, 0, 0
+            if tombstone:
+                os.remove(path)
+                if block_index is not None:
+                    block_index.set_file(path, [])
+                return "remove", None, 0, 0
+            if remote.version > base:
+                return sync_download(bstub, path, remote)
+            # the server is behind the last run, upload it again below
+
+        # new or changed here, it keeps the chunking it has on the server
+        spec = (remote.chunking or DEFAULT_CHUNKING) if exists else chunking
+        blocks = file_blocks(path, spec)
+        if blocks is None:
+            return "failed", entry, 0, 0
+        hashes, locations = blocks
+        if exists and hashes == list(remote.blocklist):
+            return "same", [remote.version] + list(local), 0, 0
+        if exists and remote.version != base:
+            return "conflict", entry, 0, 0
+
+        file_info = SurfStoreBasic_pb2.FileInfo(filename=name, version=remote.version + 1,
+                                                blocklist=hashes, chunking=spec)
+        result, uploaded = store_file(mstub, bstub, file_info, path, locations)
+        if result.result == 1: # OLD_VERSION
+            return "conflict", entry, 0, 0
+        if result.result != 0:
+            return "failed", entry, 0, 0
+        if block_index is not None:
+            block_index.set_file(path, [(b_hash, offset, length) for b_hash, (offset, length) in locations.items()])
+        return "upload", [file_info.version] + list(local), local[0], uploaded or 0
+    except Exception as e:
+        print("sync: %s failed: %s" % (name, e))
+        return "failed", entry, 0, 0
+
+def sync_download(bstub, path, remote):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fetched, hash_offset_tups = fetch_file(bstub, list(remote.blocklist), path)
+    if block_index is not None:
+        block_index.set_file(path, hash_offset_tups)
+    st = os.stat(path)
+    return "download", [remote.version, st.st_size, st.st_mtime], st.st_size, fetched
+
+def remote_names(mstub):
+    ''' The names of the files on the server that can be synced: no empty,
+    "." or ".." parts that would land outside directory, and none that
+    walk_tree would skip '''
+    names = set()
+    for chunk in mstub.ListFiles(SurfStoreBasic_pb2.FileList()):
+        for file_info in chunk.files:
+            parts = file_info.filename.split("/")
+            if any(part in ("", ".", "..") for part in parts) or parts[-1].startswith(_SYNC_IGNORE):
+                continue
+            names.add(file_info.filename)
+    return names
+
+def walk_tree(directory):
+    ''' Remote filename --> (size, mtime) of every file under directory '''
+    local = {}
+    for root, dirs, files in os.walk(directory):
+        for filename in files:
+            if filename.startswith(_SYNC_IGNORE):
+                continue
+            path = os.path.join(root, filename)
+            st = os.stat(path)
+            name = os.path.relpath(path, directory).replace(os.sep, "/")
+            local[name] = (st.st_size, st.st_mtime)
+    return local
+
+def load_sync_state(state_file):
+    try:
+        with open(state_file, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_sync_state(state_file, state):
+    out = tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(os.path.abspath(state_file)),
+                                      prefix=".surfstore-", delete=False)
+    with out:
+        json.dump(state, out)
+    os.rename(out.name, state_file)
+
 ############### part 2 ###############
 def _ping(serverID, config):
     if serverID > config.num_metadata_servers:
         print("the specified server was not born")
         return
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
     try:
         stub.Ping(SurfStoreBasic_pb2.Empty())
@@ -186,7 +593,7 @@ def _crash(serverID, config):
     if serverID > config.num_metadata_servers:
         print("the specified server was not born")
         return
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
     stub.Crash(SurfStoreBasic_pb2.Empty())
 
@@ -194,7 +601,7 @@ def _restore(serverID, config):
     if serverID > config.num_metadata_servers:
         print("the specified server was not born")
         return
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
     stub.Restore(SurfStoreBasic_pb2.Empty())
 
@@ -202,7 +609,7 @@ def _isLeader(serverID, config):
     if serverID > config.num_metadata_servers:
         print("the specified server was not born")
         return
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
     answer = stub.IsLeader(SurfStoreBasic_pb2.Empty()).answer
     if answer == True:
@@ -214,7 +621,7 @@ def _isCrashed(serverID, config):
     if serverID > config.num_metadata_servers:
         print("the specified server was not born")
         return
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[serverID])
+    channel = open_channel(config.metadata_ports[serverID])
     stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
     answer = stub.IsCrashed(SurfStoreBasic_pb2.Empty()).answer
     if answer == True:
@@ -240,6 +647,10 @@ def run_user_cli(mstub, bstub, config):
 
             <read or r> <filename> <#ID of metadata server> 
 
+            <read or r> <filename>
+
+            <sync or s> <directory>
+
             ############ part 2 ############
             <ping> <#ID of metadata server> 
 
@@ -282,6 +693,13 @@ def run_user_cli(mstub, bstub, config):
                     # set version to 1 for file that is created the first time
                     _create(mstub, bstub, sp[1], 1)
                     continue
+                if op == "read" or op == "r":
+                    # the leader, or any replica that has our writes
+                    download(mstub, bstub, sp[1])
+                    continue
+                if op == "sync" or op == "s":
+                    sync_dir(mstub, bstub, sp[1])
+                    continue
                 ########## part2 ##########
                 if (op == "ping"):
                     _ping(int(sp[1]), config)
@@ -357,21 +775,35 @@ def parse_args():
     parser = argparse.ArgumentParser(description="SurfStore client")
     parser.add_argument("config_file", type=str,
                         help="Path to configuration file")
+    parser.add_argument("--eager-upload", action="store_true",
+                        help="Upload blocks while the metadata server checks for missing ones")
+    parser.add_argument("--chunking", choices=["fixed", "cdc"], default="fixed",
+                        help="How new files are cut into blocks")
+    parser.add_argument("--cdc-sizes", type=str, default=None,
+                        help="MIN:AVG:MAX chunk sizes in bytes for --chunking cdc, "
+                             "by default a sixteenth of the blocksize, a quarter of it and the blocksize")
+    parser.add_argument("--hash-workers", type=int, default=1,
+                        help="Threads hashing large files (fixed chunking only)")
+    parser.add_argument("--wire-compress", action="store_true",
+                        help="Compress the messages sent to the servers")
+    parser.add_argument("--block-index", type=str, default=".surfstore_index.json",
+                        help="File remembering which blocks are on local disk, empty to disable")
+    parser.add_argument("--follower-reads", action="store_true",
+                        help="Read file info from any metadata server that has our writes")
+    parser.add_argument("--sync-workers", type=int, default=sync_workers,
+                        help="Files uploaded or downloaded at once by sync")
     return parser.parse_args()
 
 
 def get_metadata_stub(config):
-    # client read config to know who is leader and connect to it
-    leaderID = config.num_leaders
-    channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[leaderID])
-    stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
-    return stub
+    # client read config to know who is leader and connect to it, reads
+    # may also go to the followers
+    return MetadataRouter(config, open_channel, follower_reads)
 
 
 def get_block_stub(config):
-    channel = grpc.insecure_channel('localhost:%d' % config.block_port)
-    stub = SurfStoreBasic_pb2_grpc.BlockStoreStub(channel)
-    return stub
+    # blocks are spread over every block server in the config
+    return BlockRouter(config, open_channel)
 
 def run(config):
     metadata_stub = get_metadata_stub(config)
@@ -390,5 +822,20 @@ def run(config):
 if __name__ == "__main__":
     args = parse_args()
     config = SurfStoreConfigReader(args.config_file)
+    eager_upload = args.eager_upload
+    hash_workers = args.hash_workers
+    wire_compression = args.wire_compress
+    follower_reads = args.follower_reads
+    sync_workers = args.sync_workers
+    if args.block_index:
+        block_index = LocalBlockIndex(args.block_index)
+    if args.chunking == "cdc" and args.cdc_sizes:
+        chunking = cdc_spec(*[int(x) for x in args.cdc_sizes.split(":")])
+    elif args.chunking == "cdc":
+        chunking = cdc_spec(*default_cdc_sizes(config.get_block_size()))
+    else:
+        chunking = "fixed:%d" % config.get_block_size()
+    if max_chunk_size(chunking) > config.get_block_size():
+        raise RuntimeError("chunks can't be larger than the blocksize of %d" % config.get_block_size())
 
     run(config)
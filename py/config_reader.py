@@ -1,6 +1,11 @@
 import re
 import sys
 
+# Largest block a deployment may configure. gRPC refuses messages over 4 MiB
+# by default, and a Block message also carries its hash and field tags.
+MAX_BLOCK_SIZE = 4 * 1024 * 1024 - 1024
+DEFAULT_BLOCK_SIZE = 4096
+
 '''A simple class to read SurfStore configuration files.
 
 You shouldn't need to edit this file. If there's a bug, please contact a TA!'''
@@ -8,17 +13,30 @@ class SurfStoreConfigReader(object):
     num_metadata_match_str="M(:|=)\s*(?P<num_metadata>\d+)"
     num_leader_match_str="L(:|=)\s*(?P<num_leader>\d+)"
     metadata_inst_match_str="metadata(?P<metadata_id>\d+)(:|=)\s*(?P<metadata_port>\d+)"
-    block_inst_match_str="block(:|=)\s*(?P<block_port>\d+)"
-    config_matcher=re.compile("((%s)|(%s)|(%s)|(%s))\s*" % (
+    block_inst_match_str="block(?P<block_id>\d*)(:|=)\s*(?P<block_port>\d+)"
+    block_size_match_str="blocksize(:|=)\s*(?P<block_size>\d+)"
+    replication_match_str="replication(:|=)\s*(?P<replication>\d+)"
+    write_quorum_match_str="writequorum(:|=)\s*(?P<write_quorum>\d+)"
+    config_matcher=re.compile("((%s)|(%s)|(%s)|(%s)|(%s)|(%s)|(%s))\s*" % (
         num_metadata_match_str,
         num_leader_match_str,
         metadata_inst_match_str,
-        block_inst_match_str
+        block_inst_match_str,
+        block_size_match_str,
+        replication_match_str,
+        write_quorum_match_str
     ))
 
     def __init__(self, config_file):
         self.config_file = config_file
         self.metadata_ports = {}
+        # "block:" is the same as "block1:"
+        self.block_ports = {}
+        self.block_size = DEFAULT_BLOCK_SIZE
+        # copies kept of every block, and how many must be stored before a
+        # write counts as done (a majority unless set)
+        self.replication = 1
+        self.write_quorum = None
 
         with open(config_file, "r") as f:
             for line in f:
@@ -30,24 +48,52 @@ class SurfStoreConfigReader(object):
                 elif result["metadata_id"] is not None:
                     self.metadata_ports[int(result["metadata_id"])] = int(result["metadata_port"])
                 elif result["block_port"] is not None:
-                    self.block_port = int(result["block_port"])
+                    self.block_ports[int(result["block_id"] or 1)] = int(result["block_port"])
+                elif result["block_size"] is not None:
+                    self.block_size = int(result["block_size"])
+                elif result["replication"] is not None:
+                    self.replication = int(result["replication"])
+                elif result["write_quorum"] is not None:
+                    self.write_quorum = int(result["write_quorum"])
                 else:
                     print >> sys.stderr, "%s: Invalid line:\n%s" % (self.__class__.__name__, line)
 
         if not hasattr(self, "num_metadata_servers") \
-        or not hasattr(self, "block_port") \
+        or not self.block_ports \
         or not self.metadata_ports:
             raise Exception("Config file is missing one or more required lines!")
 
+        self.num_block_servers = len(self.block_ports)
+        for i in range(1, self.num_block_servers + 1):
+            if i not in self.block_ports:
+                raise Exception("Must set port for block%d" % i)
+        self.block_port = self.block_ports[1]
+
         for i in range(1, self.num_metadata_servers + 1):
             if not self.metadata_ports[i]:
                 raise Exception("Must set port for metadata%d" % i)
 
+        if not 0 < self.block_size <= MAX_BLOCK_SIZE:
+            raise Exception("blocksize must be between 1 and %d" % MAX_BLOCK_SIZE)
+
+        if not 0 < self.replication <= self.num_block_servers:
+            raise Exception("replication must be between 1 and the number of block servers")
+        if self.write_quorum is None:
+            self.write_quorum = self.replication // 2 + 1
+        if not 0 < self.write_quorum <= self.replication:
+            raise Exception("writequorum must be between 1 and replication")
+
     def get_num_metadata_servers(self):
         return self.num_metadata_servers
 
     def get_metadata_port(self, server_id):
         return self.metadata_ports[server_id]
 
-    def get_block_port(self):
-        return self.block_port
\ No newline at end of file
+    def get_block_port(self, server_id=1):
+        return self.block_ports[server_id]
+
+    def get_num_block_servers(self):
+        return self.num_block_servers
+
+    def get_block_size(self):
+        return self.block_size
\ No newline at end of file
@@ -0,0 +1,114 @@
+##############################################################################
+# group_commit.py
+#
+# Group commit for the leader MetadataStore. Writes that arrive at about the
+# same time are handed to 2PC together, so a burst of small writes pays for
+# one Vote/Commit round instead of one round per write.
+##############################################################################
+import asyncio
+import collections
+import threading
+import time
+
+_LATENCY_SAMPLES = 1024
+
+
+class GroupCommit(object):
+    '''
+    submit(entry) queues an entry, blocks until it is committed and returns
+    what commit said about it. A background thread takes up to max_batch
+    entries, waiting at most window seconds after the first one arrived,
+    and commits them with one call to commit(entries), in the order they
+    were submitted; commit returns a list with a result per entry. Entries
+    that come in while a batch is being committed go into the next one.
+
+    submit_async(entry) is the same for asyncio code: it returns a future on
+    the running event loop, so nothing blocks while the batch commits.
+    '''
+    def __init__(self, commit, window, max_batch):
+        self.commit = commit
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+
+        self.batches = 0
+        self.entries = 0
+        self.largest = 0
+        # seconds from submit until the entry was committed
+        self.latencies = collections.deque(maxlen=_LATENCY_SAMPLES)
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, entry):
+        done = threading.Event()
+        waiter = self.enqueue(entry, lambda waiter: done.set())
+        done.wait()
+        if waiter["error"] is not None:
+            raise waiter["error"]
+        return waiter["result"]
+
+    def submit_async(self, entry):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        def resolve(waiter):
+            if future.cancelled():
+                return
+            if waiter["error"] is not None:
+                future.set_exception(waiter["error"])
+            else:
+                future.set_result(waiter["result"])
+        self.enqueue(entry, lambda waiter: loop.call_soon_threadsafe(resolve, waiter))
+        return future
+
+    def enqueue(self, entry, done):
+        ''' Queue entry, done(waiter) is called from the commit thread '''
+        waiter = {"entry": entry, "queued": time.time(), "error": None,
+                  "result": None, "done": done}
+        with self.cond:
+            self.queue.append(waiter)
+            self.cond.notify_all()
+        return waiter
+
+    def next_batch(self):
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            deadline = self.queue[0]["queued"] + self.window
+            while len(self.queue) < self.max_batch and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            return [self.queue.popleft() for _ in range(min(len(self.queue), self.max_batch))]
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            error = None
+            results = [None] * len(batch)
+            try:
+                results = self.commit([waiter["entry"] for waiter in batch])
+            except Exception as e:
+                error = e
+
+            now = time.time()
+            with self.cond:
+                self.batches += 1
+                self.entries += len(batch)
+                self.largest = max(self.largest, len(batch))
+                self.latencies.extend(now - waiter["queued"] for waiter in batch)
+            for waiter, result in zip(batch, results):
+                waiter["error"] = error
+                waiter["result"] = result
+                waiter["done"](waiter)
+
+    def stats(self):
+        with self.cond:
+            if not self.batches:
+                return "group commit: no writes"
+            ordered = sorted(self.latencies)
+            return "group commit: %d writes in %d batches, mean batch %.1f, largest %d, " \
+                "p50 %.2f ms, p99 %.2f ms" % (
+                    self.entries, self.batches, 1. * self.entries / self.batches, self.largest,
+                    1000. * ordered[int(0.5 * (len(ordered) - 1))],
+                    1000. * ordered[int(0.99 * (len(ordered) - 1))])
@@ -0,0 +1,52 @@
+##############################################################################
+# hash_ring.py
+#
+# Consistent hashing of block hashes onto BlockStore servers. Each server
+# owns vnodes points on a 64-bit ring, and a block belongs to the server
+# owning the first point at or after the block's own position. Adding a
+# server only moves the blocks that fall just before its new points.
+##############################################################################
+import bisect
+import hashlib
+import struct
+
+_VNODES = 64
+
+
+def ring_position(key):
+    return struct.unpack(">Q", hashlib.md5(key.encode()).digest()[:8])[0]
+
+
+class HashRing(object):
+    def __init__(self, nodes, vnodes=_VNODES):
+        self.nodes = sorted(nodes)
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((ring_position("block%d#%d" % (node, i)), node))
+        points.sort()
+        self.positions = [p[0] for p in points]
+        self.owners = [p[1] for p in points]
+
+    def lookup(self, b_hash):
+        return self.lookup_n(b_hash, 1)[0]
+
+    def lookup_n(self, b_hash, count):
+        ''' The first count distinct servers clockwise from the block '''
+        i = bisect.bisect_left(self.positions, ring_position(b_hash))
+        return self.walk(i, count)
+
+    def replica_sets(self, count):
+        ''' Every distinct answer lookup_n(..., count) can give '''
+        return set(tuple(self.walk(i, count)) for i in range(len(self.owners)))
+
+    def walk(self, i, count):
+        ''' The first count distinct servers from point i on '''
+        count = min(count, len(self.nodes))
+        found = []
+        while len(found) < count:
+            node = self.owners[i % len(self.owners)]
+            if node not in found:
+                found.append(node)
+            i += 1
+        return found
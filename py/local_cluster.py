@@ -0,0 +1,133 @@
+##############################################################################
+# local_cluster.py
+#
+# A whole SurfStore deployment inside one process, for the tests: a config
+# file on free ports, every block and metadata server on its own gRPC
+# server, and the client side stubs for them.
+##############################################################################
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from concurrent import futures
+
+import grpc
+
+import SurfStoreBasic_pb2_grpc
+from block_backend import MemoryBackend
+from block_router import BlockRouter
+from block_store import AsyncBlockStore, BlockStore
+from config_reader import SurfStoreConfigReader
+from metadata_router import MetadataRouter
+from metadata_store import AsyncMetadataStore, MetadataStore
+
+
+def free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for s in sockets:
+            s.bind(("127.0.0.1", 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+def open_channel(port):
+    return grpc.insecure_channel("localhost:%d" % port)
+
+
+class LocalCluster(object):
+    '''
+    metadata servers, the first one the leader, and blocks block servers
+    keeping replication copies of every block. setup(store) is called on
+    every MetadataStore before it starts serving. With aio the servers are
+    the grpc.aio ones of --aio, all on one event loop in its own thread.
+    Use it as a context manager, or call stop().
+    '''
+    def __init__(self, metadata=1, blocks=1, block_size=4096, replication=1,
+                 backend=MemoryBackend, setup=None, aio=False):
+        self.directory = tempfile.mkdtemp()
+        self.loop = None
+        if aio:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        ports = free_ports(metadata + blocks)
+        lines = ["M: %d" % metadata, "L: 1", "blocksize: %d" % block_size,
+                 "replication: %d" % replication]
+        lines += ["metadata%d: %d" % (i + 1, ports[i]) for i in range(metadata)]
+        lines += ["block%d: %d" % (i + 1, ports[metadata + i]) for i in range(blocks)]
+        self.config_file = os.path.join(self.directory, "config.txt")
+        with open(self.config_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        self.config = SurfStoreConfigReader(self.config_file)
+
+        self.servers = []
+        self.block_stores = {}
+        for server_id, port in sorted(self.config.block_ports.items()):
+            store = BlockStore(self.config, backend())
+            servicer = AsyncBlockStore(store, 4) if aio else store
+            self.serve(port, SurfStoreBasic_pb2_grpc.add_BlockStoreServicer_to_server, servicer)
+            self.block_stores[server_id] = store
+
+        self.metadata_stores = {}
+        for server_id, port in sorted(self.config.metadata_ports.items()):
+            store = MetadataStore(self.config)
+            store.myID = server_id
+            store.leader = server_id == self.config.num_leaders
+            if setup is not None:
+                setup(store)
+            servicer = AsyncMetadataStore(store, 16) if aio else store
+            self.serve(port, SurfStoreBasic_pb2_grpc.add_MetadataStoreServicer_to_server, servicer)
+            self.metadata_stores[server_id] = store
+        # every server is up before the leader connects to the followers
+        for store in self.metadata_stores.values():
+            store.init_distributed_server()
+
+    def serve(self, port, add_servicer, servicer):
+        if self.loop is not None:
+            self.servers.append(self.run(self.serve_aio(port, add_servicer, servicer)))
+            return
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+        add_servicer(servicer, server)
+        server.add_insecure_port("127.0.0.1:%d" % port)
+        server.start()
+        self.servers.append(server)
+
+    async def serve_aio(self, port, add_servicer, servicer):
+        server = grpc.aio.server()
+        add_servicer(servicer, server)
+        server.add_insecure_port("127.0.0.1:%d" % port)
+        await server.start()
+        return server
+
+    def run(self, coroutine):
+        ''' Run a coroutine on the servers' event loop and wait for it '''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @property
+    def leader(self):
+        return self.metadata_stores[self.config.num_leaders]
+
+    def metadata_router(self, follower_reads=False):
+        return MetadataRouter(self.config, open_channel, follower_reads)
+
+    def block_router(self):
+        return BlockRouter(self.config, open_channel)
+
+    def stop(self):
+        for server in self.servers:
+            if self.loop is not None:
+                self.run(server.stop(0))
+            else:
+                server.stop(0)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,110 @@
+##############################################################################
+# local_index.py
+#
+# Client side index of the blocks already on local disk. It remembers, for
+# every file the client uploaded or downloaded, where each of its blocks
+# lives, so a read only has to fetch the blocks it doesn't have yet.
+##############################################################################
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# local files kept open for reading blocks, all are closed past this many
+_MAX_OPEN_FILES = 64
+
+
+class LocalBlockIndex(object):
+    '''
+    Maps block hash --> (path, offset, length) in every indexed file that
+    has the block, so replacing one of them leaves the others usable. The
+    index is saved as JSON,
+    keyed by path, so replacing everything known about one file is cheap.
+    Local files may change behind our back, so a block is hashed again
+    before it is used and ignored if it no longer matches.
+
+    All methods can be called from several threads at once.
+    '''
+    def __init__(self, index_file):
+        self.index_file = index_file
+        self.lock = threading.Lock()
+        # key --> absolute path, value --> list of (hash, offset, length)
+        self.files = {}
+        # key --> hash, value --> list of (path, offset, length), one per
+        # file holding the block
+        self.blocks = {}
+        self.open_files = {}
+
+        try:
+            with open(index_file, "r") as f:
+                saved = json.load(f)
+        except (IOError, ValueError):
+            saved = {}
+        for path, entries in saved.items():
+            self.set_file(path, [tuple(entry) for entry in entries])
+
+    def set_file(self, path, hash_offset_tups):
+        ''' Record the blocks of a file, replacing what we knew about it '''
+        path = os.path.abspath(path)
+        with self.lock:
+            for b_hash, offset, length in self.files.pop(path, []):
+                locations = self.blocks.get(b_hash)
+                if locations is None:
+                    continue
+                # the other files with the block still have it
+                locations[:] = [l for l in locations if l[0] != path]
+                if not locations:
+                    del self.blocks[b_hash]
+            self.files[path] = list(hash_offset_tups)
+            for b_hash, offset, length in self.files[path]:
+                locations = self.blocks.setdefault(b_hash, [])
+                if not locations or locations[-1][0] != path:
+                    locations.append((path, offset, length))
+
+    def has_block(self, b_hash):
+        return b_hash in self.blocks
+
+    def read_block(self, b_hash):
+        ''' Return the block data from the first file that still has it on
+        local disk, or None if none does '''
+        with self.lock:
+            locations = list(self.blocks.get(b_hash, ()))
+        for path, offset, length in locations:
+            data = self.read_at(path, offset, length)
+            if data is not None and len(data) == length and \
+            base64.b64encode(hashlib.sha256(data).digest()).decode() == b_hash:
+                return data
+        return None
+
+    def read_at(self, path, offset, length):
+        with self.lock:
+            try:
+                f = self.open_files.get(path)
+                if f is None:
+                    if len(self.open_files) >= _MAX_OPEN_FILES:
+                        self.close_all()
+                    f = self.open_files[path] = open(path, "rb")
+                f.seek(offset)
+                return f.read(length)
+            except IOError:
+                return None
+
+    def close_files(self):
+        with self.lock:
+            self.close_all()
+
+    def close_all(self):
+        for f in self.open_files.values():
+            f.close()
+        self.open_files = {}
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.index_file))
+        out = tempfile.NamedTemporaryFile(mode="w", dir=directory,
+                                          prefix=".surfstore-", delete=False)
+        with out:
+            with self.lock:
+                json.dump(self.files, out)
+        os.rename(out.name, self.index_file)
@@ -0,0 +1,111 @@
+##############################################################################
+# metadata_router.py
+#
+# Client side stub for all the MetadataStore servers in the config. Writes
+# and every other call go to the leader; with follower reads, ReadFile is
+# spread over the replicas, and the log index tokens the servers hand out
+# keep a client from reading anything older than what it has seen.
+##############################################################################
+import threading
+import time
+
+import grpc
+
+import SurfStoreBasic_pb2_grpc
+
+# deadline of a ReadFile sent to a follower, and how long a follower that
+# failed or was crashed is left out before it is tried again
+_READ_TIMEOUT  = 1.0
+_DOWN_SECONDS  = 5.0
+
+
+class MetadataRouter(object):
+    '''
+    token is the highest log index in any WriteResult or ReadFile answer
+    seen so far. Every ReadFile asks for at least that index; a follower
+    that hasn't applied it after a short wait answers with its own, lower
+    index and the read is sent to the leader instead. That gives
+    read-your-writes and monotonic reads while followers take most of the
+    read load.
+    '''
+    def __init__(self, config, open_channel, follower_reads=False):
+        self.follower_reads = follower_reads
+        self.stubs = {}
+        for server_id, port in config.metadata_ports.items():
+            self.stubs[server_id] = SurfStoreBasic_pb2_grpc.MetadataStoreStub(open_channel(port))
+        self.leader_id = config.num_leaders
+        self.leader = self.stubs[self.leader_id]
+        self.readers = sorted(self.stubs)
+
+        self.lock = threading.Lock()
+        self.token = 0
+        self.next_reader = 0
+        # key --> server id, value --> time it may be tried again
+        self.down_until = {}
+
+    def observe(self, log_index):
+        with self.lock:
+            self.token = max(self.token, log_index)
+
+    def pick_reader(self):
+        ''' The next replica round robin that isn't left out, or the leader '''
+        now = time.time()
+        with self.lock:
+            for _ in range(len(self.readers)):
+                server_id = self.readers[self.next_reader % len(self.readers)]
+                self.next_reader += 1
+                if self.down_until.get(server_id, 0) <= now:
+                    return server_id
+        return self.leader_id
+
+    def mark_down(self, server_id):
+        with self.lock:
+            self.down_until[server_id] = time.time() + _DOWN_SECONDS
+
+    # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
+    # The same calls as a MetadataStoreStub
+
+    def ReadFile(self, file_info):
+        return self.read("ReadFile", file_info)
+
+    def ReadFiles(self, file_list):
+        return self.read("ReadFiles", file_list)
+
+    def read(self, method, request):
+        ''' Send a ReadFile or ReadFiles to a replica that has every write
+        we've seen, or else to the leader '''
+        with self.lock:
+            token = self.token
+        request.log_index = token
+
+        if self.follower_reads:
+            server_id = self.pick_reader()
+            if server_id != self.leader_id:
+                try:
+                    result = getattr(self.stubs[server_id], method)(request, timeout=_READ_TIMEOUT)
+                    if result.log_index >= token:
+                        self.observe(result.log_index)
+                        return result
+                    if result.log_index < 0:
+                        # crashed, it doesn't get any commits
+                        self.mark_down(server_id)
+                except grpc.RpcError:
+                    self.mark_down(server_id)
+
+        result = getattr(self.leader, method)(request)
+        self.observe(result.log_index)
+        return result
+
+    def ModifyFile(self, file_info):
+        result = self.leader.ModifyFile(file_info)
+        self.observe(result.log_index)
+        return result
+
+    def DeleteFile(self, file_info):
+        result = self.leader.DeleteFile(file_info)
+        self.observe(result.log_index)
+        return result
+
+    def __getattr__(self, name):
+        # Ping, IsLeader and the rest only make sense on the leader
+        return getattr(self.leader, name)
@@ -4,6 +4,10 @@
 # metadata_store.py
 ##############################################################################
 import argparse
+import asyncio
+import collections
+import os
+import threading
 import time
 from concurrent import futures
 import grpc
@@ -12,20 +16,65 @@ import SurfStoreBasic_pb2
 import SurfStoreBasic_pb2_grpc
 
 from config_reader import SurfStoreConfigReader
+from block_gc import _GC_GRACE, BlockCollector
+from block_router import BlockRouter
+from group_commit import GroupCommit
+from metadata_table import FileTable
+from metadata_wal import DURABILITY, MetadataWal
 
 _ONE_DAY_IN_SECONDS = 60 * 60 * 24
-_IS_DELETED = 2
-_VERS       = 0
-_BL         = 1
+
+# 2PC deadlines, and the backoff between rounds that didn't get a majority
+_VOTE_TIMEOUT      = 0.5
+_COMMIT_TIMEOUT    = 1.0
+_RETRY_BACKOFF_MIN = 0.05
+_RETRY_BACKOFF_MAX = 1.0
+
+# group commit: how long the leader waits for more writes to join a batch,
+# and the most writes replicated in one 2PC round
+_COMMIT_WINDOW = 0.001
+_COMMIT_BATCH  = 256
+
+# compact the log into a snapshot once it has this many entries
+_SNAPSHOT_ENTRIES = 10000
+# files per InstallSnapshot message
+_SNAPSHOT_CHUNK   = 1024
+
+# writes check and reserve their version under one of this many locks,
+# picked by filename
+_FILE_LOCK_STRIPES = 64
+
+# files per FileList message of ListFiles
+_LIST_CHUNK = 1000
+
+# how long a follower holds a ReadFile that asks for a log index it hasn't
+# applied yet, after that the client goes to the leader
+_READ_WAIT = 0.05
+
+# Catch-up: the leader sends a Heartbeat to every follower this often, and
+# catches up the ones that are behind, _CATCH_UP_CHUNK entries per Update
+# message. _CATCH_UP_TIMEOUT is the deadline of a whole Update or
+# InstallSnapshot stream.
+_HEARTBEAT_INTERVAL = 0.2
+_CATCH_UP_CHUNK     = 512
+_CATCH_UP_TIMEOUT   = 60.0
+
+# reserve() got the version, the entry still has to go through group commit
+_PENDING = object()
 
 class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
     def __init__(self, config):
         super(MetadataStore, self).__init__()
 
-        # key --> file names, value --> (version, current blocklist, isDeleted)
-        self.files   = {}
+        # key --> file names, value --> FileRecord of the current version
+        self.files   = FileTable()
         self.config  = config
         self.bstub   = None
+        # BlockCollector of the leader with --gc, it deletes the blocks no
+        # file references any more
+        self.collector = None
+        # gzip messages to the blockstore and the other metadata servers
+        self.wire_compression = False
 
         # 2PC
         self.distributed = (config.num_metadata_servers > 1)
@@ -36,22 +85,76 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
         self.mstub_list = []
         # store crashed followers by index in mstub_list
         self.crashed_followers = []
-
-        # (cmd, filename, vers, blocklist)
+        # per follower, the last log index a Commit was queued for, and the
+        # Commits it hasn't answered yet, the first one in flight
+        self.commit_sent = []
+        self.commit_queues = []
+        self.crashed_lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        # wakes the leader's catch-up thread before the next heartbeat is due
+        self.catch_up_cond = threading.Condition()
+        self.catch_up_pool = None
+        # followers being caught up right now, by index in mstub_list
+        self.catching_up = set()
+
+        # the FileRecord each entry wrote, shared with files; files.log()
+        # turns one back into (cmd, filename, vers, blocklist, chunking)
         self.logs = []
+        # the entries up to snapshot_index were compacted into
+        # snapshot_files, the file map as of that entry; logs[0] is entry
+        # snapshot_index + 1
+        self.snapshot_index = 0
+        self.snapshot_files = FileTable(self.files.block_ids)
+        self.snapshot_entries = _SNAPSHOT_ENTRIES
+        # held while snapshot_files is changed or read, taken before
+        # log_lock; snapshot_index changes under both
+        self.snapshot_lock = threading.Lock()
+        # on-disk log and snapshot, None keeps everything in memory only
+        self.wal = None
+
+        # Writes to one file are serialized by the file's stripe lock,
+        # held while the version is checked and until the write is applied
+        # or reserved in pending. log_lock is only held to append to logs
+        # (and the WAL) and apply entries in log order. Always take a stripe
+        # lock before log_lock, and at most one stripe lock at a time.
+        self.file_locks = [threading.Lock() for _ in range(_FILE_LOCK_STRIPES)]
+        self.log_lock = threading.Lock()
+        # notified whenever a log entry is applied
+        self.applied = threading.Condition(self.log_lock)
+        # key --> file names, value --> (version, isDeleted) of the last
+        # write to the file that is still being committed
+        self.pending = {}
+        self.commit_window = _COMMIT_WINDOW
+        self.commit_batch = _COMMIT_BATCH
+        self.group_commit = None
 
 # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
 
     def init_distributed_server(self):
         if self.distributed == True:
-            self.mstub_list = self.get_metadata_stub_list(config)
+            self.mstub_list = self.get_metadata_stub_list(self.config)
             self.ServerPing()
+            if self.leader:
+                self.commit_sent = [self.last_index()] * len(self.mstub_list)
+                self.commit_queues = [collections.deque() for _ in self.mstub_list]
+                self.group_commit = GroupCommit(self.two_phase_commit,
+                                                self.commit_window, self.commit_batch)
+                self.catch_up_pool = futures.ThreadPoolExecutor(max_workers=len(self.mstub_list))
+                thread = threading.Thread(target=self.catch_up_loop)
+                thread.daemon = True
+                thread.start()
+
+
+    def open_channel(self, port):
+        if self.wire_compression:
+            return grpc.insecure_channel('localhost:%d' % port, compression=grpc.Compression.Gzip)
+        return grpc.insecure_channel('localhost:%d' % port)
 
 
     def get_metadata_stub_list(self, config):
         stub_list = []
         if not self.leader:
-            channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[config.num_leaders])
+            channel = self.open_channel(config.metadata_ports[config.num_leaders])
             stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
             stub_list.append((config.num_leaders, stub))
             return stub_list
@@ -61,7 +164,7 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
             if i == self.myID:
                 continue
 
-            channel = grpc.insecure_channel('localhost:%d' % config.metadata_ports[i])
+            channel = self.open_channel(config.metadata_ports[i])
             stub = SurfStoreBasic_pb2_grpc.MetadataStoreStub(channel)
             stub_list.append((i, stub))
 
@@ -69,10 +172,9 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
 
 
     def get_block_stub(self):
-        ''' Copied from the client, needed to interact with the blockstore '''
-        channel = grpc.insecure_channel('localhost:%d' % self.config.block_port)
-        stub = SurfStoreBasic_pb2_grpc.BlockStoreStub(channel)
-        return stub
+        ''' Copied from the client, needed to interact with the blockstore.
+        Routes every block hash to the block server that owns it. '''
+        return BlockRouter(self.config, self.open_channel)
 
 
     def check_blockstore_connection(self):
@@ -90,68 +192,410 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
 
 
     def get_missing_blocks(self, file_info):
-        missing_blocks = []
+        # batched HasBlocks calls, sent to all block servers at once
+        return self.bstub.missing_blocks(list(file_info.blocklist))
+
+
+    def pin_blocks(self, file_info):
+        ''' Keep the collector from deleting the file's blocks until
+        unpin_blocks(), return the ones it is deleting right now '''
+        if self.collector is None:
+            return ()
+        return self.collector.pin(file_info.blocklist)
+
+
+    def unpin_blocks(self, file_info):
+        if self.collector is not None:
+            self.collector.unpin(file_info.blocklist)
+
+
+    def start_collector(self, grace):
+        ''' Start deleting the blocks no file references, called on the
+        leader once the WAL is loaded '''
+        def blockstore():
+            if not self.check_blockstore_connection():
+                raise RuntimeError("blockstore is down")
+            return self.bstub
+        self.collector = BlockCollector(self.files.block_ids.decode, blockstore, grace)
+        with self.log_lock:
+            self.collector.start(self.files)
+
+
+    def latest(self, filename):
+        ''' (version, isDeleted) of the file, counting the writes that are
+        still being committed, or None if the file was never written '''
+        if filename in self.pending:
+            return self.pending[filename]
+        record = self.files.get(filename)
+        if record is not None:
+            return record.version, record.deleted
+        return None
+
+
+    def write(self, log):
+        '''
+        Commit a "mod" or "del" log entry and apply it, returning its log
+        index. The version is checked again under the file's lock, so of
+        two writers racing for the same version only one gets it; returns
+        None for the other one. Writes to other files don't wait for it.
+        With followers the entry goes through group commit.
+        '''
+        index = self.reserve(log)
+        if index is _PENDING:
+            return self.group_commit.submit(log)
+        return index
+
+
+    def reserve(self, log):
+        ''' The first half of write(): check the version and apply the entry
+        right away without followers, or return _PENDING once it is
+        reserved for group commit '''
+        with self.file_lock(log[1]):
+            state = self.latest(log[1])
+            version = state[0] if state is not None else 0
+            if log[2] != version + 1:
+                return None
+            if log[0] == "del" and (state is None or state[1]):
+                return None
+            if self.group_commit is None:
+                with self.log_lock:
+                    self.apply_log(log)
+                    index = self.last_index()
+            else:
+                self.pending[log[1]] = (log[2], log[0] == "del")
+        if self.group_commit is None:
+            self.sync_wal()
+            return index
+        return _PENDING
+
+
+    def write_result(self, result, log, index):
+        ''' Fill in the WriteResult for a log entry write() answered index for '''
+        if index is not None:
+            result.result = 0 # OK
+            result.current_version = log[2]
+            result.log_index = index
+        else:
+            # another client got this version in while we checked the blocks
+            result.result = 1 # OLD_VERSION
+            state = self.latest(log[1])
+            if state is not None:
+                result.current_version = state[0]
+        return result
+
+
+    def file_lock(self, filename):
+        return self.file_locks[hash(filename) % len(self.file_locks)]
+
+
+    def apply_log(self, log):
+        ''' Execute a committed log entry, callers hold log_lock '''
+        old = self.files.get(log[1])
+        record = self.files.apply(log)
+        self.logs.append(record)
+        if self.collector is not None:
+            self.collector.replace(old, record)
+        if self.wal is not None:
+            self.wal.append(self.last_index(), log)
+        self.applied.notify_all()
+
+
+    def sync_wal(self):
+        ''' Wait until the applied log entries are on disk, called after
+        log_lock is released so other writes can share the fsync '''
+        if self.wal is not None:
+            self.wal.sync()
+
+
+    def open_wal(self, data_dir, durability):
+        ''' Load the snapshot and log entries saved in data_dir, then log
+        every entry applied from now on there '''
+        wal = MetadataWal(data_dir, durability)
+        index, files, entries = wal.recover()
+        self.files = files
+        self.snapshot_index = index
+        self.snapshot_files = files.copy()
+        with self.log_lock:
+            for log in entries:
+                self.apply_log(log)
+        self.wal = wal
+        print("INFO: Loaded %d files and %d log entries from %s" % (len(files), len(entries), data_dir))
+
+
+    def last_index(self):
+        return self.snapshot_index + len(self.logs)
+
+
+    def compact_log(self):
+        '''
+        Fold the log entries into snapshot_files and drop them, once there
+        are snapshot_entries of them. Only the records of the entries are
+        put in, the snapshot is never copied, so the work is the same for
+        any number of files, and writes only wait while the entries are
+        sliced off the log. The records are never changed in place, so
+        they are shared with files.
+        '''
+        if len(self.logs) < self.snapshot_entries:
+            return
+        with self.snapshot_lock:
+            with self.log_lock:
+                index = self.last_index()
+                compacted = self.logs[:]
+                if self.wal is not None:
+                    self.wal.rotate(index)
+
+            for record in compacted:
+                self.snapshot_files.keep(record)
+            with self.log_lock:
+                self.snapshot_index = index
+                del self.logs[:len(compacted)]
+
+            if self.wal is not None:
+                self.wal.save_snapshot(index, self.snapshot_files)
+
+
+    def snapshot_chunks(self):
+        ''' The snapshot and the log after it, as InstallSnapshot messages '''
+        with self.snapshot_lock:
+            files = self.snapshot_files.copy()
+            with self.log_lock:
+                index, tail = self.snapshot_index, list(self.logs)
+
+        chunk = SurfStoreBasic_pb2.SnapshotChunk(index=index)
+        for filename, record in files.items():
+            chunk.files.extend([SurfStoreBasic_pb2.FileInfo(filename=filename, version=record.version, \
+                blocklist=files.blocklist(record), chunking=record.chunking)])
+            if len(chunk.files) == _SNAPSHOT_CHUNK:
+                yield chunk
+                chunk = SurfStoreBasic_pb2.SnapshotChunk(index=index)
+        for i, record in enumerate(tail):
+            chunk.logs.extend([self.rpc_log(files.log(record), index + 1 + i)])
+        yield chunk
+
+
+    def rpc_log(self, log, index=0):
+        return SurfStoreBasic_pb2.Log(cmd = log[0], filename = log[1], version = log[2], \
+            blocklist = log[3], chunking = log[4], index = index)
+
+
+    def two_phase_commit(self, logs):
+        ''' Replicate a batch of log entries to the followers in one 2PC
+        round, then apply them on the leader. Returns their log indexes. '''
+        backoff = _RETRY_BACKOFF_MIN
+        # one replication round at a time, so log indexes go out in order
+        with self.commit_lock:
+            first = self.last_index() + 1
+            rpc_logs = SurfStoreBasic_pb2.Logs()
+            for i, log in enumerate(logs):
+                rpc_logs.allLogs.extend([self.rpc_log(log, first + i)])
+            # piazza says if we don't get majority vote, we just hang on there,
+            # so keep retrying, with a bounded backoff between the rounds
+            while not self.replicate(rpc_logs):
+                time.sleep(backoff)
+                backoff = min(2 * backoff, _RETRY_BACKOFF_MAX)
+
+            # leader log locally, the file's lock makes the move from pending
+            # to files look atomic to writers of the same file
+            for log in logs:
+                with self.file_lock(log[1]):
+                    with self.log_lock:
+                        self.apply_log(log)
+                    if self.pending.get(log[1], (None,))[0] == log[2]:
+                        del self.pending[log[1]]
+            self.sync_wal()
+        return list(range(first, first + len(logs)))
+
+
+    def replicate(self, rpc_logs):
+        '''
+        One round of 2PC. Vote goes to every follower at once and the
+        commit is decided as soon as a majority voted yes; Commit is then sent
+        to the yes voters, including the ones whose vote comes in later.
+        Only followers that are live and have been sent every earlier round
+        count, the others are left to catch_up. Returns False if no majority
+        voted yes within _VOTE_TIMEOUT.
+        '''
+        needed = (len(self.mstub_list) + 1) // 2
+        first = rpc_logs.allLogs[0].index
+        cond = threading.Condition()
+        state = {"yes": [], "answered": 0, "decided": False}
+
+        def on_vote(i):
+            def done(future):
+                answer = future.exception() is None and future.result().answer
+                with self.crashed_lock:
+                    yes = answer and self.in_step(i, first)
+                with cond:
+                    state["answered"] += 1
+                    if yes:
+                        state["yes"].append(i)
+                    cond.notify_all()
+                    send_now = yes and state["decided"]
+                if not answer:
+                    self.mark_crashed(i)
+                if send_now:
+                    self.send_commit(i, rpc_logs)
+            return done
 
-        for b_hash in file_info.blocklist:
-            bl = SurfStoreBasic_pb2.Block(hash=b_hash)
+        # 1st phase of 2PC
+        for i in range(len(self.mstub_list)):
+            vote = self.mstub_list[i][1].Vote.future(SurfStoreBasic_pb2.Empty(), timeout=_VOTE_TIMEOUT)
+            vote.add_done_callback(on_vote(i))
+
+        with cond:
+            deadline = time.time() + _VOTE_TIMEOUT
+            while len(state["yes"]) < needed and state["answered"] < len(self.mstub_list) \
+            and time.time() < deadline:
+                cond.wait(deadline - time.time())
+            if len(state["yes"]) < needed:
+                return False
+            state["decided"] = True
+            voters = list(state["yes"])
 
-            if self.bstub.HasBlock(bl).answer == False:
-                missing_blocks.append(b_hash)
+        # 2nd phase of 2PC
+        for i in voters:
+            self.send_commit(i, rpc_logs)
+        return True
 
-        return missing_blocks
 
+    def in_step(self, i, first):
+        ''' Whether follower i is live and was sent every entry before
+        first, called holding crashed_lock '''
+        return i not in self.crashed_followers and self.commit_sent[i] == first - 1
+
+
+    def send_commit(self, i, rpc_logs):
+        ''' Queue the Commit of a round for follower i. It is sent once the
+        follower answered the Commits of the rounds before, so they can't
+        overtake each other. A follower that missed a round isn't sent any
+        later one until catch_up brings it up to date. '''
+        first = rpc_logs.allLogs[0].index
+        with self.crashed_lock:
+            if not self.in_step(i, first):
+                return
+            self.commit_sent[i] = first + len(rpc_logs.allLogs) - 1
+            queue = self.commit_queues[i]
+            queue.append(rpc_logs)
+            if len(queue) > 1:
+                return
+        self.send_queued_commit(i, rpc_logs)
+
+
+    def send_queued_commit(self, i, rpc_logs):
+        def done(future):
+            failed = future.exception() is not None or not future.result().answer
+            if failed:
+                # marked first, so nothing new is queued behind the failure
+                self.mark_crashed(i)
+            with self.crashed_lock:
+                queue = self.commit_queues[i]
+                if failed:
+                    queue.clear()
+                else:
+                    queue.popleft()
+                next_logs = queue[0] if queue else None
+            if next_logs is not None:
+                self.send_queued_commit(i, next_logs)
+        self.mstub_list[i][1].Commit.future(rpc_logs, timeout=_COMMIT_TIMEOUT).add_done_callback(done)
+
+
+    def mark_crashed(self, i):
+        with self.crashed_lock:
+            if i in self.crashed_followers:
+                return
+            self.crashed_followers.append(i)
+        # check on it now instead of at the next heartbeat
+        with self.catch_up_cond:
+            self.catch_up_cond.notify()
+
+
+    def catch_up_loop(self):
+        ''' Leader only. Heartbeat the followers every _HEARTBEAT_INTERVAL,
+        or right away when a follower failed a commit or rejoined '''
+        while True:
+            with self.catch_up_cond:
+                self.catch_up_cond.wait(_HEARTBEAT_INTERVAL)
+            self.heartbeat()
 
-    def two_phase_commit(self, cmd, file_info):
-        # leader log locally
-        log = [cmd, file_info.filename, file_info.version, file_info.blocklist]
-        self.logs.append(log)
-        votes = 0
-        # 1st phase of 2PC
+
+    def heartbeat(self):
+        request = SurfStoreBasic_pb2.LogIndex(index=self.last_index(), server=self.myID)
         for i in range(len(self.mstub_list)):
-            result = self.mstub_list[i][1].Vote(SurfStoreBasic_pb2.Empty())
-            if result.answer == True:
-                votes += 1
-            else:
-                if i not in self.crashed_followers:
-                    self.crashed_followers.append(i)
-        # 2nd phase of 2PC
-        if votes >= 1.*len(self.mstub_list)/2:
-            for i in range(len(self.mstub_list)):
-                if i in self.crashed_followers:
-                    continue
-                rpc_log = SurfStoreBasic_pb2.Log(cmd = log[0], filename = log[1], version = log[2], blocklist = log[3])
-                self.mstub_list[i][1].Commit(rpc_log)
-            return True
+            beat = self.mstub_list[i][1].Heartbeat.future(request, timeout=_COMMIT_TIMEOUT)
+            beat.add_done_callback(self.on_heartbeat(i, request.index))
+
+
+    def on_heartbeat(self, i, leader_index):
+        def done(future):
+            if future.exception() is not None or future.result().crashed:
+                self.mark_crashed(i)
+                return
+            with self.crashed_lock:
+                crashed = i in self.crashed_followers
+            if crashed or future.result().index < leader_index:
+                self.start_catch_up(i, future.result().index)
+        return done
+
+
+    def start_catch_up(self, i, follower_index):
+        with self.crashed_lock:
+            if i in self.catching_up:
+                return
+            self.catching_up.add(i)
+        self.catch_up_pool.submit(self.catch_up, i, follower_index)
+
+
+    def catch_up(self, i, follower_index):
+        '''
+        Bring follower i up to date from follower_index, the last entry it
+        has. Most entries are sent while writes go on; the ones committed
+        in the meantime are sent while commit_lock holds back the next
+        round, then the follower takes part in commits again.
+        '''
+        stub = self.mstub_list[i][1]
+        try:
+            sent = self.send_entries(stub, follower_index)
+            if sent is not None:
+                with self.commit_lock:
+                    sent = self.send_entries(stub, sent)
+                    if sent is not None:
+                        with self.crashed_lock:
+                            self.commit_sent[i] = sent
+                            if i in self.crashed_followers:
+                                self.crashed_followers.remove(i)
+        except grpc.RpcError:
+            self.mark_crashed(i)
+        finally:
+            with self.crashed_lock:
+                self.catching_up.discard(i)
+
+
+    def send_entries(self, stub, after):
+        ''' Send the log entries after index after, _CATCH_UP_CHUNK per
+        message, or the snapshot and the log after it when some of them
+        were compacted. Returns the last index sent, or None if the
+        follower turned them down. '''
+        with self.log_lock:
+            start = max(after, self.snapshot_index)
+            missing = [self.files.log(record) for record in self.logs[start - self.snapshot_index:]]
+            compacted = after < self.snapshot_index
+        if not missing and not compacted:
+            return after
+        if compacted:
+            result = stub.InstallSnapshot(self.snapshot_chunks(), timeout=_CATCH_UP_TIMEOUT)
         else:
-            # piazza says if we don't get majority vote, we just hang on there
-            # though it seems like TA won't actually test on it
-            self.logs.pop()
-            # check whether crashed server is up
-            while(len(self.crashed_followers) > 1.*len(self.mstub_list)/2):
-                for i in self.crashed_followers:
-                    result = self.mstub_list[i][1].Vote(SurfStoreBasic_pb2.Empty())
-                    if result.answer == True:
-                        self.crashed_followers.remove(i)
-
-            # call the function again, now we should be good to go
-            self.two_phase_commit(cmd, file_info)
-            return False
-
-
-    def update_crashed_server(self):
-        updated_list = []
-        # convert to rpc logs
-        rpc_logs = SurfStoreBasic_pb2.Logs()
-        for log in self.logs:
-            rpc_log = SurfStoreBasic_pb2.Log(cmd = log[0], filename = log[1], \
-                version = log[2], blocklist = log[3])
-            rpc_logs.allLogs.extend([rpc_log])
-        for i in self.crashed_followers:
-            result = self.mstub_list[i][1].Update(rpc_logs)
-            if result.answer == True:
-                updated_list.append(i)
-        for i in updated_list:     
-            self.crashed_followers.remove(i)
+            result = stub.Update(self.log_chunks(start, missing), timeout=_CATCH_UP_TIMEOUT)
+        if not result.answer:
+            return None
+        return start + len(missing)
+
+
+    def log_chunks(self, start, logs):
+        for pos in range(0, len(logs), _CATCH_UP_CHUNK):
+            rpc_logs = SurfStoreBasic_pb2.Logs(start=start + pos)
+            for log in logs[pos:pos + _CATCH_UP_CHUNK]:
+                rpc_logs.allLogs.extend([self.rpc_log(log)])
+            yield rpc_logs
     
 ######################################################
 ################# API Calls ###########################
@@ -174,67 +618,120 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
         fills in the version and blocklist fields and returns the completed
         object.
         """
-        fn = file_info.filename
+        self.wait_applied(file_info.log_index)
+        # taken before the file is looked up, the answer is at least this new
+        index = self.last_index()
+        self.fill_file_info(self.files, file_info)
+        file_info.log_index = -1 if self.crashed else index
+        
+        return file_info
+
+
+    def ReadFiles(self, file_list, context):
+        ''' ReadFile for every file in the list, all answered from the same
+        file table '''
+        self.wait_applied(file_list.log_index)
+        index = self.last_index()
+        files = self.files
+        for file_info in file_list.files:
+            self.fill_file_info(files, file_info)
+        file_list.log_index = -1 if self.crashed else index
+        return file_list
+
+
+    def ListFiles(self, file_list, context):
+        ''' Stream the name and version of every file that isn't deleted,
+        _LIST_CHUNK at a time '''
+        self.wait_applied(file_list.log_index)
+        return self.list_chunks()
+
+
+    def list_chunks(self):
+        index = self.last_index()
+        files = self.files
+        chunk = SurfStoreBasic_pb2.FileList(log_index=index)
+        for filename in files.names():
+            record = files.get(filename)
+            if record is None or record.deleted:
+                continue
+            chunk.files.extend([SurfStoreBasic_pb2.FileInfo(filename=filename, version=record.version)])
+            if len(chunk.files) == _LIST_CHUNK:
+                yield chunk
+                chunk = SurfStoreBasic_pb2.FileList(log_index=index)
+        if chunk.files:
+            yield chunk
 
-        if len(fn) != 0 and fn in self.files:
+
+    def wait_applied(self, log_index):
+        if log_index > self.last_index() and not self.leader:
+            # the client wrote something we haven't applied yet, give the
+            # commit a moment to arrive
+            deadline = time.time() + _READ_WAIT
+            with self.applied:
+                while log_index > self.last_index() and time.time() < deadline:
+                    self.applied.wait(deadline - time.time())
+
+
+    def fill_file_info(self, files, file_info):
+        fn = file_info.filename
+        record = files.get(fn) if len(fn) != 0 else None
+        if record is not None:
             # The file name exists, update with the info
-            info_tup = self.files[fn]
-            file_info.version = info_tup[_VERS]
-            file_info.blocklist[:] = info_tup[_BL]
-            if self.files[fn][_IS_DELETED]:
-                file_info.blocklist[:] = ['0']  # a deleted file has a hashlist with a single hash value of "0"
+            file_info.version = record.version
+            file_info.blocklist[:] = files.blocklist(record)
+            file_info.chunking = record.chunking
         else:
             # vers == 0 signals that the file d/n exist
             file_info.version = 0
             file_info.blocklist[:] = []
-        
-        return file_info
 
 
     # rpc ModifyFile (FileInfo) returns (WriteResult) {}
     def ModifyFile(self, file_info, context):
+        deleting = self.pin_blocks(file_info)
+        try:
+            mod_result, log = self.check_modify(file_info, deleting)
+            if log is None:
+                return mod_result
+            return self.write_result(mod_result, log, self.write(log))
+        finally:
+            self.unpin_blocks(file_info)
+
+
+    def check_modify(self, file_info, deleting=()):
+        ''' Return the WriteResult for a ModifyFile and the log entry to
+        write, or None when the result is already the answer. The blocks in
+        deleting count as missing. '''
         # Use this to return the result, assume MISSING_BLOCKS
         mod_result = SurfStoreBasic_pb2.WriteResult(result=2)
 
         if not self.leader:
             mod_result.result = 3
-            return mod_result
+            return mod_result, None
         
-        file_tup = None
-
-        # Check if the file already exists in the metadata record
-        if file_info.filename in self.files:
-            file_tup = self.files[file_info.filename]
-            mod_result.current_version = file_tup[_VERS]
-        else: 
-            file_tup = (0,file_info.blocklist,False)
+        state = self.latest(file_info.filename)
+        if state is not None:
+            mod_result.current_version = state[0]
+        version = state[0] if state is not None else 0
 
         # The case where the new vers is not current version + 1
-        if file_info.version != (file_tup[_VERS] + 1):
+        if file_info.version != (version + 1):
             mod_result.result = 1 # OLD_VERSION
-        # The case where the file exists and the next vers num is correct
-        else:
-            ###################
-            # 2PC
-            if self.distributed:
-                if self.leader:
-                    self.two_phase_commit("mod", file_info)
-            ###################
-
-            self.check_blockstore_connection()
-            # Used to maintain a list of missing blocks in the blockstore
-            missing_blocks = self.get_missing_blocks(file_info)
-            mod_result.missing_blocks[:] = missing_blocks
-
-            if len(missing_blocks) == 0:
-                mod_result.result = 0 # OK
-                  
-        if mod_result.result == 0: # OK
-            mod_result.current_version = file_info.version
-            self.files[file_info.filename] = \
-                (file_info.version,file_info.blocklist,False)
-        
-        return mod_result
+            return mod_result, None
+
+        # Only when a request is valid (all blocks are present and the version
+        # number is correct) does it need to invoke 2PC on the followers.
+        self.check_blockstore_connection()
+        # Used to maintain a list of missing blocks in the blockstore
+        missing_blocks = self.get_missing_blocks(file_info)
+        if deleting:
+            missing = set(missing_blocks)
+            missing_blocks = [b for b in file_info.blocklist if b in missing or b in deleting]
+        mod_result.missing_blocks[:] = missing_blocks
+        if len(missing_blocks) != 0:
+            return mod_result, None
+
+        return mod_result, ["mod", file_info.filename, file_info.version, list(file_info.blocklist), file_info.chunking]
         
 
     def DeleteFile(self, file_info, context):
@@ -243,25 +740,9 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
             del_result.result = 3
             return del_result
 
-        fn = file_info.filename
-
-        # Does the file exist?
-        if fn in self.files:
-            # Version should be current_version + 1 and not already deleted
-            if file_info.version == (self.files[fn][_VERS] + 1) and \
-            self.files[fn][_IS_DELETED] == False:
-                # Only when a request is valid (all blocks are present and the version
-                # number is correct) does it need to invoke 2PC on the followers.
-                ###################
-                # 2PC
-                if self.distributed:
-                    if self.leader:
-                        self.two_phase_commit("del", file_info)
-                ###################
-                del_result.result = 0 # OK
-                self.files[fn] = (file_info.version, ['0'], True)
-        
-        return del_result
+        # Version should be current_version + 1 and not already deleted
+        log = ["del", file_info.filename, file_info.version, ['0'], '']
+        return self.write_result(del_result, log, self.write(log))
     
 ######################################################
 ############### Below is for part 2 ##################
@@ -275,38 +756,94 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
 
 
     def Commit(self, request, context):
-        if not self.crashed:
-            log = (request.cmd, request.filename, request.version, request.blocklist)
-            self.logs.append(log)
-            # leader has already checked the validity of the command, so just execute it
-            if request.cmd == "mod":
-                self.files[request.filename] = (request.version, request.blocklist, False)
-            if request.cmd == "del":
-                self.files[request.filename] = (request.version, ['0'], True)
-            return SurfStoreBasic_pb2.Empty()
+        if self.crashed:
+            return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
+        answer = True
+        with self.log_lock:
+            for entry in request.allLogs:
+                if entry.index <= self.last_index():
+                    # a repeat of an entry we have
+                    continue
+                if entry.index != self.last_index() + 1:
+                    # we missed the entries before it
+                    answer = False
+                    break
+                # leader has already checked the validity of the command, so just execute it
+                self.apply_log((entry.cmd, entry.filename, entry.version, entry.blocklist, entry.chunking))
+        self.sync_wal()
+        return SurfStoreBasic_pb2.SimpleAnswer(answer=answer)
 
 
-    def Update(self, request, context):
+    def Update(self, request_iterator, context):
         if self.crashed:
             return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
-        # convert grpc format to python list
-        leaderLogs = []
-        for entry in request.allLogs:
-            log = (entry.cmd, entry.filename, entry.version, entry.blocklist)
-            leaderLogs.append(log)
-        myLogSize, leaderLogSize = len(self.logs), len(leaderLogs)
-        if myLogSize != leaderLogSize:
-            for i in range(myLogSize, leaderLogSize):
-                missedLog = leaderLogs[i]
-                
-                # update the file map
-                if missedLog[0] == "mod":
-                    self.files[missedLog[1]] = (missedLog[2], missedLog[3], False)
-                if missedLog[0] == "del":
-                    self.files[missedLog[1]] = (missedLog[2], ['0'], True)
-                # append the missed log
-                self.logs.append(missedLog)
+        for request in request_iterator:
+            # convert grpc format to python list
+            leaderLogs = []
+            for entry in request.allLogs:
+                log = (entry.cmd, entry.filename, entry.version, entry.blocklist, entry.chunking)
+                leaderLogs.append(log)
+            with self.log_lock:
+                if self.last_index() < request.start:
+                    # we missed the entries before this message
+                    self.sync_wal()
+                    return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
+                myLogSize, leaderLogSize = self.last_index() - request.start, len(leaderLogs)
+                for i in range(myLogSize, leaderLogSize):
+                    # update the file map and append the missed log
+                    self.apply_log(leaderLogs[i])
+
+        self.sync_wal()
+        return SurfStoreBasic_pb2.SimpleAnswer(answer=True)
+
+
+    def Heartbeat(self, request, context):
+        return SurfStoreBasic_pb2.LogIndex(index=self.last_index(), crashed=self.crashed, server=self.myID)
 
+
+    def Rejoin(self, request, context):
+        if not self.leader:
+            return SurfStoreBasic_pb2.Empty()
+        for i in range(len(self.mstub_list)):
+            if self.mstub_list[i][0] == request.server and request.index < self.last_index():
+                self.start_catch_up(i, request.index)
+        return SurfStoreBasic_pb2.Empty()
+
+
+    def InstallSnapshot(self, request_iterator, context):
+        if self.crashed:
+            return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
+        index = 0
+        files = FileTable()
+        snapshot = FileTable(files.block_ids)
+        tail = []
+        for chunk in request_iterator:
+            index = chunk.index
+            for file_info in chunk.files:
+                if list(file_info.blocklist) == ['0']:
+                    record = files.add(file_info.filename, file_info.version, (), True, '')
+                else:
+                    record = files.add(file_info.filename, file_info.version, file_info.blocklist, False, file_info.chunking)
+                snapshot.keep(record)
+            tail.extend(chunk.logs)
+
+        installed = False
+        with self.snapshot_lock:
+            with self.log_lock:
+                if index > self.last_index():
+                    self.files = files
+                    self.logs = []
+                    self.snapshot_index = index
+                    self.snapshot_files = snapshot
+                    installed = True
+                    if self.wal is not None:
+                        self.wal.rotate(index)
+                for entry in tail:
+                    if entry.index == self.last_index() + 1:
+                        self.apply_log((entry.cmd, entry.filename, entry.version, entry.blocklist, entry.chunking))
+            if installed and self.wal is not None:
+                self.wal.save_snapshot(index, snapshot)
+        self.sync_wal()
         return SurfStoreBasic_pb2.SimpleAnswer(answer=True)
 
 
@@ -326,6 +863,10 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
 
     def Restore(self, request, context):
         self.crashed = False
+        if self.distributed and not self.leader:
+            # let the leader know, so it catches us up right away
+            rejoin = SurfStoreBasic_pb2.LogIndex(index=self.last_index(), server=self.myID)
+            self.mstub_list[0][1].Rejoin.future(rejoin, timeout=_COMMIT_TIMEOUT)
         return SurfStoreBasic_pb2.Empty()
     
 
@@ -335,6 +876,103 @@ class MetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
         else: 
             return SurfStoreBasic_pb2.SimpleAnswer(answer=False)
 
+
+class AsyncMetadataStore(SurfStoreBasic_pb2_grpc.MetadataStoreServicer):
+    '''
+    grpc.aio front of a MetadataStore, for --aio. ReadFile answers right on
+    the event loop, and a write waits for its group commit as a future on
+    the loop instead of holding a thread, so thousands of clients can have
+    calls open at once. The calls that block, the blockstore check, fsyncs
+    and the follower side of replication, run on a pool of threads.
+    '''
+    def __init__(self, store, threads):
+        super(AsyncMetadataStore, self).__init__()
+        self.store = store
+        self.pool = futures.ThreadPoolExecutor(max_workers=threads)
+
+    async def blocking(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.pool, fn, *args)
+
+    async def write(self, log):
+        index = await self.blocking(self.store.reserve, log)
+        if index is _PENDING:
+            index = await self.store.group_commit.submit_async(log)
+        return index
+
+    async def Ping(self, request, context):
+        return SurfStoreBasic_pb2.Empty()
+
+    async def ReadFile(self, file_info, context):
+        if file_info.log_index > self.store.last_index() and not self.store.leader:
+            # it may wait for a commit
+            return await self.blocking(self.store.ReadFile, file_info, context)
+        return self.store.ReadFile(file_info, context)
+
+    async def ReadFiles(self, file_list, context):
+        if file_list.log_index > self.store.last_index() and not self.store.leader:
+            return await self.blocking(self.store.ReadFiles, file_list, context)
+        return self.store.ReadFiles(file_list, context)
+
+    async def ListFiles(self, file_list, context):
+        if file_list.log_index > self.store.last_index() and not self.store.leader:
+            await self.blocking(self.store.wait_applied, file_list.log_index)
+        for chunk in self.store.list_chunks():
+            yield chunk
+
+    async def ModifyFile(self, file_info, context):
+        deleting = self.store.pin_blocks(file_info)
+        try:
+            mod_result, log = await self.blocking(self.store.check_modify, file_info, deleting)
+            if log is None:
+                return mod_result
+            return self.store.write_result(mod_result, log, await self.write(log))
+        finally:
+            self.store.unpin_blocks(file_info)
+
+    async def DeleteFile(self, file_info, context):
+        del_result = SurfStoreBasic_pb2.WriteResult(result=1)
+        if not self.store.leader:
+            del_result.result = 3
+            return del_result
+        log = ["del", file_info.filename, file_info.version, ['0'], '']
+        return self.store.write_result(del_result, log, await self.write(log))
+
+    async def Vote(self, request, context):
+        return self.store.Vote(request, context)
+
+    async def Commit(self, request, context):
+        return await self.blocking(self.store.Commit, request, context)
+
+    async def Update(self, request_iterator, context):
+        # each message is applied as it arrives, like the threaded Update
+        async for request in request_iterator:
+            answer = await self.blocking(self.store.Update, iter([request]), context)
+            if not answer.answer:
+                return answer
+        return SurfStoreBasic_pb2.SimpleAnswer(answer=not self.store.crashed)
+
+    async def Heartbeat(self, request, context):
+        return self.store.Heartbeat(request, context)
+
+    async def Rejoin(self, request, context):
+        return self.store.Rejoin(request, context)
+
+    async def InstallSnapshot(self, request_iterator, context):
+        chunks = [chunk async for chunk in request_iterator]
+        return await self.blocking(self.store.InstallSnapshot, iter(chunks), context)
+
+    async def IsLeader(self, request, context):
+        return self.store.IsLeader(request, context)
+
+    async def Crash(self, request, context):
+        return self.store.Crash(request, context)
+
+    async def Restore(self, request, context):
+        return self.store.Restore(request, context)
+
+    async def IsCrashed(self, request, context):
+        return self.store.IsCrashed(request, context)
+
 # ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~# ~#
 
 def parse_args():
@@ -344,7 +982,27 @@ def parse_args():
     parser.add_argument("-n", "--number", type=int, default=1,
                         help="Set which number this server is")
     parser.add_argument("-t", "--threads", type=int, default=10,
-                        help="Maximum number of concurrent threads")
+                        help="Maximum number of concurrent threads (with --aio, threads for blocking work)")
+    parser.add_argument("--aio", action="store_true",
+                        help="Serve with grpc.aio on an event loop instead of a thread per call")
+    parser.add_argument("--wire-compress", action="store_true",
+                        help="Compress the messages this server sends")
+    parser.add_argument("--commit-window", type=float, default=1000 * _COMMIT_WINDOW,
+                        help="Milliseconds the leader waits for more writes to replicate together")
+    parser.add_argument("--commit-batch", type=int, default=_COMMIT_BATCH,
+                        help="Most writes the leader replicates in one round")
+    parser.add_argument("--snapshot-entries", type=int, default=_SNAPSHOT_ENTRIES,
+                        help="Log entries kept before they are compacted into a snapshot")
+    parser.add_argument("-d", "--data-dir", type=str, default=None,
+                        help="Keep the metadata log and snapshots in DATA_DIR/metadataN, "
+                             "without it nothing is kept across restarts")
+    parser.add_argument("--durability", choices=DURABILITY, default="batch",
+                        help="When log entries are fsynced: every write (sync), "
+                             "shared by concurrent writes (batch) or every second (async)")
+    parser.add_argument("--gc", action="store_true",
+                        help="Delete the blocks no file references any more (leader only)")
+    parser.add_argument("--gc-grace", type=float, default=_GC_GRACE,
+                        help="Seconds a block goes without references before it is deleted")
     return parser.parse_args()
 
 def serve(args, config):
@@ -356,10 +1014,26 @@ def serve(args, config):
     if args.number == leaderID:
         metadata_store.leader = True # Hey, look at me, I'm the captain now.
     metadata_store.myID = args.number
+    metadata_store.wire_compression = args.wire_compress
+    metadata_store.commit_window = args.commit_window / 1000.
+    metadata_store.commit_batch = args.commit_batch
+    metadata_store.snapshot_entries = args.snapshot_entries
+    if args.data_dir:
+        metadata_store.open_wal(os.path.join(args.data_dir, "metadata%d" % args.number), args.durability)
     metadata_store.init_distributed_server()
+    if args.gc and metadata_store.leader:
+        metadata_store.start_collector(args.gc_grace)
     ## END
 
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.threads))
+    if args.aio:
+        serve_aio(args, config, metadata_store)
+        return
+
+    if args.wire_compress:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.threads),
+                             compression=grpc.Compression.Gzip)
+    else:
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.threads))
     SurfStoreBasic_pb2_grpc.add_MetadataStoreServicer_to_server(metadata_store, server)
     server.add_insecure_port("127.0.0.1:%d" % config.metadata_ports[args.number])
     print("INFO: Metadata server number %d starting" % args.number)
@@ -368,14 +1042,42 @@ def serve(args, config):
 
     try:
         while True:
-            if metadata_store.distributed:
-                if metadata_store.leader:
-                    metadata_store.update_crashed_server()
+            metadata_store.compact_log()
             time.sleep(0.5)
             pass
 
     except KeyboardInterrupt:
         server.stop(0)
+        if metadata_store.group_commit is not None:
+            print(metadata_store.group_commit.stats())
+        if metadata_store.collector is not None:
+            print(metadata_store.collector.stats())
+        if metadata_store.wal is not None:
+            metadata_store.wal.close()
+
+def serve_aio(args, config, metadata_store):
+    async def run():
+        server = grpc.aio.server(compression=grpc.Compression.Gzip if args.wire_compress else None)
+        servicer = AsyncMetadataStore(metadata_store, args.threads)
+        SurfStoreBasic_pb2_grpc.add_MetadataStoreServicer_to_server(servicer, server)
+        server.add_insecure_port("127.0.0.1:%d" % config.metadata_ports[args.number])
+        print("INFO: Metadata server number %d starting" % args.number)
+        await server.start()
+        print("Server started on 127.0.0.1:%d (aio)" % config.metadata_ports[args.number])
+        while True:
+            await servicer.blocking(metadata_store.compact_log)
+            await asyncio.sleep(0.5)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(run())
+    except KeyboardInterrupt:
+        if metadata_store.group_commit is not None:
+            print(metadata_store.group_commit.stats())
+        if metadata_store.collector is not None:
+            print(metadata_store.collector.stats())
+        if metadata_store.wal is not None:
+            metadata_store.wal.close()
 
 if __name__ == "__main__":
     args = parse_args()
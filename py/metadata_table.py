@@ -0,0 +1,210 @@
+##############################################################################
+# metadata_table.py
+#
+# The file map of a MetadataStore, kept compact enough for namespaces of
+# millions of files. Block hashes are stored once and referred to by int,
+# blocklists are arrays of those ints, and the log entry that wrote a file
+# version is the same object as the file's record.
+##############################################################################
+import array
+import binascii
+import sys
+
+# blocklist of a deleted file
+_DELETED = ['0']
+
+# a hash the client makes: base64 of a sha256 digest
+_DIGEST_BYTES  = 32
+_DIGEST_LENGTH = 44
+# ids of hashes that aren't digests start here
+OTHER_IDS      = 1 << 31
+# hash table slots start at this many and double at 2/3 full
+_INITIAL_SLOTS = 1024
+
+
+class BlockIds(object):
+    '''
+    Interns block hashes as ints. A hash that is the base64 of a sha256
+    digest, as every hash a client makes is, is kept as the raw digest in
+    one bytearray and found through an open addressing table of ids with
+    linear probing, starting at the slot its first 8 bytes pick: about 40
+    bytes a hash, where a str and its dict entry take 150. Any other
+    string is kept in a dict, with ids from OTHER_IDS up.
+
+    Only one thread may add hashes at a time; decode() can be called from
+    any thread while one does, since ids are never moved or reused.
+    '''
+    def __init__(self, digests=b"", others=()):
+        self.digests = bytearray(digests)
+        self.count = len(self.digests) // _DIGEST_BYTES
+        # id + 1 of the digest in each slot, 0 for an empty slot
+        self.slots = None
+        self.rebuild(_INITIAL_SLOTS)
+        # key --> hash, value --> id
+        self.others = list(others)
+        self.other_ids = dict((b_hash, OTHER_IDS + i) for i, b_hash in enumerate(self.others))
+
+    def __len__(self):
+        return self.count + len(self.others)
+
+    def intern(self, b_hash):
+        raw = None
+        if len(b_hash) == _DIGEST_LENGTH:
+            try:
+                raw = binascii.a2b_base64(b_hash)
+            except ValueError:
+                # binascii.Error, or a str that isn't ASCII
+                pass
+            # decoding ignores stray characters and padding bits, only take
+            # the hashes that come back the same
+            if raw is not None and (len(raw) != _DIGEST_BYTES or
+                                    binascii.b2a_base64(raw, newline=False).decode() != b_hash):
+                raw = None
+        if raw is None:
+            block_id = self.other_ids.get(b_hash)
+            if block_id is None:
+                block_id = OTHER_IDS + len(self.others)
+                self.other_ids[b_hash] = block_id
+                self.others.append(b_hash)
+            return block_id
+
+        mask = len(self.slots) - 1
+        slot = int.from_bytes(raw[:8], "little") & mask
+        while self.slots[slot]:
+            block_id = self.slots[slot] - 1
+            start = block_id * _DIGEST_BYTES
+            if self.digests[start:start + _DIGEST_BYTES] == raw:
+                return block_id
+            slot = (slot + 1) & mask
+
+        block_id = self.count
+        self.digests += raw
+        self.count += 1
+        self.slots[slot] = block_id + 1
+        if 3 * self.count > 2 * len(self.slots):
+            self.rebuild(2 * len(self.slots))
+        return block_id
+
+    def rebuild(self, size):
+        ''' Put every digest in a new table of at least size slots '''
+        while 3 * self.count > 2 * size:
+            size *= 2
+        slots = array.array("i", [0]) * size
+        mask = size - 1
+        # the first 8 bytes of every digest, in one go
+        starts = array.array("Q", bytes(self.digests[:self.count * _DIGEST_BYTES]))[::_DIGEST_BYTES // 8]
+        if sys.byteorder != "little":
+            starts.byteswap()
+        for block_id, start in enumerate(starts):
+            slot = start & mask
+            while slots[slot]:
+                slot = (slot + 1) & mask
+            slots[slot] = block_id + 1
+        self.slots = slots
+
+    def save(self):
+        ''' (digests, other hashes) of every hash interned so far, for
+        BlockIds(digests, others) to load '''
+        count, others = self.count, len(self.others)
+        return bytes(self.digests[:count * _DIGEST_BYTES]), self.others[:others]
+
+    def decode(self, block_id):
+        if block_id >= OTHER_IDS:
+            return self.others[block_id - OTHER_IDS]
+        start = block_id * _DIGEST_BYTES
+        return binascii.b2a_base64(self.digests[start:start + _DIGEST_BYTES], newline=False).decode()
+
+
+class FileRecord(object):
+    '''
+    One version of a file, made by the "mod" or "del" log entry that wrote
+    it. A record is never changed once made; a write makes a new one, so
+    the file table, its snapshots and the log can all hold it.
+    '''
+    __slots__ = ("filename", "version", "blocks", "deleted", "chunking")
+
+    def __init__(self, filename, version, blocks, deleted, chunking):
+        self.filename = filename
+        self.version = version
+        self.blocks = blocks
+        self.deleted = deleted
+        self.chunking = chunking
+
+
+class FileTable(object):
+    '''
+    filename --> FileRecord of the latest version of every file. A
+    record's blocks are an array("I") of the ids block_ids interned its
+    hashes as, or () when there are none. A hash stays interned after the
+    last file using it is gone.
+
+    copy() shares the records and block_ids, so a snapshot costs one dict
+    copy.
+    '''
+    def __init__(self, block_ids=None):
+        self.records = {}
+        self.block_ids = block_ids if block_ids is not None else BlockIds()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, filename):
+        return filename in self.records
+
+    def get(self, filename):
+        return self.records.get(filename)
+
+    def items(self):
+        return self.records.items()
+
+    def names(self):
+        ''' Every filename, taken in one C call, so it needs no lock even
+        while another thread adds files '''
+        return list(self.records)
+
+    def copy(self):
+        table = FileTable(self.block_ids)
+        table.records = dict(self.records)
+        return table
+
+    def intern(self, b_hash):
+        return self.block_ids.intern(b_hash)
+
+    def put(self, filename, version, blocks, deleted, chunking):
+        ''' Store a new version of filename with its blocks already interned,
+        return its record '''
+        record = FileRecord(filename, version, blocks, deleted, sys.intern(chunking))
+        self.records[filename] = record
+        return record
+
+    def keep(self, record):
+        ''' Make record, from a table with the same block_ids, the latest
+        version of its file here '''
+        self.records[record.filename] = record
+
+    def add(self, filename, version, blocklist, deleted, chunking):
+        if deleted or len(blocklist) == 0:
+            # deleted and empty files share the one empty tuple
+            blocks = ()
+        else:
+            blocks = array.array("I", map(self.block_ids.intern, blocklist))
+        return self.put(filename, version, blocks, deleted, chunking)
+
+    def apply(self, log):
+        ''' Store the file version a (cmd, filename, version, blocklist,
+        chunking) log entry writes, return its record '''
+        if log[0] == "del":
+            return self.add(log[1], log[2], (), True, '')
+        return self.add(log[1], log[2], log[3], False, log[4])
+
+    def blocklist(self, record):
+        if record.deleted:
+            # a deleted file has a hashlist with a single hash value of "0"
+            return list(_DELETED)
+        return list(map(self.block_ids.decode, record.blocks))
+
+    def log(self, record):
+        ''' The log entry that wrote record '''
+        if record.deleted:
+            return ("del", record.filename, record.version, list(_DELETED), '')
+        return ("mod", record.filename, record.version, self.blocklist(record), record.chunking)
@@ -0,0 +1,299 @@
+##############################################################################
+# metadata_wal.py
+#
+# Keeps the MetadataStore state on disk: a snapshot of the file map plus a
+# write-ahead log of the entries committed after it. Every log entry is
+# written to the log before the write that made it is acknowledged.
+##############################################################################
+import array
+import gc
+import os
+import re
+import struct
+import threading
+import zlib
+
+from metadata_table import BlockIds, FileTable
+
+_SNAPSHOT_NAME = "snapshot.bin"
+_LOG_NAME      = "log-%010d.wal"
+# a log file is named after the index of the entry just before its first one
+_LOG_RE        = re.compile(r"^log-(\d{10})\.wal$")
+
+# record: payload length, crc32 of the payload
+_RECORD_HEADER = struct.Struct("<II")
+# payload: index, version, then cmd, filename, chunking and the blocklist,
+# NUL separated
+_RECORD_FIELDS = struct.Struct("<ii")
+
+# snapshot: magic, index, number of files, crc32 of the rest of the file
+_SNAPSHOT_HEADER = struct.Struct("<4sQII")
+_SNAPSHOT_MAGIC  = b"SSM2"
+# the format before block ids, with every blocklist as hash strings, is
+# still read
+_SNAPSHOT_MAGIC_HASHES = b"SSM1"
+_SECTION_LENGTH  = struct.Struct("<Q")
+
+# sync: fsync every write before it is acknowledged
+# batch: writes waiting at the same time share one fsync
+# async: fsync from a background thread every _ASYNC_SYNC_INTERVAL seconds,
+#        a crash can lose the writes since the last one
+DURABILITY = ("sync", "batch", "async")
+_ASYNC_SYNC_INTERVAL = 1.0
+
+
+def encode_record(index, log):
+    cmd, filename, version, blocklist, chunking = log
+    fields = "\0".join([cmd, filename, chunking] + list(blocklist)).encode("utf-8")
+    payload = _RECORD_FIELDS.pack(index, version) + fields
+    return _RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def read_records(path):
+    ''' Yield (index, log) for the complete records of a log file, and
+    truncate it after the last one '''
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + _RECORD_HEADER.size <= len(data):
+        length, crc = _RECORD_HEADER.unpack_from(data, pos)
+        start = pos + _RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < max(length, _RECORD_FIELDS.size) or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        index, version = _RECORD_FIELDS.unpack_from(payload)
+        fields = payload[_RECORD_FIELDS.size:].decode("utf-8").split("\0")
+        yield index, (fields[0], fields[1], version, fields[3:], fields[2])
+        pos = start + length
+
+    if pos < len(data):
+        # the process died while writing the last record
+        with open(path, "r+b") as f:
+            f.truncate(pos)
+
+
+def write_snapshot(path, index, files):
+    '''
+    Columnar binary snapshot of a FileTable: the versions, deleted flags
+    and blocklist lengths as arrays, the filenames and chunking specs as
+    NUL separated strings, all the blocklists as one array of block ids,
+    then the interned hashes as the raw digests and the other hashes NUL
+    separated. Loading it is a few C level calls per column and one pass
+    over the files.
+    '''
+    # the ids in the records were all interned before this
+    digests, others = files.block_ids.save()
+    versions = array.array("i")
+    deleted = bytearray()
+    counts = array.array("I")
+    blocks = array.array("I")
+    names, chunkings = [], []
+    for filename, record in files.items():
+        versions.append(record.version)
+        deleted.append(1 if record.deleted else 0)
+        counts.append(len(record.blocks))
+        names.append(filename)
+        chunkings.append(record.chunking)
+        blocks.extend(record.blocks)
+
+    sections = [versions.tobytes(), bytes(deleted), counts.tobytes()]
+    sections += ["\0".join(column).encode("utf-8") for column in (names, chunkings)]
+    sections += [blocks.tobytes(), digests, "\0".join(others).encode("utf-8")]
+    body = b"".join(_SECTION_LENGTH.pack(len(section)) + section for section in sections)
+
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, index, len(files), zlib.crc32(body) & 0xffffffff))
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp, path)
+    sync_dir(os.path.dirname(path))
+
+
+def read_snapshot(path):
+    ''' Return (index, FileTable) from a snapshot, or (0, an empty one) if
+    there is none '''
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        return 0, FileTable()
+    magic, index, count, crc = _SNAPSHOT_HEADER.unpack_from(data)
+    body = data[_SNAPSHOT_HEADER.size:]
+    if magic not in (_SNAPSHOT_MAGIC, _SNAPSHOT_MAGIC_HASHES) or zlib.crc32(body) & 0xffffffff != crc:
+        raise Exception("%s is not a valid snapshot" % path)
+
+    sections = []
+    pos = 0
+    while pos < len(body):
+        length, = _SECTION_LENGTH.unpack_from(body, pos)
+        pos += _SECTION_LENGTH.size
+        sections.append(body[pos:pos + length])
+        pos += length
+    versions = array.array("i")
+    versions.frombytes(sections[0])
+    deleted = bytearray(sections[1])
+    counts = array.array("I")
+    counts.frombytes(sections[2])
+    names, chunkings = [section.decode("utf-8").split("\0") for section in sections[3:5]]
+    block_ids = array.array("I")
+    if magic == _SNAPSHOT_MAGIC:
+        block_ids.frombytes(sections[5])
+        others = sections[7].decode("utf-8").split("\0") if sections[7] else []
+        files = FileTable(BlockIds(sections[6], others))
+    else:
+        files = FileTable()
+        block_ids.extend(map(files.intern, sections[5].decode("utf-8").split("\0")))
+
+    start = 0
+    # millions of new records would set off the cyclic GC over and over,
+    # none of them can be part of a cycle
+    gc.disable()
+    try:
+        for i in range(count):
+            end = start + counts[i]
+            if deleted[i]:
+                files.put(names[i], versions[i], (), True, chunkings[i])
+            else:
+                files.put(names[i], versions[i], block_ids[start:end] if end > start else (), False, chunkings[i])
+            start = end
+    finally:
+        gc.enable()
+    return index, files
+
+
+def sync_dir(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class MetadataWal(object):
+    '''
+    The write-ahead log and snapshot under data_dir. recover() returns the
+    state found on disk and opens a new log file for append(). The caller
+    serializes append() and rotate(); sync() may be called from any thread
+    and returns once everything appended before it is on disk.
+
+    Each snapshot starts a new log file, and the files the snapshot covers
+    are deleted once it is safely written.
+    '''
+    def __init__(self, data_dir, durability="batch"):
+        self.data_dir = data_dir
+        self.durability = durability
+        self.file = None
+        # bytes appended and bytes known to be on disk, over all log files
+        self.written = 0
+        self.synced = 0
+        self.syncing = False
+        self.cond = threading.Condition()
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_index = 0
+
+        if not os.path.isdir(data_dir):
+            os.makedirs(data_dir)
+
+    def log_starts(self):
+        return sorted(int(m.group(1)) for m in map(_LOG_RE.match, os.listdir(self.data_dir)) if m)
+
+    def log_path(self, start):
+        return os.path.join(self.data_dir, _LOG_NAME % start)
+
+    def recover(self):
+        ''' Return (snapshot index, files, entries): the snapshot and the log
+        entries that follow it, in order '''
+        index, files = read_snapshot(os.path.join(self.data_dir, _SNAPSHOT_NAME))
+        self.snapshot_index = index
+        entries = []
+        last = index
+        for start in self.log_starts():
+            for entry_index, log in read_records(self.log_path(start)):
+                if entry_index == last + 1:
+                    entries.append(log)
+                    last = entry_index
+
+        self.open_log(last)
+        if self.durability == "async":
+            thread = threading.Thread(target=self.sync_loop)
+            thread.daemon = True
+            thread.start()
+        return index, files, entries
+
+    def open_log(self, start):
+        self.file = open(self.log_path(start), "ab", 0)
+        sync_dir(self.data_dir)
+
+    def append(self, index, log):
+        record = encode_record(index, log)
+        self.file.write(record)
+        self.written += len(record)
+        if self.durability == "sync":
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+
+    def sync(self):
+        ''' Batch mode: wait until what was appended so far is on disk. The
+        first waiter fsyncs for everyone who appended before it started. '''
+        if self.durability != "batch":
+            return
+        target = self.written
+        with self.cond:
+            while self.synced < target:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.flush_locked()
+
+    def flush_locked(self):
+        ''' fsync the log up to what is written now, called holding cond '''
+        self.syncing = True
+        end, f = self.written, self.file
+        self.cond.release()
+        try:
+            os.fsync(f.fileno())
+        finally:
+            self.cond.acquire()
+            self.syncing = False
+            self.synced = max(self.synced, end)
+            self.cond.notify_all()
+
+    def sync_loop(self):
+        while not self.file.closed:
+            with self.cond:
+                self.cond.wait(_ASYNC_SYNC_INTERVAL)
+                if self.file.closed:
+                    return
+                if self.synced < self.written and not self.syncing:
+                    self.flush_locked()
+
+    def rotate(self, index):
+        ''' Start a new log file after entry index, called when a snapshot
+        at index is taken and before save_snapshot '''
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+            self.file.close()
+            self.open_log(index)
+
+    def save_snapshot(self, index, files):
+        ''' Write the snapshot, then delete the log files it covers '''
+        with self.snapshot_lock:
+            if index <= self.snapshot_index:
+                return
+            write_snapshot(os.path.join(self.data_dir, _SNAPSHOT_NAME), index, files)
+            self.snapshot_index = index
+            for start in self.log_starts():
+                if start < index:
+                    os.remove(self.log_path(start))
+
+    def close(self):
+        with self.cond:
+            while self.syncing:
+                self.cond.wait()
+            os.fsync(self.file.fileno())
+            self.file.close()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+##############################################################################
+# rebalance.py
+#
+# Run after adding block servers to the config. Every block is owned by the
+# replication servers the HashRing picks for it; this moves the blocks a
+# server no longer owns under the new config, which with consistent hashing
+# are only the ones in the ring ranges taken over by the new servers. Blocks
+# are copied to all their new owners before they are deleted from the old
+# one.
+##############################################################################
+from __future__ import print_function
+import argparse
+import collections
+
+import grpc
+
+import SurfStoreBasic_pb2
+import SurfStoreBasic_pb2_grpc
+
+from config_reader import SurfStoreConfigReader
+from hash_ring import HashRing
+
+
+def copy_blocks(source, target, hashes):
+    blocks = source.GetBlocks(SurfStoreBasic_pb2.BlockList(hashes=hashes))
+    # a block deleted since it was listed comes back without a hash
+    target.StoreBlocks(block for block in blocks if block.hash)
+
+
+def rebalance(old_config, new_config):
+    new_ring = HashRing(new_config.block_ports.keys())
+    replication = new_config.replication
+    stubs = {}
+    for server_id, port in new_config.block_ports.items():
+        channel = grpc.insecure_channel('localhost:%d' % port)
+        stubs[server_id] = SurfStoreBasic_pb2_grpc.BlockStoreStub(channel)
+
+    for server_id in sorted(old_config.block_ports):
+        source = stubs[server_id]
+        moved, moved_bytes = 0, 0
+
+        for listing in source.ListBlocks(SurfStoreBasic_pb2.Empty()):
+            by_target = collections.defaultdict(list)
+            leaving = []
+            for b_hash in listing.hashes:
+                owners = new_ring.lookup_n(b_hash, replication)
+                if server_id not in owners:
+                    leaving.append(b_hash)
+                    for owner in owners:
+                        by_target[owner].append(b_hash)
+            if not leaving:
+                continue
+
+            for target_id, hashes in by_target.items():
+                copy_blocks(source, stubs[target_id], hashes)
+            result = source.DeleteBlocks(SurfStoreBasic_pb2.BlockList(hashes=leaving))
+            moved += result.deleted
+            moved_bytes += result.bytes
+
+        print("block%d: moved %d blocks (%d bytes)" % (server_id, moved, moved_bytes))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Move SurfStore blocks to their owners after block servers were added")
+    parser.add_argument("old_config_file", type=str,
+                        help="Path to the configuration file the blocks were stored with")
+    parser.add_argument("new_config_file", type=str,
+                        help="Path to the configuration file with the new block servers")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    old_config = SurfStoreConfigReader(args.old_config_file)
+    new_config = SurfStoreConfigReader(args.new_config_file)
+
+    for server_id, port in old_config.block_ports.items():
+        if new_config.block_ports.get(server_id) != port:
+            raise RuntimeError("block%d must keep its port in the new config" % server_id)
+
+    rebalance(old_config, new_config)
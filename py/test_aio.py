@@ -0,0 +1,144 @@
+##############################################################################
+# test_aio.py
+#
+# Tests of the --aio block and metadata servers, a LocalCluster of grpc.aio
+# servers against the usual blocking stubs. Needs no servers:
+#   $ python test_aio.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import grpc
+
+import SurfStoreBasic_pb2
+import SurfStoreBasic_pb2_grpc
+from block_backend import LogBackend
+from local_cluster import LocalCluster, open_channel
+
+
+def make_block(i, size=100):
+    data = (b"block %d " % i) * (size // 10)
+    return SurfStoreBasic_pb2.Block(hash=base64.b64encode(hashlib.sha256(data).digest()).decode(), data=data)
+
+def store(router, blocks):
+    by_hash = dict((b.hash, b) for b in blocks)
+    router.store_blocks(list(by_hash), lambda hashes: (by_hash[h] for h in hashes))
+
+def modify(mstub, filename, version, blocks=()):
+    info = SurfStoreBasic_pb2.FileInfo(filename=filename, version=version, blocklist=[b.hash for b in blocks])
+    return mstub.ModifyFile(info)
+
+def read(mstub, filename):
+    return mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=filename))
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_blocks_round_trip():
+    with LocalCluster(blocks=2, aio=True) as cluster:
+        router = cluster.block_router()
+        router.Ping(SurfStoreBasic_pb2.Empty())
+        blocks = [make_block(i) for i in range(50)]
+        router.StoreBlock(blocks[0])
+        store(router, blocks[1:])
+        assert router.missing_blocks([b.hash for b in blocks] + [make_block(99).hash]) == [make_block(99).hash]
+        assert [b.data for b in router.get_blocks([b.hash for b in blocks])] == [b.data for b in blocks]
+        assert router.GetBlock(blocks[7]).data == blocks[7].data
+
+        router.delete_blocks([b.hash for b in blocks[:10]])
+        assert len(router.missing_blocks([b.hash for b in blocks])) == 10
+
+def test_blocks_on_disk_go_through_the_io_threads():
+    directory = tempfile.mkdtemp()
+    counter = itertools.count()
+    backend = lambda: LogBackend(os.path.join(directory, "block%d" % next(counter)))
+    try:
+        with LocalCluster(blocks=2, backend=backend, aio=True) as cluster:
+            router = cluster.block_router()
+            blocks = [make_block(i, 1000) for i in range(20)]
+            store(router, blocks)
+            assert [b.data for b in router.get_blocks([b.hash for b in blocks])] == [b.data for b in blocks]
+            assert sum(len(s.backend.keys()) for s in cluster.block_stores.values()) == 20
+    finally:
+        shutil.rmtree(directory)
+
+def test_oversized_blocks_are_refused():
+    with LocalCluster(block_size=1024, aio=True) as cluster:
+        stub = SurfStoreBasic_pb2_grpc.BlockStoreStub(open_channel(cluster.config.block_ports[1]))
+        try:
+            stub.StoreBlock(make_block(1, 2000))
+            assert False, "StoreBlock should fail"
+        except grpc.RpcError as e:
+            assert e.code() == grpc.StatusCode.INVALID_ARGUMENT
+        stub.StoreBlock(make_block(2, 1000))
+        assert stub.HasBlock(make_block(2, 1000)).answer
+
+def test_files_are_written_and_replicated():
+    with LocalCluster(metadata=3, aio=True) as cluster:
+        mstub = cluster.metadata_router()
+        blocks = [make_block(i) for i in range(3)]
+
+        # blocks that aren't stored yet are sent back as missing
+        result = modify(mstub, "f", 1, blocks)
+        assert result.result == 2 and sorted(result.missing_blocks) == sorted(b.hash for b in blocks)
+        store(cluster.block_router(), blocks)
+        assert modify(mstub, "f", 1, blocks).result == 0
+        assert modify(mstub, "f", 1, blocks).result == 1
+        assert list(read(mstub, "f").blocklist) == [b.hash for b in blocks]
+
+        deleted = mstub.DeleteFile(SurfStoreBasic_pb2.FileInfo(filename="f", version=2))
+        assert deleted.result == 0
+        assert list(read(mstub, "f").blocklist) == ["0"]
+        for server_id in (2, 3):
+            follower = cluster.metadata_stores[server_id]
+            wait_for(lambda: follower.last_index() == 2)
+            assert follower.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f"), None).version == 2
+
+def test_concurrent_writes_share_group_commits():
+    with LocalCluster(metadata=3, aio=True) as cluster:
+        mstub = cluster.metadata_router()
+        results = []
+        def writer(w):
+            for i in range(20):
+                results.append(modify(mstub, "w%d-%d" % (w, i), 1).result)
+        threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == [0] * 160
+        assert cluster.leader.last_index() == 160
+        assert cluster.leader.crashed_followers == []
+
+def test_follower_reads_wait_for_the_log_index():
+    with LocalCluster(metadata=3, aio=True) as cluster:
+        mstub = cluster.metadata_router(follower_reads=True)
+        for version in range(1, 11):
+            assert modify(mstub, "f", version).result == 0
+            # a read right after a write sees it, whichever server answers
+            assert read(mstub, "f").version == version
+        # a follower's listing waits for the index it's asked for too
+        modify(mstub, "g", 1)
+        follower = SurfStoreBasic_pb2_grpc.MetadataStoreStub(open_channel(cluster.config.metadata_ports[2]))
+        request = SurfStoreBasic_pb2.FileList(log_index=cluster.leader.last_index())
+        listed = dict((f.filename, f.version) for chunk in follower.ListFiles(request) for f in chunk.files)
+        assert listed == {"f": 10, "g": 1}
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,375 @@
+##############################################################################
+# test_block_backend.py
+#
+# Tests of the BlockStore storage backends. Needs no servers:
+#   $ python test_block_backend.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+from block_backend import (ArenaBackend, BlockCache, CompressedBackend, LogBackend, MemoryBackend,
+                           SharedLogBackend)
+
+_FORK = multiprocessing.get_context("fork")
+
+
+def in_worker(target, *args):
+    ''' Run target(*args) in a forked worker, fail if it does '''
+    worker = _FORK.Process(target=target, args=args)
+    worker.start()
+    worker.join()
+    assert worker.exitcode == 0, "worker exited with %s" % worker.exitcode
+
+def block(i, size=1000):
+    return (b"%06d" % i) * (size // 6)
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.startswith("segment-"))
+
+
+def test_shared_log_blocks_are_seen_by_every_worker():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = SharedLogBackend(directory)
+
+        def store(backend, start):
+            for i in range(start, start + 50):
+                backend.put("h%d" % i, block(i))
+        in_worker(store, backend, 0)
+        in_worker(store, backend, 50)
+        # and a block stored here is seen by the workers
+        backend.put("here", block(-1))
+
+        def check(backend):
+            for i in range(100):
+                assert backend.get("h%d" % i) == block(i)
+            assert backend.get("here") == block(-1)
+            assert backend.delete("h7") == len(block(7))
+        in_worker(check, backend)
+
+        assert backend.get("h99") == block(99)
+        assert not backend.contains("h7")
+        assert backend.get("h7") is None
+        assert len(backend.keys()) == 100
+        backend.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_shared_log_follows_segments_sealed_elsewhere():
+    directory = tempfile.mkdtemp()
+    try:
+        # a few blocks per segment, so the workers roll over many of them
+        backend = SharedLogBackend(directory, segment_bytes=4000)
+        backend.put("first", block(0))
+
+        def store(backend, start):
+            for i in range(start, start + 40):
+                backend.put("h%d" % i, block(i))
+            backend.delete("h%d" % start)
+        in_worker(store, backend, 0)
+        in_worker(store, backend, 40)
+
+        for i in range(80):
+            expected = None if i in (0, 40) else block(i)
+            assert backend.get("h%d" % i) == expected
+        assert backend.active > 10
+        assert backend.get("first") == block(0)
+        backend.close()
+
+        # what the workers wrote is all in the log after a restart
+        reopened = LogBackend(directory)
+        assert sorted(reopened.keys()) == sorted(["first"] + ["h%d" % i for i in range(80) if i not in (0, 40)])
+        assert reopened.get("h79") == block(79)
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_shared_log_put_is_stored_once():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = SharedLogBackend(directory)
+
+        def store(backend):
+            for i in range(20):
+                backend.put("h%d" % i, block(i))
+        workers = [_FORK.Process(target=store, args=(backend,)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            assert worker.exitcode == 0
+
+        backend.refresh()
+        # four workers stored the same blocks, each one was appended once
+        assert len(backend.active_entries) == 20
+        assert backend.get("h19") == block(19)
+        backend.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_log_keeps_blocks_across_restarts():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = LogBackend(directory, segment_bytes=10000)
+        for i in range(50):
+            backend.put("h%d" % i, block(i))
+        for i in range(0, 50, 10):
+            backend.delete("h%d" % i)
+        backend.close()
+
+        # every segment was sealed, startup reads only the footers
+        reopened = LogBackend(directory, segment_bytes=10000)
+        assert all(reopened.read_footer(int(name[8:16])) is not None for name in segment_files(directory)[:-1])
+        assert sorted(reopened.keys()) == sorted("h%d" % i for i in range(50) if i % 10)
+        assert all(reopened.get("h%d" % i) == block(i) for i in range(50) if i % 10)
+        assert reopened.get("h10") is None and not reopened.contains("h10")
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_log_recovers_a_segment_cut_off_in_a_crash():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = LogBackend(directory)
+        for i in range(10):
+            backend.put("h%d" % i, block(i))
+        backend.delete("h3")
+        backend.put("last", block(99))
+        # the process dies halfway through writing the last record
+        path = backend.segment_path(backend.active)
+        with open(path, "r+b") as f:
+            f.truncate(os.path.getsize(path) - 100)
+
+        reopened = LogBackend(directory)
+        assert sorted(reopened.keys()) == sorted("h%d" % i for i in range(10) if i != 3)
+        assert reopened.get("h9") == block(9) and reopened.get("last") is None
+        # the torn segment was truncated and sealed, new blocks go on
+        assert reopened.read_footer(1) is not None and reopened.active == 2
+        reopened.put("last", block(99))
+        reopened.close()
+        reopened = LogBackend(directory)
+        assert reopened.get("last") == block(99)
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_log_compacts_mostly_deleted_segments():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = LogBackend(directory, segment_bytes=10000)
+        for i in range(100):
+            backend.put("h%d" % i, block(i))
+        full = segment_files(directory)
+        for i in range(0, 100, 4):
+            backend.delete("h%d" % i)
+        # a quarter deleted from every segment, nothing is moved yet
+        assert segment_files(directory)[:len(full) - 1] == full[:-1]
+
+        for i in range(100):
+            if i % 4 != 3:
+                backend.delete("h%d" % i)
+        # the old segments went, the live blocks were copied and still read
+        assert not set(full[:-1]) & set(segment_files(directory))
+        assert sorted(backend.keys()) == sorted("h%d" % i for i in range(3, 100, 4))
+        assert all(backend.get("h%d" % i) == block(i) for i in range(3, 100, 4))
+        backend.put("h0", block(0))
+        backend.close()
+
+        # and the deleted blocks stay deleted after a restart
+        reopened = LogBackend(directory, segment_bytes=10000)
+        assert sorted(reopened.keys()) == sorted(["h0"] + ["h%d" % i for i in range(3, 100, 4)])
+        assert reopened.get("h4") is None and reopened.get("h0") == block(0)
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_log_compaction_keeps_tombstones_of_older_segments():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = LogBackend(directory, segment_bytes=5000)
+        for i in range(10):
+            backend.put("old%d" % i, block(i))
+        # the tombstone of old0 lands in a segment of new blocks, which is
+        # then compacted while the old segment is still there
+        backend.delete("old0")
+        for i in range(10):
+            backend.put("new%d" % i, block(i))
+        for i in range(10):
+            backend.delete("new%d" % i)
+        backend.close()
+
+        reopened = LogBackend(directory, segment_bytes=5000)
+        assert sorted(reopened.keys()) == sorted("old%d" % i for i in range(1, 10))
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_log_compacts_at_startup_and_after_a_torn_compaction():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = LogBackend(directory, segment_bytes=10000)
+        for i in range(40):
+            backend.put("h%d" % i, block(i))
+        backend.close()
+        first = os.path.join(directory, segment_files(directory)[0])
+        saved = open(first, "rb").read()
+
+        backend = LogBackend(directory, segment_bytes=10000)
+        for i in range(1, 9):
+            backend.delete("h%d" % i)
+        backend.close()
+        # put the first segment back as if the compaction died before
+        # removing it: h0 is in it and in the segment it was copied to
+        assert not os.path.exists(first)
+        with open(first, "wb") as f:
+            f.write(saved)
+        reopened = LogBackend(directory, segment_bytes=10000)
+        assert sorted(reopened.keys()) == sorted("h%d" % i for i in range(40) if not 1 <= i < 9)
+        assert reopened.get("h0") == block(0)
+        # and it is compacted again at startup
+        assert not os.path.exists(first)
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+class SlowReads(MemoryBackend):
+    ''' Holds every get() after it read the block, until release is set '''
+    def __init__(self):
+        MemoryBackend.__init__(self)
+        self.reading = threading.Event()
+        self.release = threading.Event()
+
+    def get(self, b_hash):
+        data = MemoryBackend.get(self, b_hash)
+        self.reading.set()
+        self.release.wait()
+        return data
+
+def test_cache_miss_racing_a_delete_does_not_admit_the_block():
+    backend = SlowReads()
+    cache = BlockCache(backend, 100000)
+    cache.put("h", block(1))
+
+    # the read got the block from the backend, then it is deleted
+    reader = threading.Thread(target=cache.get, args=("h",))
+    reader.start()
+    backend.reading.wait()
+    assert cache.delete("h") == len(block(1))
+    backend.release.set()
+    reader.join()
+
+    assert not cache.contains("h") and "h" not in cache.entries
+    assert cache.get("h") is None
+    # without a delete in between a miss is admitted
+    cache.put("k", block(2))
+    assert cache.get("k") == block(2) and "k" in cache.entries
+
+def test_compressed_blocks_read_back_the_same():
+    inner = MemoryBackend()
+    backend = CompressedBackend(inner)
+    text = b"the same few words, over and over again. " * 100
+    noise = os.urandom(4096)
+    for b_hash, data in (("text", text), ("noise", noise), ("empty", b"")):
+        backend.put(b_hash, data)
+        assert backend.get(b_hash) == data
+    # only the block that shrinks is stored compressed, behind its flag byte
+    assert inner.get("text")[:1] == b"\x01" and len(inner.get("text")) < len(text) // 10
+    assert inner.get("noise") == b"\x00" + noise
+    assert inner.get("empty") == b"\x00"
+    # a delete frees what the block took compressed
+    stored = len(inner.get("text"))
+    assert backend.delete("text") == stored
+    assert backend.get("text") is None and sorted(backend.keys()) == ["empty", "noise"]
+
+def test_compressed_log_blocks_survive_a_restart():
+    directory = tempfile.mkdtemp()
+    try:
+        backend = CompressedBackend(LogBackend(directory))
+        blocks = dict(("h%d" % i, (b"%d " % i) * 500) for i in range(20))
+        for b_hash, data in blocks.items():
+            backend.put(b_hash, data)
+        backend.close()
+        reopened = CompressedBackend(LogBackend(directory))
+        assert all(reopened.get(b_hash) == data for b_hash, data in blocks.items())
+        reopened.close()
+    finally:
+        shutil.rmtree(directory)
+
+def test_arena_grows_and_keeps_every_block():
+    # small arenas, so the blocks take several and some don't fit at all
+    backend = ArenaBackend(arena_bytes=200000)
+    sizes = [0, 1, 4096, 70000, 300000] + [1000 + i for i in range(500)]
+    for i, size in enumerate(sizes):
+        backend.put("h%d" % i, block(i, size))
+    backend.put("h3", b"a second put of a hash is ignored")
+
+    assert len(backend.arenas) > 3
+    assert all(len(arena) <= max(200000, 300044) for arena in backend.arenas)
+    for i, size in enumerate(sizes):
+        assert backend.get("h%d" % i) == block(i, size)
+    assert sorted(backend.keys()) == sorted("h%d" % i for i in range(len(sizes)))
+    assert backend.get("missing") is None and not backend.contains("missing")
+
+def test_arena_frees_mostly_deleted_arenas():
+    backend = ArenaBackend(arena_bytes=100000)
+    for i in range(1000):
+        backend.put("h%d" % i, block(i))
+    full = len(backend.arenas)
+    for i in range(900):
+        assert backend.delete("h%d" % i) == len(block(i))
+    assert backend.delete("h0") == 0
+
+    # the blocks left were moved out of the arenas that became holes
+    assert sum(arena is not None for arena in backend.arenas) < full // 2
+    for i in range(900, 1000):
+        assert backend.get("h%d" % i) == block(i)
+    # and entries and slots are reused
+    for i in range(900):
+        backend.put("h%d" % i, block(i))
+    assert len(backend.where) == 1000
+    assert all(backend.get("h%d" % i) == block(i) for i in range(1000))
+
+def test_arena_reuses_the_places_of_freed_arenas():
+    backend = ArenaBackend(arena_bytes=100000)
+    for rounds in range(10):
+        for i in range(1000):
+            backend.put("h%d" % i, block(i))
+        for i in range(1000):
+            backend.delete("h%d" % i)
+    # a round takes about a dozen arenas, freed ones are taken again
+    # instead of the lists growing every round
+    assert len(backend.arenas) < 20 and len(backend.dead) == len(backend.arenas)
+    for i in range(500):
+        backend.put("h%d" % i, block(i))
+    assert all(backend.get("h%d" % i) == block(i) for i in range(500))
+
+def test_arena_matches_a_dict_under_churn():
+    rand = random.Random(5)
+    backend = ArenaBackend(arena_bytes=50000)
+    model = {}
+    for step in range(20000):
+        i = rand.randrange(300)
+        if rand.random() < 0.5:
+            data = block(i, rand.choice([0, 10, 500, 3000]))
+            backend.put("h%d" % i, data)
+            model.setdefault("h%d" % i, data)
+        else:
+            assert backend.delete("h%d" % i) == len(model.pop("h%d" % i, b""))
+        if step % 1000 == 0:
+            assert sorted(backend.keys()) == sorted(model)
+    assert all(backend.get(key) == data for key, data in model.items())
+    # deleted slots are cleared on a resize, the table stays sized to the
+    # blocks held, not to the puts ever made
+    assert len(backend.slots) <= 1024 and backend.count == len(model)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,171 @@
+##############################################################################
+# test_block_gc.py
+#
+# Tests of the MetadataStore's BlockCollector, against a blockstore kept in
+# memory. Needs no servers:
+#   $ python test_block_gc.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+
+from block_gc import BlockCollector
+from metadata_table import FileTable
+
+
+class FakeBlockstore(object):
+    ''' Every block on every one of servers; DeleteBlocks to a server in
+    down fails '''
+    def __init__(self, servers, hashes):
+        self.stored = dict((server_id, set(hashes)) for server_id in servers)
+        self.down = set()
+        self.calls = []
+        self.during_delete = None
+
+    def delete_blocks(self, hashes):
+        return self.delete_from([(server_id, b_hash) for b_hash in hashes
+                                 for server_id in sorted(self.stored)])
+
+    def delete_from(self, pairs):
+        self.calls.append(list(pairs))
+        if self.during_delete is not None:
+            self.during_delete()
+        deleted, failed = 0, []
+        for server_id, b_hash in pairs:
+            if server_id in self.down:
+                failed.append((server_id, b_hash))
+            elif b_hash in self.stored[server_id]:
+                self.stored[server_id].discard(b_hash)
+                deleted += 1
+        return deleted, deleted * 10, failed
+
+    def holders(self, b_hash):
+        return sorted(server_id for server_id, hashes in self.stored.items() if b_hash in hashes)
+
+
+def make_collector(blockstore):
+    files = FileTable()
+    collector = BlockCollector(files.block_ids.decode, lambda: blockstore, grace=0)
+    return files, collector
+
+def write(files, collector, log):
+    ''' Apply a log entry the way MetadataStore.apply_log does '''
+    old = files.get(log[1])
+    collector.replace(old, files.apply(log))
+
+def refs(files, collector, b_hash):
+    return collector.count(files.intern(b_hash))
+
+
+def test_refcounts_follow_mod_and_del():
+    blockstore = FakeBlockstore([1], ["a", "b", "c"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a", "b", "a"], "fixed:4096"))
+    write(files, collector, ("mod", "g", 1, ["b"], "fixed:4096"))
+    assert refs(files, collector, "a") == 2
+    assert refs(files, collector, "b") == 2
+
+    write(files, collector, ("mod", "f", 2, ["b", "c"], "fixed:4096"))
+    assert refs(files, collector, "a") == 0
+    assert refs(files, collector, "b") == 2
+    assert refs(files, collector, "c") == 1
+    assert collector.collect() == 10
+    assert blockstore.holders("a") == []
+
+    write(files, collector, ("del", "f", 3))
+    assert refs(files, collector, "b") == 1
+    assert refs(files, collector, "c") == 0
+    collector.collect()
+    assert blockstore.holders("b") == [1]
+    assert blockstore.holders("c") == []
+
+def test_pinned_hashes_are_never_picked():
+    blockstore = FakeBlockstore([1, 2], ["a", "b"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a", "b"], "fixed:4096"))
+    write(files, collector, ("del", "f", 2))
+
+    assert collector.pin(["a"]) == set()
+    collector.collect()
+    assert blockstore.holders("a") == [1, 2]
+    assert blockstore.holders("b") == []
+
+    collector.unpin(["a"])
+    collector.collect()
+    assert blockstore.holders("a") == []
+
+def test_pin_reports_hashes_being_deleted():
+    blockstore = FakeBlockstore([1], ["a", "b"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a"], "fixed:4096"))
+    write(files, collector, ("mod", "f", 2, ["b"], "fixed:4096"))
+
+    pinned = []
+    blockstore.during_delete = lambda: pinned.append(collector.pin(["a", "b"]))
+    collector.collect()
+    assert pinned == [set(["a"])]
+    collector.unpin(["a", "b"])
+    # once the delete is done nothing is in flight
+    assert collector.pin(["a"]) == set()
+
+def test_failed_deletes_are_retried_on_those_servers():
+    blockstore = FakeBlockstore([1, 2, 3], ["a", "b"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a", "b"], "fixed:4096"))
+    write(files, collector, ("del", "f", 2))
+
+    blockstore.down = set([2])
+    collector.collect()
+    assert blockstore.holders("a") == [2]
+    assert blockstore.holders("b") == [2]
+
+    # the next cycle only goes to the server that missed the delete
+    blockstore.down = set()
+    del blockstore.calls[:]
+    collector.collect()
+    assert blockstore.calls == [[(2, "a"), (2, "b")]]
+    assert blockstore.holders("a") == []
+    assert blockstore.holders("b") == []
+    assert collector.failed == {}
+
+def test_failed_delete_of_a_block_used_again_is_dropped():
+    blockstore = FakeBlockstore([1, 2], ["a"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a"], "fixed:4096"))
+    write(files, collector, ("del", "f", 2))
+
+    blockstore.down = set([2])
+    collector.collect()
+    write(files, collector, ("mod", "g", 1, ["a"], "fixed:4096"))
+    blockstore.down = set()
+    del blockstore.calls[:]
+    collector.collect()
+    assert blockstore.calls == []
+    assert blockstore.holders("a") == [2]
+    assert collector.failed == {}
+
+def test_unreachable_blockstore_keeps_the_candidates():
+    blockstore = FakeBlockstore([1], ["a"])
+    files, collector = make_collector(blockstore)
+    write(files, collector, ("mod", "f", 1, ["a"], "fixed:4096"))
+    write(files, collector, ("del", "f", 2))
+
+    def fail():
+        raise RuntimeError("blockstore is down")
+    blockstore.during_delete = fail
+    try:
+        collector.collect()
+        assert False, "collect() should have raised"
+    except RuntimeError:
+        pass
+    assert collector.pin(["a"]) == set()
+    collector.unpin(["a"])
+
+    blockstore.during_delete = None
+    collector.collect()
+    assert blockstore.holders("a") == []
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,141 @@
+##############################################################################
+# test_block_router.py
+#
+# Tests of the BlockRouter against block servers running in this process.
+# Needs no servers:
+#   $ python test_block_router.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import time
+from concurrent import futures
+
+import grpc
+
+import SurfStoreBasic_pb2
+import block_router
+from local_cluster import LocalCluster
+
+
+def make_block(i):
+    data = b"block %d" % i
+    return SurfStoreBasic_pb2.Block(hash=base64.b64encode(hashlib.sha256(data).digest()).decode(), data=data)
+
+def stop_block_server(cluster, server_id):
+    # the block servers were started first, in server id order
+    cluster.servers[server_id - 1].stop(0)
+
+
+class HungStub(object):
+    ''' A BlockStoreStub whose GetBlock never answers '''
+    def __init__(self):
+        self.GetBlock = self
+        self.timeouts = []
+
+    def future(self, request, timeout=None):
+        self.timeouts.append(timeout)
+        return futures.Future()
+
+
+def test_blocks_go_over_the_wire_compressed():
+    with LocalCluster(blocks=2) as cluster:
+        open_channel = lambda port: grpc.insecure_channel("localhost:%d" % port, compression=grpc.Compression.Gzip)
+        router = block_router.BlockRouter(cluster.config, open_channel)
+        blocks = [SurfStoreBasic_pb2.Block(hash="h%d" % i, data=b"compressible " * 300) for i in range(10)]
+        router.store_blocks([b.hash for b in blocks], lambda hashes: (b for b in blocks if b.hash in hashes))
+        assert [b.data for b in router.get_blocks([b.hash for b in blocks])] == [b.data for b in blocks]
+        assert router.GetBlock(blocks[3]).data == blocks[3].data
+
+def test_writes_need_a_quorum_of_replicas():
+    with LocalCluster(blocks=3, replication=3) as cluster:
+        router = cluster.block_router()
+        assert router.write_quorum == 2
+        stop_block_server(cluster, 3)
+        # a minority down, writes and Ping still go through
+        router.Ping(SurfStoreBasic_pb2.Empty())
+        router.StoreBlock(make_block(1))
+        router.store_blocks([make_block(2).hash], lambda hashes: iter([make_block(2)]))
+        assert router.missing_blocks([make_block(1).hash, make_block(2).hash]) == []
+
+        # a block on only one replica is short of its quorum, so it counts
+        # as missing and gets uploaded again
+        cluster.block_stores[2].backend.delete(make_block(1).hash)
+        assert router.missing_blocks([make_block(1).hash, make_block(2).hash]) == [make_block(1).hash]
+
+        stop_block_server(cluster, 2)
+        for call in (lambda: router.StoreBlock(make_block(3)),
+                     lambda: router.Ping(SurfStoreBasic_pb2.Empty())):
+            try:
+                call()
+                assert False, "a majority is down"
+            except Exception as e:
+                assert "fewer than 2" in str(e) or "quorum" in str(e)
+
+def test_slow_read_is_hedged_to_another_replica():
+    with LocalCluster(blocks=2, replication=2) as cluster:
+        router = cluster.block_router()
+        block = make_block(1)
+        router.StoreBlock(block)
+        first = router.pick_replicas(block.hash)[0]
+        hung = HungStub()
+        router.stubs[first] = hung
+        router.hedge_delay = 0.05
+
+        started = time.time()
+        assert router.GetBlock(SurfStoreBasic_pb2.Block(hash=block.hash)).data == block.data
+        assert time.time() - started < 1.0 and len(hung.timeouts) == 1
+        # the hung replica has a call in flight, the next read starts elsewhere
+        assert router.pick_replicas(block.hash)[0] != first
+        # a block neither replica has comes back empty
+        router.stubs[first] = cluster.block_router().stubs[first]
+        assert router.GetBlock(SurfStoreBasic_pb2.Block(hash=make_block(2).hash)).hash == ""
+
+def test_has_block_skips_a_replica_that_is_down():
+    with LocalCluster(blocks=3, replication=2) as cluster:
+        router = cluster.block_router()
+        block = make_block(1)
+        router.StoreBlock(block)
+        first, second = router.replicas_for(block.hash)
+
+        stop_block_server(cluster, first)
+        assert router.HasBlock(block).answer
+        missing = SurfStoreBasic_pb2.Block(hash=make_block(2).hash)
+        assert not router.HasBlock(missing).answer
+
+        # with every replica down there is no answer to give
+        stop_block_server(cluster, second)
+        try:
+            router.HasBlock(block)
+            assert False, "HasBlock should fail"
+        except grpc.RpcError:
+            pass
+
+def test_hedged_get_block_gives_up_after_the_deadline():
+    with LocalCluster(blocks=2, replication=2) as cluster:
+        router = cluster.block_router()
+        stubs = dict((server_id, HungStub()) for server_id in router.stubs)
+        router.stubs = stubs
+        router.hedge_delay = 0.01
+
+        saved, block_router._READ_TIMEOUT = block_router._READ_TIMEOUT, 0.2
+        try:
+            started = time.time()
+            try:
+                router.GetBlock(SurfStoreBasic_pb2.Block(hash=make_block(1).hash))
+                assert False, "GetBlock should fail"
+            except Exception as e:
+                assert "answered within" in str(e)
+            assert time.time() - started < 1.0
+        finally:
+            block_router._READ_TIMEOUT = saved
+        # hedged to the other replica, every call with the time that was left
+        assert all(len(stub.timeouts) == 1 for stub in stubs.values())
+        assert all(0 <= stub.timeouts[0] <= 0.2 for stub in stubs.values())
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,107 @@
+##############################################################################
+# test_block_store.py
+#
+# Tests of the BlockStore calls, on the servicer itself or on block servers
+# running in this process. Needs no servers:
+#   $ python test_block_store.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+
+import grpc
+
+import SurfStoreBasic_pb2
+from block_store import BlockStore
+from local_cluster import LocalCluster
+
+
+class Config(object):
+    def get_block_size(self):
+        return 4096
+
+class Aborted(Exception):
+    pass
+
+class Context(object):
+    def abort(self, code, details):
+        raise Aborted(code, details)
+
+def make_block(i, size=100):
+    data = (b"%06d" % i) * (size // 6)
+    return SurfStoreBasic_pb2.Block(hash=base64.b64encode(hashlib.sha256(data).digest()).decode(), data=data)
+
+def present(bitmap, count):
+    bitmap = bytearray(bitmap)
+    return [bool(bitmap[i >> 3] & (1 << (i & 7))) for i in range(count)]
+
+
+def test_has_blocks_answers_a_bit_per_hash():
+    store = BlockStore(Config())
+    blocks = [make_block(i) for i in range(20)]
+    for i in (0, 3, 7, 8, 15, 19):
+        store.StoreBlock(blocks[i], None)
+
+    request = SurfStoreBasic_pb2.BlockList(hashes=[b.hash for b in blocks])
+    bitmap = store.HasBlocks(request, None).bitmap
+    assert len(bitmap) == 3
+    assert present(bitmap, 20) == [i in (0, 3, 7, 8, 15, 19) for i in range(20)]
+    # the same hash twice gets a bit each time
+    request = SurfStoreBasic_pb2.BlockList(hashes=[blocks[3].hash, blocks[4].hash, blocks[3].hash])
+    assert present(store.HasBlocks(request, None).bitmap, 3) == [True, False, True]
+    assert store.HasBlocks(SurfStoreBasic_pb2.BlockList(), None).bitmap == b""
+
+def test_modify_file_lists_the_missing_blocks_in_order():
+    with LocalCluster(blocks=2) as cluster:
+        blocks = [make_block(i) for i in range(10)]
+        router = cluster.block_router()
+        for block in blocks[::2]:
+            router.StoreBlock(block)
+
+        blocklist = [b.hash for b in blocks]
+        info = SurfStoreBasic_pb2.FileInfo(filename="f", version=1, blocklist=blocklist)
+        result = cluster.leader.ModifyFile(info, None)
+        assert result.result == SurfStoreBasic_pb2.WriteResult.MISSING_BLOCKS
+        assert list(result.missing_blocks) == blocklist[1::2]
+
+        by_hash = dict((b.hash, b) for b in blocks)
+        router.store_blocks(blocklist[1::2], lambda hashes: (by_hash[h] for h in hashes))
+        assert cluster.leader.ModifyFile(info, None).result == SurfStoreBasic_pb2.WriteResult.OK
+
+def test_store_blocks_stores_the_whole_stream():
+    store = BlockStore(Config())
+    blocks = [make_block(i, 4096) for i in range(50)]
+    # a block sent twice is stored once, and counted each time
+    result = store.StoreBlocks(iter(blocks + blocks[:5]), Context())
+    assert result.stored == 55
+    assert sorted(store.backend.keys()) == sorted(b.hash for b in blocks)
+    assert all(store.GetBlock(b, None).data == b.data for b in blocks)
+
+def test_store_blocks_refuses_a_block_over_the_blocksize():
+    store = BlockStore(Config())
+    blocks = [make_block(1), make_block(2, 5000), make_block(3)]
+    try:
+        store.StoreBlocks(iter(blocks), Context())
+        assert False, "StoreBlocks should abort"
+    except Aborted as e:
+        assert e.args[0] == grpc.StatusCode.INVALID_ARGUMENT
+    # the blocks before it were stored, nothing after
+    assert store.backend.keys() == [blocks[0].hash]
+
+def test_get_blocks_streams_in_request_order():
+    store = BlockStore(Config())
+    blocks = [make_block(i) for i in range(10)]
+    for block in blocks[:8]:
+        store.StoreBlock(block, None)
+    hashes = [blocks[i].hash for i in (5, 9, 0, 5, 7)]
+    answers = list(store.GetBlocks(SurfStoreBasic_pb2.BlockList(hashes=hashes), None))
+    # a block that isn't stored comes back empty, in its place
+    assert [a.hash for a in answers] == [blocks[5].hash, "", blocks[0].hash, blocks[5].hash, blocks[7].hash]
+    assert answers[3].data == blocks[5].data and answers[1].data == b""
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,84 @@
+##############################################################################
+# test_chunker.py
+#
+# Tests of the client's chunking specs and cut points. Needs no servers:
+#   $ python test_chunker.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import io
+import random
+
+from chunker import (cdc_spec, chunk_file, default_cdc_sizes, max_chunk_size,
+                     parse_chunking)
+from config_reader import DEFAULT_BLOCK_SIZE
+
+
+def random_bytes(size, seed):
+    rand = random.Random(seed)
+    return bytes(bytearray(rand.getrandbits(8) for _ in range(size)))
+
+def chunks(data, spec):
+    return [bytes(block) for block in chunk_file(io.BytesIO(data), spec)]
+
+
+def test_default_cdc_sizes_fit_the_blocksize():
+    for block_size in (DEFAULT_BLOCK_SIZE, 1, 100, 4096, 65536, 4 * 1024 * 1024 - 1024):
+        spec = cdc_spec(*default_cdc_sizes(block_size))
+        assert max_chunk_size(spec) == block_size
+    assert cdc_spec(*default_cdc_sizes(4096)) == "cdc:256:1024:4096"
+
+def test_bad_specs_are_refused():
+    for spec in ("fixed:0", "fixed", "cdc:10:5:20", "cdc:1:2", "zip:1"):
+        try:
+            parse_chunking(spec)
+            assert False, "%s should be refused" % spec
+        except ValueError:
+            pass
+    assert parse_chunking("") == parse_chunking("fixed:4096")
+
+def test_fixed_chunks():
+    data = random_bytes(10000, 1)
+    blocks = chunks(data, "fixed:4096")
+    assert [len(b) for b in blocks] == [4096, 4096, 1808]
+    assert b"".join(blocks) == data
+    assert chunks(b"", "fixed:4096") == []
+
+def test_cdc_chunks_stay_within_the_sizes():
+    data = random_bytes(300000, 2)
+    spec = cdc_spec(*default_cdc_sizes(4096))
+    blocks = chunks(data, spec)
+    assert b"".join(blocks) == data
+    assert all(256 <= len(b) <= 4096 for b in blocks[:-1])
+    assert 0 < len(blocks[-1]) <= 4096
+    # cuts at content, not at max size, most of the time
+    assert sum(len(b) == 4096 for b in blocks) < len(blocks) // 10
+    # zeros never match the mask, they are cut at the largest size
+    assert [len(b) for b in chunks(bytes(10000), spec)] == [4096, 4096, 1808]
+
+def test_cdc_boundaries_survive_an_insert():
+    data = random_bytes(200000, 3)
+    spec = cdc_spec(*default_cdc_sizes(4096))
+    before = chunks(data, spec)
+    edited = data[:50000] + b"inserted bytes" + data[50000:]
+    after = chunks(edited, spec)
+
+    # the blocks before the insert are the same, and after a block or two
+    # the cuts line up again, so nearly every block is reused
+    offset = 0
+    for i, block in enumerate(before):
+        if offset + len(block) > 50000:
+            break
+        assert after[i] == block
+        offset += len(block)
+    changed = set(after) - set(before)
+    assert len(changed) <= 3
+    # fixed size blocks all change after the insert
+    fixed = set(chunks(edited, "fixed:4096")) - set(chunks(data, "fixed:4096"))
+    assert len(fixed) > 30
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
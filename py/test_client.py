@@ -0,0 +1,193 @@
+##############################################################################
+# test_client.py
+#
+# Tests of the client's uploads, downloads and hashing against an in-process
+# cluster. Needs no servers:
+#   $ python test_client.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+
+import SurfStoreBasic_pb2
+import client
+from config_reader import MAX_BLOCK_SIZE, SurfStoreConfigReader
+from local_cluster import LocalCluster
+
+
+def random_bytes(size, seed):
+    rand = random.Random(seed)
+    return bytes(bytearray(rand.getrandbits(8) for _ in range(size)))
+
+def expected_blocks(data, block_size):
+    return [(base64.b64encode(hashlib.sha256(data[start:start + block_size]).digest()).decode(),
+             start, len(data[start:start + block_size]))
+            for start in range(0, len(data), block_size)]
+
+
+class Client(object):
+    ''' A cluster, its stubs and a directory for the client's files '''
+    def __init__(self, **cluster_args):
+        self.cluster = LocalCluster(**cluster_args)
+        self.mstub = self.cluster.metadata_router()
+        self.bstub = self.cluster.block_router()
+        self.directory = tempfile.mkdtemp()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, data):
+        with open(self.path(name), "wb") as f:
+            f.write(data)
+        return self.path(name)
+
+    def upload(self, name, version):
+        ''' store_file the way modifyFile does, return the bytes uploaded '''
+        hashes, locations = client.file_blocks(self.path(name), client.DEFAULT_CHUNKING)
+        file_info = SurfStoreBasic_pb2.FileInfo(filename=name, version=version, blocklist=hashes,
+                                                chunking=client.DEFAULT_CHUNKING)
+        result, uploaded = client.store_file(self.mstub, self.bstub, file_info, self.path(name), locations)
+        assert result.result == 0
+        return uploaded
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cluster.stop()
+        shutil.rmtree(self.directory)
+
+
+def test_upload_sends_only_the_missing_blocks():
+    with Client(blocks=2) as c:
+        data = random_bytes(10 * 4096, 1)
+        c.write("f", data)
+        assert c.upload("f", 1) == len(data)
+        hashes, _ = client.file_blocks(c.path("f"), client.DEFAULT_CHUNKING)
+        # every block went to the server that owns it
+        assert c.bstub.missing_blocks(hashes) == []
+
+        # one changed block, and one that is already stored twice
+        changed = data[:4096] + b"x" * 4096 + data[8192:] + data[:4096] + b"tail"
+        c.write("f", changed)
+        assert c.upload("f", 2) == 4096 + 4
+        # nothing left to upload for a copy of the same file
+        c.write("g", changed)
+        assert c.upload("g", 1) is None
+
+def test_eager_upload_pushes_every_block_at_once():
+    with Client(blocks=2) as c:
+        data = random_bytes(6 * 4096, 2)
+        c.write("f", data)
+        hashes, locations = client.file_blocks(c.path("f"), client.DEFAULT_CHUNKING)
+        file_info = SurfStoreBasic_pb2.FileInfo(filename="f", version=1, blocklist=hashes)
+        push = client.futures.ThreadPoolExecutor(max_workers=1).submit(
+            client.upload_blocks, c.bstub, list(locations), c.path("f"), locations)
+        result, uploaded = client.store_file(c.mstub, c.bstub, file_info, c.path("f"), locations, push)
+        # the push may be done before the check, then nothing was missing
+        assert result.result == 0 and uploaded in (None, len(data))
+        assert c.bstub.missing_blocks(hashes) == []
+
+def test_download_streams_blocks_from_every_server():
+    with Client(blocks=3) as c:
+        data = random_bytes(40 * 4096 + 1234, 3)
+        c.write("f", data)
+        c.upload("f", 1)
+        blocklist = list(c.mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f")).blocklist)
+
+        fetched, tups = client.fetch_file(c.bstub, blocklist, c.path("copy"))
+        assert open(c.path("copy"), "rb").read() == data
+        assert fetched == len(data)
+        assert [t[0] for t in tups] == blocklist and tups[-1][1:] == (40 * 4096, 1234)
+
+def test_failed_download_leaves_the_old_file():
+    with Client(blocks=2) as c:
+        c.write("f", random_bytes(5 * 4096, 4))
+        c.upload("f", 1)
+        blocklist = list(c.mstub.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f")).blocklist)
+        c.write("copy", b"old")
+        try:
+            client.fetch_file(c.bstub, blocklist[:3] + ["not a stored hash"] + blocklist[3:], c.path("copy"))
+            assert False, "fetch_file should fail"
+        except Exception as e:
+            assert "missing" in str(e)
+        # the temp file was removed and the file is what it was
+        assert sorted(os.listdir(c.directory)) == ["copy", "f"]
+        assert open(c.path("copy"), "rb").read() == b"old"
+
+def test_blocklist_is_hashed_at_any_block_size():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "f")
+        data = random_bytes(100000, 5)
+        with open(path, "wb") as f:
+            f.write(data)
+        # smaller and larger blocks than the file, and a last one cut short
+        for block_size in (1000, 4096, 65536, 200000):
+            blocks = list(client.create_blocklist(path, "fixed:%d" % block_size))
+            assert blocks == expected_blocks(data, block_size)
+        open(path, "wb").close()
+        assert list(client.create_blocklist(path, "fixed:4096")) == []
+        assert client.create_blocklist(os.path.join(directory, "missing")) is None
+    finally:
+        shutil.rmtree(directory)
+
+def test_parallel_hashing_gives_the_same_blocklist():
+    directory = tempfile.mkdtemp()
+    saved = client.hash_workers, client._PARALLEL_HASH_MIN_BYTES, client._HASH_RANGE_BYTES
+    try:
+        path = os.path.join(directory, "f")
+        data = random_bytes(300000, 7)
+        with open(path, "wb") as f:
+            f.write(data)
+        # small ranges, so the file is split over the threads
+        client.hash_workers, client._PARALLEL_HASH_MIN_BYTES, client._HASH_RANGE_BYTES = 4, 1, 20000
+        for block_size in (1000, 4096, 30000, 400000):
+            blocks = client.create_blocklist(path, "fixed:%d" % block_size)
+            assert blocks.__name__ == "_hash_blocks_parallel"
+            assert list(blocks) == expected_blocks(data, block_size)
+        # content-defined chunking is never split
+        assert client.create_blocklist(path, "cdc:256:1024:4096").__name__ == "_hash_blocks"
+    finally:
+        client.hash_workers, client._PARALLEL_HASH_MIN_BYTES, client._HASH_RANGE_BYTES = saved
+        shutil.rmtree(directory)
+
+def test_files_round_trip_at_a_configured_block_size():
+    with Client(blocks=2, block_size=1024) as c:
+        assert c.cluster.config.get_block_size() == 1024
+        data = random_bytes(50 * 1024 + 17, 6)
+        c.write("f", data)
+        hashes, locations = client.file_blocks(c.path("f"), "fixed:1024")
+        assert len(hashes) == 51 and max(length for _, length in locations.values()) == 1024
+        file_info = SurfStoreBasic_pb2.FileInfo(filename="f", version=1, blocklist=hashes, chunking="fixed:1024")
+        result, uploaded = client.store_file(c.mstub, c.bstub, file_info, c.path("f"), locations)
+        assert result.result == 0 and uploaded == len(data)
+
+        client.fetch_file(c.bstub, hashes, c.path("copy"))
+        assert open(c.path("copy"), "rb").read() == data
+
+def test_block_size_out_of_range_is_refused():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "config.txt")
+        for block_size in (0, MAX_BLOCK_SIZE + 1):
+            with open(path, "w") as f:
+                f.write("M: 1\nL: 1\nmetadata1: 9001\nblock: 9002\nblocksize: %d\n" % block_size)
+            try:
+                SurfStoreConfigReader(path)
+                assert False, "blocksize %d should be refused" % block_size
+            except Exception as e:
+                assert "blocksize" in str(e)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
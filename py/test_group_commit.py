@@ -0,0 +1,86 @@
+##############################################################################
+# test_group_commit.py
+#
+# Tests of batching concurrent writes into one commit. Needs no servers:
+#   $ python test_group_commit.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import asyncio
+import threading
+import time
+
+from group_commit import GroupCommit
+
+
+class Recorder(object):
+    ''' A commit function that takes a while and remembers its batches '''
+    def __init__(self, delay=0.02, fail=None):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+
+    def __call__(self, entries):
+        self.batches.append(list(entries))
+        time.sleep(self.delay)
+        if self.fail in entries:
+            raise ValueError("commit of %s failed" % self.fail)
+        return ["done %s" % entry for entry in entries]
+
+def submit_all(group, entries):
+    results = {}
+    def submit(entry):
+        try:
+            results[entry] = group.submit(entry)
+        except ValueError as e:
+            results[entry] = e
+    threads = [threading.Thread(target=submit, args=(entry,)) for entry in entries]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_writes_share_a_commit():
+    commit = Recorder()
+    group = GroupCommit(commit, 0.005, 8)
+    results = submit_all(group, range(40))
+
+    assert results == dict((i, "done %d" % i) for i in range(40))
+    # while one batch commits the next fills up, up to max_batch
+    assert len(commit.batches) < 20 and max(len(b) for b in commit.batches) <= 8
+    assert sorted(sum(commit.batches, [])) == list(range(40))
+    assert group.entries == 40 and group.batches == len(commit.batches)
+    assert "40 writes" in group.stats()
+
+def test_a_failed_commit_fails_its_whole_batch_only():
+    commit = Recorder(fail=3)
+    group = GroupCommit(commit, 0.05, 100)
+    results = submit_all(group, range(5))
+    failed = [batch for batch in commit.batches if 3 in batch][0]
+    assert len(failed) > 1
+    for entry, result in results.items():
+        assert isinstance(result, ValueError) == (entry in failed)
+    assert group.submit(7) == "done 7"
+
+def test_async_submit_resolves_on_the_loop():
+    commit = Recorder()
+    group = GroupCommit(commit, 0.005, 100)
+
+    async def writes():
+        return await asyncio.gather(*[group.submit_async(i) for i in range(10)])
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        assert loop.run_until_complete(writes()) == ["done %d" % i for i in range(10)]
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+    assert len(commit.batches) <= 2
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,78 @@
+##############################################################################
+# test_hash_ring.py
+#
+# Tests of block placement on the consistent-hash ring, and of moving blocks
+# after servers are added. Needs no servers:
+#   $ python test_hash_ring.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import collections
+
+import SurfStoreBasic_pb2
+from block_router import BlockRouter
+from hash_ring import HashRing
+from local_cluster import LocalCluster, open_channel
+from rebalance import rebalance
+
+_KEYS = ["block-%d" % i for i in range(20000)]
+
+
+class OldConfig(object):
+    ''' The block servers a cluster had before some were added '''
+    def __init__(self, config, servers):
+        self.block_ports = dict((i, config.block_ports[i]) for i in servers)
+        self.replication = config.replication
+        self.write_quorum = config.write_quorum
+
+
+def test_blocks_spread_evenly():
+    ring = HashRing([1, 2, 3, 4])
+    owners = collections.Counter(ring.lookup(key) for key in _KEYS)
+    assert sorted(owners) == [1, 2, 3, 4]
+    assert all(0.15 < count / float(len(_KEYS)) < 0.35 for count in owners.values())
+    # the same servers in another order place every block the same
+    again = HashRing([4, 2, 1, 3])
+    assert all(ring.lookup(key) == again.lookup(key) for key in _KEYS[:1000])
+
+def test_adding_a_server_only_moves_blocks_to_it():
+    before = HashRing([1, 2, 3, 4])
+    after = HashRing([1, 2, 3, 4, 5])
+    moved = [key for key in _KEYS if before.lookup(key) != after.lookup(key)]
+    assert all(after.lookup(key) == 5 for key in moved)
+    assert 0.1 < len(moved) / float(len(_KEYS)) < 0.3
+
+def test_replicas_are_distinct_servers():
+    ring = HashRing([1, 2, 3])
+    for key in _KEYS[:2000]:
+        replicas = ring.lookup_n(key, 2)
+        assert len(set(replicas)) == 2 and replicas[0] == ring.lookup(key)
+        assert tuple(replicas) in ring.replica_sets(2)
+    # never more replicas than servers
+    assert sorted(ring.lookup_n(_KEYS[0], 5)) == [1, 2, 3]
+    assert len(ring.replica_sets(3)) <= 6
+
+def test_rebalance_moves_blocks_to_the_new_servers():
+    with LocalCluster(blocks=3) as cluster:
+        # stored while only servers 1 and 2 were in the config
+        old = OldConfig(cluster.config, [1, 2])
+        blocks = [SurfStoreBasic_pb2.Block(hash="h%d" % i, data=b"%d" % i) for i in range(300)]
+        by_hash = dict((b.hash, b) for b in blocks)
+        BlockRouter(old, open_channel).store_blocks(list(by_hash), lambda hashes: (by_hash[h] for h in hashes))
+        assert not cluster.block_stores[3].backend.keys()
+
+        rebalance(old, cluster.config)
+        ring = HashRing([1, 2, 3])
+        for server_id, store in cluster.block_stores.items():
+            held = store.backend.keys()
+            assert all(ring.lookup(b_hash) == server_id for b_hash in held)
+        assert sum(len(store.backend.keys()) for store in cluster.block_stores.values()) == 300
+        router = cluster.block_router()
+        assert router.missing_blocks(list(by_hash)) == []
+        assert router.GetBlock(blocks[7]).data == b"7"
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,98 @@
+##############################################################################
+# test_local_index.py
+#
+# Tests of the client's LocalBlockIndex. Needs no servers:
+#   $ python test_local_index.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+
+from local_index import LocalBlockIndex
+
+
+def block_hash(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+def write_file(directory, name, blocks):
+    ''' Write the blocks to a file, return its path and (hash, offset, length) '''
+    path = os.path.join(directory, name)
+    hash_offset_tups = []
+    offset = 0
+    with open(path, "wb") as f:
+        for data in blocks:
+            f.write(data)
+            hash_offset_tups.append((block_hash(data), offset, len(data)))
+            offset += len(data)
+    return path, hash_offset_tups
+
+
+def test_shared_block_survives_replacing_one_file():
+    directory = tempfile.mkdtemp()
+    try:
+        index = LocalBlockIndex(os.path.join(directory, "index.json"))
+        shared = b"shared block"
+        a, a_blocks = write_file(directory, "a", [shared, b"only in a"])
+        b, b_blocks = write_file(directory, "b", [b"only in b", shared])
+        index.set_file(a, a_blocks)
+        index.set_file(b, b_blocks)
+
+        # a is rewritten without the shared block, b still has it
+        a, a_blocks = write_file(directory, "a", [b"new a"])
+        index.set_file(a, a_blocks)
+        assert index.has_block(block_hash(shared))
+        assert index.read_block(block_hash(shared)) == shared
+        assert not index.has_block(block_hash(b"only in a"))
+
+        index.set_file(b, [])
+        assert not index.has_block(block_hash(shared))
+        index.close_files()
+    finally:
+        shutil.rmtree(directory)
+
+def test_changed_copy_falls_back_to_another_file():
+    directory = tempfile.mkdtemp()
+    try:
+        index = LocalBlockIndex(os.path.join(directory, "index.json"))
+        shared = b"x" * 100
+        a, a_blocks = write_file(directory, "a", [shared])
+        b, b_blocks = write_file(directory, "b", [b"y" * 10, shared])
+        index.set_file(a, a_blocks)
+        index.set_file(b, b_blocks)
+
+        # a changes behind the index's back
+        write_file(directory, "a", [b"z" * 100])
+        assert index.read_block(block_hash(shared)) == shared
+        # and once no file has it any more there's nothing to read
+        write_file(directory, "b", [b"z" * 110])
+        index.close_files()
+        assert index.read_block(block_hash(shared)) is None
+        index.close_files()
+    finally:
+        shutil.rmtree(directory)
+
+def test_saved_index_loads_back():
+    directory = tempfile.mkdtemp()
+    try:
+        index_file = os.path.join(directory, "index.json")
+        index = LocalBlockIndex(index_file)
+        data = b"saved"
+        a, a_blocks = write_file(directory, "a", [data, data])
+        index.set_file(a, a_blocks)
+        index.save()
+
+        loaded = LocalBlockIndex(index_file)
+        assert loaded.read_block(block_hash(data)) == data
+        loaded.close_files()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
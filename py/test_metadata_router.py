@@ -0,0 +1,91 @@
+##############################################################################
+# test_metadata_router.py
+#
+# Tests of follower reads and their read-your-writes tokens, against
+# metadata servers running in this process. Needs no servers:
+#   $ python test_metadata_router.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import collections
+import time
+
+import SurfStoreBasic_pb2
+from local_cluster import LocalCluster
+
+
+class Reads(object):
+    ''' LocalCluster setup counting the ReadFile calls each server answers,
+    with the Commits to the followers in slow delayed by delay seconds '''
+    def __init__(self, slow=(), delay=0.0):
+        self.served = collections.Counter()
+        self.slow = slow
+        self.delay = delay
+
+    def __call__(self, store):
+        read_file, commit = store.ReadFile, store.Commit
+        def ReadFile(request, context):
+            self.served[store.myID] += 1
+            return read_file(request, context)
+        def Commit(request, context):
+            time.sleep(self.delay)
+            return commit(request, context)
+        store.ReadFile = ReadFile
+        if store.myID in self.slow:
+            store.Commit = Commit
+
+def write(router, filename, version):
+    info = SurfStoreBasic_pb2.FileInfo(filename=filename, version=version, blocklist=[])
+    result = router.ModifyFile(info)
+    assert result.result == 0
+    return result.log_index
+
+def read_version(router, filename):
+    return router.ReadFile(SurfStoreBasic_pb2.FileInfo(filename=filename)).version
+
+
+def test_reads_are_spread_over_every_server():
+    reads = Reads()
+    with LocalCluster(metadata=3, setup=reads) as cluster:
+        router = cluster.metadata_router(follower_reads=True)
+        write(router, "f", 1)
+        for _ in range(30):
+            assert read_version(router, "f") == 1
+        assert all(reads.served[server_id] >= 5 for server_id in (1, 2, 3))
+
+        # without follower reads everything goes to the leader
+        reads.served.clear()
+        router = cluster.metadata_router()
+        for _ in range(10):
+            read_version(router, "f")
+        assert reads.served == {1: 10}
+
+def test_a_lagging_follower_never_hides_our_writes():
+    # server 3 gets every commit well after the client's next read
+    reads = Reads(slow=(3,), delay=0.2)
+    with LocalCluster(metadata=3, setup=reads) as cluster:
+        router = cluster.metadata_router(follower_reads=True)
+        for version in range(1, 6):
+            index = write(router, "f", version)
+            assert router.token >= index
+            for _ in range(3):
+                assert read_version(router, "f") == version
+        # server 3 was asked, and sent the reads on to the leader
+        assert reads.served[3] > 0 and reads.served[1] > 0
+
+def test_reads_skip_a_crashed_follower():
+    with LocalCluster(metadata=3) as cluster:
+        router = cluster.metadata_router(follower_reads=True)
+        write(router, "f", 1)
+        cluster.metadata_stores[2].Crash(SurfStoreBasic_pb2.Empty(), None)
+        write(router, "f", 2)
+        for _ in range(10):
+            assert read_version(router, "f") == 2
+        # a crashed follower answers with log index -1 and is left out
+        assert router.down_until.get(2, 0) > time.time()
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
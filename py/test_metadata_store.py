@@ -0,0 +1,235 @@
+##############################################################################
+# test_metadata_store.py
+#
+# Tests of the MetadataStore's log, snapshots and replication, with the
+# servers in this process and no BlockStore. Needs no servers:
+#   $ python test_metadata_store.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import random
+import threading
+import time
+
+import SurfStoreBasic_pb2
+from local_cluster import LocalCluster
+from metadata_store import MetadataStore
+
+
+class Config(object):
+    num_metadata_servers = 1
+    metadata_ports = {1: 0}
+    block_ports = {}
+
+def block_hash(i):
+    return base64.b64encode(hashlib.sha256(b"%d" % i).digest()).decode()
+
+def write(store, log):
+    ''' Apply a committed log entry the way the leader does '''
+    with store.log_lock:
+        store.apply_log(log)
+
+def slow_commits(store):
+    ''' LocalCluster setup: followers answer Commit after a random pause,
+    so Commits sent at the same time could overtake each other '''
+    if store.myID == 1:
+        return
+    commit = store.Commit
+    rand = random.Random(store.myID)
+    def Commit(request, context):
+        time.sleep(rand.random() * 0.005)
+        return commit(request, context)
+    store.Commit = Commit
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_compacted_snapshot_keeps_blocklists():
+    store = MetadataStore(Config())
+    store.snapshot_entries = 5
+    for i in range(12):
+        write(store, ("mod", "f%d" % (i % 4), i // 4 + 1, [block_hash(i), block_hash(i + 100)], "fixed:4096"))
+    store.compact_log()
+    assert store.snapshot_index == 12 and store.logs == []
+
+    chunks = list(store.snapshot_chunks())
+    sent = dict((f.filename, list(f.blocklist)) for chunk in chunks for f in chunk.files)
+    for name, record in store.files.items():
+        assert sent[name] == store.files.blocklist(record)
+    assert sent["f0"] == [block_hash(8), block_hash(108)]
+
+    # a follower installing it has the same files
+    follower = MetadataStore(Config())
+    assert follower.InstallSnapshot(iter(chunks), None).answer
+    read = follower.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f0"), None)
+    assert list(read.blocklist) == [block_hash(8), block_hash(108)]
+
+def test_snapshot_chunks_carry_the_log_after_the_snapshot():
+    store = MetadataStore(Config())
+    store.snapshot_entries = 4
+    for i in range(6):
+        write(store, ("mod", "f%d" % i, 1, [block_hash(i)], "fixed:4096"))
+    store.compact_log()
+    write(store, ("del", "f0", 2, ["0"], ""))
+    write(store, ("mod", "f9", 1, [block_hash(9)], "fixed:4096"))
+
+    follower = MetadataStore(Config())
+    assert follower.InstallSnapshot(store.snapshot_chunks(), None).answer
+    assert follower.last_index() == store.last_index() == 8
+    assert list(follower.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f0"), None).blocklist) == ["0"]
+    assert list(follower.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="f9"), None).blocklist) == [block_hash(9)]
+
+def test_concurrent_rounds_reach_the_followers_in_order():
+    with LocalCluster(metadata=3, setup=slow_commits) as cluster:
+        leader = cluster.leader
+        # small batches, so many rounds are in flight at once
+        leader.group_commit.window = 0
+        mstub = cluster.metadata_router()
+        crashes = []
+        mark_crashed = leader.mark_crashed
+        def record_crash(i):
+            crashes.append(i)
+            mark_crashed(i)
+        leader.mark_crashed = record_crash
+
+        def writer(w):
+            for i in range(25):
+                info = SurfStoreBasic_pb2.FileInfo(filename="w%d-%d" % (w, i), version=1, blocklist=[])
+                assert mstub.ModifyFile(info).result == 0
+        threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert leader.last_index() == 200
+        for server_id in (2, 3):
+            follower = cluster.metadata_stores[server_id]
+            wait_for(lambda: follower.last_index() == 200)
+            assert sorted(follower.files.names()) == sorted(leader.files.names())
+        # no Commit arrived out of order, so no follower was taken for crashed
+        assert crashes == [] and leader.crashed_followers == []
+        assert leader.commit_sent == [200, 200]
+
+def test_yes_votes_of_crashed_followers_do_not_count():
+    with LocalCluster(metadata=3) as cluster:
+        leader = cluster.leader
+        # nothing brings a follower back while the test runs
+        leader.start_catch_up = lambda i, follower_index: None
+        rpc_logs = SurfStoreBasic_pb2.Logs()
+        rpc_logs.allLogs.extend([leader.rpc_log(("mod", "f", 1, [], ""), 1)])
+
+        # server 3 votes no, and server 2 votes yes but failed a Commit
+        cluster.metadata_stores[3].Crash(SurfStoreBasic_pb2.Empty(), None)
+        with leader.crashed_lock:
+            leader.crashed_followers.append(0)
+        assert not leader.replicate(rpc_logs)
+        assert cluster.metadata_stores[2].last_index() == 0
+
+        # a follower that missed a round isn't counted or sent later ones
+        with leader.crashed_lock:
+            leader.crashed_followers.remove(0)
+            leader.commit_sent[0] = -1
+        assert not leader.replicate(rpc_logs)
+        with leader.crashed_lock:
+            leader.commit_sent[0] = 0
+        assert leader.replicate(rpc_logs)
+        wait_for(lambda: cluster.metadata_stores[2].last_index() == 1)
+
+def modify(store, filename, version):
+    info = SurfStoreBasic_pb2.FileInfo(filename=filename, version=version, blocklist=[])
+    assert store.ModifyFile(info, None).result == 0
+
+def test_racing_writers_each_win_distinct_versions():
+    for metadata in (1, 3):
+        with LocalCluster(metadata=metadata) as cluster:
+            leader = cluster.leader
+            won = []
+            def writer():
+                for _ in range(30):
+                    version = leader.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="shared"), None).version + 1
+                    info = SurfStoreBasic_pb2.FileInfo(filename="shared", version=version, blocklist=[])
+                    result = leader.ModifyFile(info, None)
+                    if result.result == 0:
+                        won.append(version)
+                    else:
+                        assert result.result == 1 and result.current_version >= version
+            threads = [threading.Thread(target=writer) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # every version went to exactly one writer, with none skipped
+            assert sorted(won) == list(range(1, len(won) + 1))
+            assert leader.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="shared"), None).version == len(won)
+
+def test_a_write_only_waits_for_writes_to_the_same_file():
+    with LocalCluster() as cluster:
+        leader = cluster.leader
+        names = ["f%d" % i for i in range(200)]
+        busy = names[0]
+        other = [name for name in names if leader.file_lock(name) is not leader.file_lock(busy)][0]
+        done = []
+        def write(name):
+            modify(leader, name, 1)
+            done.append(name)
+
+        with leader.file_lock(busy):
+            threads = [threading.Thread(target=write, args=(name,)) for name in (busy, other)]
+            for thread in threads:
+                thread.start()
+            threads[1].join(5)
+            time.sleep(0.05)
+            assert done == [other]
+        threads[0].join(5)
+        assert done == [other, busy]
+
+def test_restored_follower_is_sent_the_entries_it_missed():
+    with LocalCluster(metadata=3) as cluster:
+        leader, follower = cluster.leader, cluster.metadata_stores[3]
+        modify(leader, "before", 1)
+        wait_for(lambda: follower.last_index() == 1)
+
+        follower.Crash(SurfStoreBasic_pb2.Empty(), None)
+        for i in range(20):
+            modify(leader, "f%d" % i, 1)
+        modify(leader, "before", 2)
+        assert follower.last_index() == 1
+        wait_for(lambda: 1 in leader.crashed_followers)
+
+        follower.Restore(SurfStoreBasic_pb2.Empty(), None)
+        wait_for(lambda: follower.last_index() == 22 and not leader.crashed_followers)
+        assert follower.ReadFile(SurfStoreBasic_pb2.FileInfo(filename="before"), None).version == 2
+        # and it takes part in the next rounds again
+        modify(leader, "after", 1)
+        wait_for(lambda: follower.last_index() == 23)
+
+def test_follower_behind_the_snapshot_is_sent_the_snapshot():
+    with LocalCluster(metadata=3) as cluster:
+        leader, follower = cluster.leader, cluster.metadata_stores[2]
+        leader.snapshot_entries = 10
+        follower.Crash(SurfStoreBasic_pb2.Empty(), None)
+        for i in range(25):
+            modify(leader, "f%d" % (i % 10), i // 10 + 1)
+        leader.compact_log()
+        assert leader.snapshot_index == 25
+        modify(leader, "f0", 4)
+
+        follower.Restore(SurfStoreBasic_pb2.Empty(), None)
+        wait_for(lambda: follower.last_index() == 26)
+        assert sorted(follower.files.names()) == sorted(leader.files.names())
+        for name in leader.files.names():
+            info = SurfStoreBasic_pb2.FileInfo(filename=name)
+            assert follower.ReadFile(info, None).version == leader.ReadFile(info, None).version
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,89 @@
+##############################################################################
+# test_metadata_table.py
+#
+# Tests of the MetadataStore's file map, BlockIds and FileTable. Needs no
+# servers:
+#   $ python test_metadata_table.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+
+from metadata_table import OTHER_IDS, BlockIds, FileTable
+
+
+def block_hash(i):
+    return base64.b64encode(hashlib.sha256(b"%d" % i).digest()).decode()
+
+
+def test_digests_intern_to_stable_ids():
+    block_ids = BlockIds()
+    # enough hashes to grow the table a few times
+    hashes = [block_hash(i) for i in range(5000)]
+    ids = [block_ids.intern(b_hash) for b_hash in hashes]
+    assert ids == list(range(5000))
+    assert [block_ids.intern(b_hash) for b_hash in hashes] == ids
+    assert [block_ids.decode(block_id) for block_id in ids] == hashes
+    assert len(block_ids) == 5000
+
+def test_other_hashes_get_their_own_ids():
+    block_ids = BlockIds()
+    digest = block_hash(1)
+    # 44 characters that aren't a canonical base64 digest
+    odd = digest[:-2] + "B="
+    others = ["0", "not a digest", "x" * 44, odd, "é" * 44]
+    ids = [block_ids.intern(b_hash) for b_hash in others]
+    assert all(block_id >= OTHER_IDS for block_id in ids)
+    assert len(set(ids)) == len(others)
+    assert [block_ids.decode(block_id) for block_id in ids] == others
+    assert block_ids.intern(digest) == 0
+    assert block_ids.intern("not a digest") == ids[1]
+
+def test_saved_ids_load_back():
+    block_ids = BlockIds()
+    hashes = [block_hash(i) for i in range(3000)] + ["other", "0"]
+    ids = [block_ids.intern(b_hash) for b_hash in hashes]
+
+    loaded = BlockIds(*block_ids.save())
+    assert [loaded.intern(b_hash) for b_hash in hashes] == ids
+    assert [loaded.decode(block_id) for block_id in ids] == hashes
+    # new hashes carry on after the loaded ones
+    assert loaded.intern(block_hash(3000)) == 3000
+    assert loaded.intern("another") == OTHER_IDS + 2
+
+def test_file_table_round_trips_log_entries():
+    files = FileTable()
+    logs = [
+        ("mod", "a", 1, [block_hash(1), block_hash(2), block_hash(1)], "fixed:4096"),
+        ("mod", "b", 1, [], "cdc:8192"),
+        ("mod", "c", 1, ["not a digest", block_hash(2)], "fixed:4096"),
+        ("del", "d", 2, ["0"], ""),
+    ]
+    for log in logs:
+        files.apply(log)
+    assert [files.log(files.get(log[1])) for log in logs] == logs
+    assert files.blocklist(files.get("d")) == ["0"]
+    assert len(files) == 4 and "c" in files and "e" not in files
+
+    # a new version replaces the record, a copy keeps the old one
+    snapshot = files.copy()
+    files.apply(("del", "a", 2, ["0"], ""))
+    assert files.get("a").deleted
+    assert snapshot.get("a").version == 1
+    assert snapshot.blocklist(snapshot.get("a")) == logs[0][3]
+    # the copy shares the block ids
+    assert snapshot.intern(block_hash(3)) == files.intern(block_hash(3))
+
+def test_chunking_specs_are_shared():
+    files = FileTable()
+    spec = "".join(["fixed:", "4096"])
+    files.apply(("mod", "a", 1, [block_hash(1)], spec))
+    files.apply(("mod", "b", 1, [block_hash(2)], "fixed:" + "4096"))
+    assert files.get("a").chunking is files.get("b").chunking
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
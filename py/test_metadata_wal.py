@@ -0,0 +1,190 @@
+##############################################################################
+# test_metadata_wal.py
+#
+# Tests of the MetadataStore's write-ahead log and snapshots. Needs no
+# servers:
+#   $ python test_metadata_wal.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+import metadata_wal
+from metadata_table import FileTable
+from metadata_wal import MetadataWal, encode_record, read_records, read_snapshot, write_snapshot
+
+
+def block_hash(data):
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+def entries(count):
+    ''' count log entries writing, changing and deleting a few files '''
+    logs = []
+    for i in range(count):
+        name = "dir/file%d" % (i % 3)
+        if i % 4 == 3:
+            logs.append(("del", name, i + 1, ["0"], ""))
+        else:
+            blocklist = [block_hash(b"%d-%d" % (i, j)) for j in range(i % 3)]
+            logs.append(("mod", name, i + 1, blocklist, "fixed:4096"))
+    return logs
+
+def table(logs):
+    files = FileTable()
+    for log in logs:
+        files.apply(log)
+    return files
+
+def contents(files):
+    return sorted((name, record.version, record.deleted, record.chunking, files.blocklist(record))
+                  for name, record in files.items())
+
+def write_log(path, records):
+    with open(path, "wb") as f:
+        for index, log in records:
+            f.write(encode_record(index, log))
+
+
+def test_records_read_back():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "log")
+        records = list(enumerate(entries(6), 1))
+        records.append((7, ("mod", "odd é name", 7, [], "cdc:8192")))
+        write_log(path, records)
+        assert list(read_records(path)) == records
+    finally:
+        shutil.rmtree(directory)
+
+def test_bad_crc_ends_the_log():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "log")
+        records = list(enumerate(entries(4), 1))
+        write_log(path, records)
+        good = len(encode_record(*records[0])) + len(encode_record(*records[1]))
+        with open(path, "r+b") as f:
+            # flip a byte in the payload of the third record
+            f.seek(good + metadata_wal._RECORD_HEADER.size + 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xff]))
+        assert list(read_records(path)) == records[:2]
+        assert os.path.getsize(path) == good
+    finally:
+        shutil.rmtree(directory)
+
+def test_torn_tail_is_truncated():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "log")
+        records = list(enumerate(entries(3), 1))
+        write_log(path, records)
+        whole = os.path.getsize(path)
+        for cut in (3, metadata_wal._RECORD_HEADER.size + 1, len(encode_record(4, entries(4)[3])) - 1):
+            with open(path, "ab") as f:
+                f.write(encode_record(4, entries(4)[3])[:cut])
+            assert list(read_records(path)) == records
+            assert os.path.getsize(path) == whole
+    finally:
+        shutil.rmtree(directory)
+
+def test_snapshot_and_log_recover():
+    directory = tempfile.mkdtemp()
+    try:
+        logs = entries(10)
+        wal = MetadataWal(directory, "sync")
+        assert wal.recover()[0] == 0
+        for index, log in enumerate(logs[:6], 1):
+            wal.append(index, log)
+        wal.rotate(6)
+        wal.save_snapshot(6, table(logs[:6]))
+        for index, log in enumerate(logs[6:], 7):
+            wal.append(index, log)
+        wal.close()
+        # the log file the snapshot covers is gone
+        assert wal.log_starts() == [6]
+
+        index, files, tail = MetadataWal(directory).recover()
+        assert index == 6
+        assert contents(files) == contents(table(logs[:6]))
+        assert tail == logs[6:]
+        for log in tail:
+            files.apply(log)
+        assert contents(files) == contents(table(logs))
+    finally:
+        shutil.rmtree(directory)
+
+def test_snapshot_keeps_every_kind_of_record():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "snapshot.bin")
+        files = table(entries(8))
+        files.apply(("mod", "empty", 1, [], "fixed:4096"))
+        # hashes that aren't sha256 digests are kept too
+        files.apply(("mod", "other", 2, ["abc", block_hash(b"x"), "abc"], "cdc:8192"))
+        write_snapshot(path, 42, files)
+        with open(path, "rb") as f:
+            assert f.read(4) == b"SSM2"
+
+        index, loaded = read_snapshot(path)
+        assert index == 42
+        assert contents(loaded) == contents(files)
+        assert loaded.intern("abc") == files.intern("abc")
+    finally:
+        shutil.rmtree(directory)
+
+def test_ssm1_snapshot_is_read():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "snapshot.bin")
+        files = table(entries(8))
+        # the SSM1 layout: the same columns, blocklists as NUL separated hashes
+        rows = sorted(files.items())
+        sections = [
+            b"".join(metadata_wal.struct.pack("<i", r.version) for _, r in rows),
+            bytes(bytearray(1 if r.deleted else 0 for _, r in rows)),
+            b"".join(metadata_wal.struct.pack("<I", len(r.blocks)) for _, r in rows),
+            "\0".join(name for name, _ in rows).encode("utf-8"),
+            "\0".join(r.chunking for _, r in rows).encode("utf-8"),
+            "\0".join(h for _, r in rows for h in files.blocklist(r) if not r.deleted).encode("utf-8"),
+        ]
+        body = b"".join(metadata_wal._SECTION_LENGTH.pack(len(s)) + s for s in sections)
+        with open(path, "wb") as f:
+            f.write(metadata_wal._SNAPSHOT_HEADER.pack(b"SSM1", 8, len(rows), zlib.crc32(body) & 0xffffffff))
+            f.write(body)
+
+        index, loaded = read_snapshot(path)
+        assert index == 8
+        assert contents(loaded) == contents(files)
+    finally:
+        shutil.rmtree(directory)
+
+def test_bad_snapshot_is_refused():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "snapshot.bin")
+        write_snapshot(path, 3, table(entries(3)))
+        with open(path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"?")
+        try:
+            read_snapshot(path)
+            assert False, "read_snapshot() should have raised"
+        except Exception as e:
+            assert "not a valid snapshot" in str(e)
+        # no snapshot at all is an empty table
+        assert read_snapshot(os.path.join(directory, "none"))[0] == 0
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -0,0 +1,146 @@
+##############################################################################
+# test_sync.py
+#
+# Tests of the client's sync command, two client directories against one
+# in-process cluster. Needs no servers:
+#   $ python test_sync.py     (or python -m pytest)
+##############################################################################
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+
+import client
+from local_cluster import LocalCluster
+
+
+def write_file(directory, name, data):
+    path = os.path.join(directory, *name.split("/"))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(data)
+    # a new mtime even within the same clock tick, so the change is seen
+    st = os.stat(path)
+    os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+def read_tree(directory):
+    return dict((name, open(os.path.join(directory, *name.split("/")), "rb").read())
+                for name in client.walk_tree(directory))
+
+def sync(cluster, directory):
+    return client.sync_dir(cluster.metadata_router(), cluster.block_router(), directory, workers=4).files
+
+
+class Peers(object):
+    ''' A cluster and two client directories, a and b '''
+    def __enter__(self):
+        self.cluster = LocalCluster(blocks=2)
+        self.root = tempfile.mkdtemp()
+        self.a = os.path.join(self.root, "a")
+        self.b = os.path.join(self.root, "b")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cluster.stop()
+        shutil.rmtree(self.root)
+
+
+def test_files_only_on_the_server_are_downloaded():
+    with Peers() as p:
+        files = {"top": b"x" * 10000, "sub/deep/file": b"y" * 5000, "empty": b""}
+        for name, data in files.items():
+            write_file(p.a, name, data)
+        assert sync(p.cluster, p.a)["upload"] == 3
+
+        # b starts out empty and has never synced
+        assert sync(p.cluster, p.b)["download"] == 3
+        assert read_tree(p.b) == files
+        assert sync(p.cluster, p.b) == {"same": 3}
+
+def test_files_only_here_are_uploaded():
+    with Peers() as p:
+        write_file(p.a, "shared", b"s" * 100)
+        sync(p.cluster, p.a)
+        sync(p.cluster, p.b)
+
+        write_file(p.b, "new/in/b", b"n" * 9000)
+        assert sync(p.cluster, p.b)["upload"] == 1
+        assert sync(p.cluster, p.a)["download"] == 1
+        assert read_tree(p.a) == read_tree(p.b)
+
+def test_file_changed_on_both_sides_is_a_conflict():
+    with Peers() as p:
+        write_file(p.a, "f", b"original")
+        sync(p.cluster, p.a)
+        sync(p.cluster, p.b)
+
+        write_file(p.a, "f", b"changed in a")
+        write_file(p.b, "f", b"changed in b")
+        assert sync(p.cluster, p.a)["upload"] == 1
+        assert sync(p.cluster, p.b)["conflict"] == 1
+        # b's copy is left alone, and so is the server's
+        assert read_tree(p.b) == {"f": b"changed in b"}
+        write_file(p.a, "g", b"g")
+        sync(p.cluster, p.a)
+        assert read_tree(p.a)["f"] == b"changed in a"
+
+def test_deletes_reach_the_other_side():
+    with Peers() as p:
+        write_file(p.a, "keep", b"k")
+        write_file(p.a, "gone", b"g" * 7000)
+        sync(p.cluster, p.a)
+        sync(p.cluster, p.b)
+
+        os.remove(os.path.join(p.a, "gone"))
+        assert sync(p.cluster, p.a)["delete"] == 1
+        assert sync(p.cluster, p.b)["remove"] == 1
+        assert read_tree(p.b) == {"keep": b"k"}
+        # a deleted file isn't listed, a new client doesn't bring it back
+        sync(p.cluster, os.path.join(p.root, "c"))
+        assert read_tree(os.path.join(p.root, "c")) == {"keep": b"k"}
+
+def test_server_that_lost_its_files_gets_them_again():
+    with Peers() as p:
+        write_file(p.a, "f", b"f" * 5000)
+        sync(p.cluster, p.a)
+
+        # the same directory against a new, empty cluster
+        p.cluster.stop()
+        p.cluster = LocalCluster(blocks=2)
+        assert sync(p.cluster, p.a)["upload"] == 1
+        assert read_tree(p.a) == {"f": b"f" * 5000}
+
+def test_many_files_take_several_read_batches():
+    # more files than one ReadFiles batch, the same for one worker or many
+    read_batch, client._SYNC_READ_BATCH = client._SYNC_READ_BATCH, 10
+    try:
+        count = 27
+        files = dict(("d%d/f%d" % (i % 5, i), b"%d" % i * (i % 50)) for i in range(count))
+        for workers in (1, 8):
+            with Peers() as p:
+                for name, data in files.items():
+                    write_file(p.a, name, data)
+                assert client.sync_dir(p.cluster.metadata_router(), p.cluster.block_router(),
+                                       p.a, workers=workers).files == {"upload": count}
+                assert client.sync_dir(p.cluster.metadata_router(), p.cluster.block_router(),
+                                       p.b, workers=workers).files == {"download": count}
+                assert read_tree(p.b) == files
+                assert sync(p.cluster, p.a) == {"same": count}
+    finally:
+        client._SYNC_READ_BATCH = read_batch
+
+def test_remote_names_outside_the_directory_are_skipped():
+    with Peers() as p:
+        mstub = p.cluster.metadata_router()
+        for name in ("../escape", "a//b", "ok/name", "dir/.surfstore_x"):
+            info = client.SurfStoreBasic_pb2.FileInfo(filename=name, version=1, blocklist=[])
+            assert mstub.ModifyFile(info).result == 0
+        assert client.remote_names(mstub) == set(["ok/name"])
+
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print("%s == PASS" % name)
@@ -239,6 +239,59 @@ def del_tests(mstub, bstub):
 
     return 'del_tests == PASS'
 
+def has_blocks_test(mstub, bstub):
+    stored = 'hasblocks.stored'
+    absent = 'hasblocks.absent'
+    bstub.StoreBlock(SurfStoreBasic_pb2.Block(hash=sha256(stored), data=stored))
+
+    hashes = [sha256(stored), sha256(absent)] * 5
+    bitmap = bstub.HasBlocks(SurfStoreBasic_pb2.BlockList(hashes=hashes)).bitmap
+    assert len(bitmap) == 2
+
+    for i in range(len(hashes)):
+        present = bool(bytearray(bitmap)[i >> 3] & (1 << (i & 7)))
+        assert present == (i % 2 == 0)
+
+    bitmap = bstub.HasBlocks(SurfStoreBasic_pb2.BlockList(hashes=[])).bitmap
+    assert len(bitmap) == 0
+
+    return 'has_blocks_test == PASS'
+
+def store_blocks_test(mstub, bstub):
+    datalist = ['storeblocks.%d' % i for i in range(600)]
+    hashlist = [ sha256(b) for b in datalist ]
+
+    blocks = (SurfStoreBasic_pb2.Block(hash=_hash, data=_data)
+              for _hash, _data in zip(hashlist, datalist))
+    assert bstub.StoreBlocks(blocks).stored == len(datalist)
+
+    for _hash, _data in zip(hashlist, datalist):
+        assert bstub.GetBlock(SurfStoreBasic_pb2.Block(hash=_hash)).data == _data
+
+    assert bstub.StoreBlocks(iter([])).stored == 0
+
+    return 'store_blocks_test == PASS'
+
+def get_blocks_test(mstub, bstub):
+    datalist = ['getblocks.%d' % i for i in range(10)]
+    hashlist = [ sha256(b) for b in datalist ]
+
+    for _hash, _data in zip(hashlist, datalist):
+        bstub.StoreBlock(SurfStoreBasic_pb2.Block(hash=_hash, data=_data))
+
+    request = hashlist + [sha256('getblocks.absent')] + hashlist[:1]
+    blocks = list(bstub.GetBlocks(SurfStoreBasic_pb2.BlockList(hashes=request)))
+    assert len(blocks) == len(request)
+
+    for block, _hash, _data in zip(blocks, hashlist, datalist):
+        assert block.hash == _hash
+        assert block.data == _data
+
+    assert blocks[-2].hash == ''
+    assert blocks[-1].data == datalist[0]
+
+    return 'get_blocks_test == PASS'
+
 ##############################################################################
 
 def sha256(s):
@@ -310,6 +363,12 @@ def run(config):
     print(result)
     result = del_tests (metadata_stub, block_stub)
     print(result)
+    result = has_blocks_test(metadata_stub, block_stub)
+    print(result)
+    result = store_blocks_test(metadata_stub, block_stub)
+    print(result)
+    result = get_blocks_test(metadata_stub, block_stub)
+    print(result)
 
 if __name__ == "__main__":
     args = parse_args()